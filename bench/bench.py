@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Measures xpgdiff on large catalogs, reporting each phase separately so
+that regressions show up as numbers:
+
+- introspect: reading the source and target catalogs, with the number
+  of queries run (live databases only)
+- diff: generating the migration DDL from source to target
+- render: generating the DDL of every source schema, as print_schema_ddl
+  does
+
+Peak memory is the process high-water mark (ru_maxrss) after each phase.
+
+Usage:
+
+  bench.py synthetic [--schemas N] [--tables N] [--columns N] [--functions N] [--drift F]
+  bench.py live [--jobs N] [--columnar] source-libpq-connstr target-libpq-connstr
+
+The synthetic mode builds both sides with synthetic.py; the live mode
+reads two databases created with fixture.sql.
+"""
+
+import argparse
+import json
+import resource
+import sys
+import threading
+import time
+
+import synthetic
+import xpgdiff
+
+class Measurements:
+    """ The measured phases of one benchmark run """
+    def __init__(self):
+        self.phases = []
+
+    def measure(self, name, func, queries=None):
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+        self.phases.append({'phase': name, 'seconds': round(seconds, 3), 'queries': queries() if queries else None, 'peak_rss_mib': round(peak_rss_mib(), 1)})
+        return result
+
+    def print_table(self):
+        print(f'{"phase":<12} {"seconds":>10} {"queries":>8} {"peak MiB":>10}')
+        for phase in self.phases:
+            queries = '' if phase['queries'] is None else phase['queries']
+            print(f'{phase["phase"]:<12} {phase["seconds"]:>10.3f} {queries:>8} {phase["peak_rss_mib"]:>10.1f}')
+
+def peak_rss_mib():
+    """
+    Gets the peak resident set size of the process.
+
+    :returns: The peak in MiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+class QueryCounter:
+    """ Counts the queries run on connections opened by xpgdiff.connect """
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def install(self):
+        counter = self
+        connect = xpgdiff.connect
+
+        class CountingCursor(xpgdiff.psycopg2.extensions.cursor):
+            def execute(self, query, vars=None):
+                with counter._lock:
+                    counter.count += 1
+                return super().execute(query, vars)
+
+        def counting_connect(*args, **kwargs):
+            conn = connect(*args, **kwargs)
+            conn.cursor_factory = CountingCursor
+            return conn
+
+        xpgdiff.connect = counting_connect
+
+def consume(statements):
+    """
+    Generates DDL statements without keeping them.
+
+    :param statements: The DDL statements.
+    :returns: The number of statements.
+    """
+    count = 0
+    for statement in statements:
+        count += 1
+    return count
+
+def run(source_schemas_func, target_schemas_func, queries=None):
+    """
+    Runs and measures the benchmark phases.
+
+    :param source_schemas_func: Called to get the source schemas.
+    :param target_schemas_func: Called to get the target schemas.
+    :param queries: Called to get the number of queries run so far, if counted.
+    :returns: The Measurements.
+    """
+    measurements = Measurements()
+    source_schemas, target_schemas = measurements.measure('introspect', lambda: (source_schemas_func(), target_schemas_func()), queries)
+    measurements.measure('diff', lambda: consume(xpgdiff.schemas_migration_ddl(source_schemas, target_schemas)))
+    measurements.measure('render', lambda: sum(consume(xpgdiff.schema_ddl(schema)) for schema in source_schemas))
+    return measurements
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Measures xpgdiff introspection, diff and render on large catalogs.')
+    parser.add_argument('--json', action='store_true', help='print the measurements as JSON')
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+    synthetic_parser = subparsers.add_parser('synthetic', help='build both sides in memory with synthetic.py')
+    synthetic_parser.add_argument('--schemas', type=int, default=50)
+    synthetic_parser.add_argument('--tables', type=int, default=20000)
+    synthetic_parser.add_argument('--columns', type=int, default=200)
+    synthetic_parser.add_argument('--functions', type=int, default=5000)
+    synthetic_parser.add_argument('--drift', type=float, default=0.01, help='fraction of tables and functions that differ in the target')
+    live_parser = subparsers.add_parser('live', help='read two databases created with fixture.sql')
+    live_parser.add_argument('--jobs', type=int, default=1, help='connections per database')
+    live_parser.add_argument('--columnar', action='store_true', help='keep table columns in column stores')
+    live_parser.add_argument('source')
+    live_parser.add_argument('target')
+    args = parser.parse_args(argv)
+
+    if args.mode == 'synthetic':
+        measurements = run(lambda: synthetic.build_schemas(args.schemas, args.tables, args.columns, args.functions),
+                           lambda: synthetic.build_schemas(args.schemas, args.tables, args.columns, args.functions, args.drift))
+    else:
+        counter = QueryCounter()
+        counter.install()
+        measurements = run(lambda: xpgdiff.get_schema_objects(args.source, args.jobs, columnar=args.columnar),
+                           lambda: xpgdiff.get_schema_objects(args.target, args.jobs, columnar=args.columnar),
+                           lambda: counter.count)
+
+    if args.json:
+        print(json.dumps(measurements.phases, indent=2))
+    else:
+        measurements.print_table()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
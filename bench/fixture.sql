@@ -0,0 +1,71 @@
+-- Creates a synthetic database with the same shape as synthetic.py builds,
+-- for measuring introspection against a real server.  Run it in an empty
+-- database, e.g. one database without drift and one with:
+--
+--   createdb bench_source && createdb bench_target
+--   psql -v tables=2000 -d bench_source -f bench/fixture.sql
+--   psql -v tables=2000 -v drift=0.01 -d bench_target -f bench/fixture.sql
+--
+-- Variables (defaults): schemas (50), tables (20000), columns (200),
+-- functions (5000), drift (0).  Needs PostgreSQL 11 or later, as it
+-- commits every 100 tables to stay within max_locks_per_transaction.
+
+\set ON_ERROR_STOP on
+\if :{?schemas} \else \set schemas 50 \endif
+\if :{?tables} \else \set tables 20000 \endif
+\if :{?columns} \else \set columns 200 \endif
+\if :{?functions} \else \set functions 5000 \endif
+\if :{?drift} \else \set drift 0 \endif
+
+select set_config('xpgdiff_bench.schemas', :'schemas', false),
+       set_config('xpgdiff_bench.tables', :'tables', false),
+       set_config('xpgdiff_bench.columns', :'columns', false),
+       set_config('xpgdiff_bench.functions', :'functions', false),
+       set_config('xpgdiff_bench.drift', :'drift', false);
+
+do $$
+declare
+    nschemas int := current_setting('xpgdiff_bench.schemas')::int;
+    ntables int := current_setting('xpgdiff_bench.tables')::int;
+    ncolumns int := current_setting('xpgdiff_bench.columns')::int;
+    nfunctions int := current_setting('xpgdiff_bench.functions')::int;
+    drift float8 := current_setting('xpgdiff_bench.drift')::float8;
+    -- Must match COLUMN_TYPES in synthetic.py
+    column_types text[] := array['int4', 'varchar(64)', 'text', 'numeric(12, 2)', 'timestamptz', 'bool'];
+    drifted boolean;
+    schema_name text;
+    columns text;
+begin
+    for i in 0 .. nschemas - 1 loop
+        execute format('create schema s%s', i);
+    end loop;
+
+    for j in 0 .. ntables - 1 loop
+        schema_name := 's' || (j % nschemas);
+        drifted := (j::bigint * 7919) % 1000 < drift * 1000;
+        columns := 'c0 int8 not null primary key';
+        for k in 1 .. ncolumns - 1 loop
+            columns := columns || format(', c%s %s', k,
+                case when k = 1 and drifted then 'int8'
+                     else column_types[(k - 1) % array_length(column_types, 1) + 1] end);
+        end loop;
+        if drifted then
+            columns := columns || ', extra text';
+        end if;
+        execute format('create table %s.t%s (%s)', schema_name, j, columns);
+        execute format('create index t%s_c1_idx on %s.t%s (c1)', j, schema_name, j);
+        if j % 100 = 99 then
+            commit;
+        end if;
+    end loop;
+
+    for j in 0 .. nfunctions - 1 loop
+        schema_name := 's' || (j % nschemas);
+        drifted := (j::bigint * 7919) % 1000 < drift * 1000;
+        execute format('create function %s.f%s(integer) returns integer language sql as $function$ select $1 + %s%s $function$',
+                       schema_name, j, j, case when drifted then ' + 1' else '' end);
+    end loop;
+end
+$$;
+
+analyze;
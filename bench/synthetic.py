@@ -0,0 +1,112 @@
+"""
+Builds synthetic xpgdiff object graphs of configurable size, with the
+same shape as the database created by fixture.sql, so that diffing and
+rendering can be measured without a database and introspection can be
+measured against one.
+
+The shape, for table and function numbers j starting at 0:
+
+- schemas s0 .. s{schemas - 1}
+- table t{j} in schema s{j % schemas}, with column c0 int8 NOT NULL as
+  its primary key, columns c1 .. c{columns - 1} cycling through the types
+  in COLUMN_TYPES, and index t{j}_c1_idx on c1
+- function f{j}(int4) in schema s{j % schemas}, a SQL function returning
+  $1 + j
+
+In the drifted variant, every table and function that is_drifted picks
+differs: c1 of a table is int8 and the table has an extra text column,
+and a function returns $1 + j + 1.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import xpgdiff
+
+# (SQL type, pg_type.typname, atttypmod) for columns c1 onwards
+COLUMN_TYPES = [
+    ('int4', 'int4', -1),
+    ('varchar(64)', 'varchar', 64 + 4),
+    ('text', 'text', -1),
+    ('numeric(12, 2)', 'numeric', ((12 << 16) | 2) + 4),
+    ('timestamptz', 'timestamptz', -1),
+    ('bool', 'bool', -1),
+]
+
+def is_drifted(number, drift):
+    """
+    Tells whether a table or function differs in the drifted variant.
+    Drifted objects are spread evenly over schemas and numbers.
+
+    :param number: The table or function number.
+    :param drift: The fraction of tables and functions that differ.
+    :returns: True if the object differs.
+    """
+    return (number * 7919) % 1000 < drift * 1000
+
+def column_type(colnum, drifted):
+    """
+    Gets the type of a column of a synthetic table.
+
+    :param colnum: The column number, c0 being 0.
+    :param drifted: Whether the table is drifted.
+    :returns: A (SQL type, typname, typmod) tuple.
+    """
+    if colnum == 0:
+        return ('int8', 'int8', -1)
+    if colnum == 1 and drifted:
+        return ('int8', 'int8', -1)
+    return COLUMN_TYPES[(colnum - 1) % len(COLUMN_TYPES)]
+
+def function_definition(schema_name, number, drifted):
+    """
+    Gets the definition of a synthetic function as pg_get_functiondef
+    prints it.
+
+    :param schema_name: The name of the function's schema.
+    :param number: The function number.
+    :param drifted: Whether the function is drifted.
+    :returns: The definition.
+    """
+    body = f'select $1 + {number}{" + 1" if drifted else ""}'
+    return f'CREATE OR REPLACE FUNCTION {schema_name}.f{number}(integer)\n RETURNS integer\n LANGUAGE sql\nAS $function$ {body} $function$\n'
+
+def build_schemas(schemas=50, tables=20000, columns=200, functions=5000, drift=0.0, owner='postgres', first_oid=16384):
+    """
+    Builds the xpgdiff objects of a synthetic database.
+
+    :param schemas: The number of schemas.
+    :param tables: The total number of tables.
+    :param columns: The number of columns per table, at least 2.
+    :param functions: The total number of functions.
+    :param drift: The fraction of tables and functions that differ from the undrifted variant.
+    :param owner: The owner of every table and function.
+    :param first_oid: The first oid to assign.
+    :returns: A list of Schema instances.
+    """
+    oids = iter(range(first_oid, first_oid + 1 + schemas + tables * 4 + functions))
+    schema_list = [xpgdiff.Schema(next(oids), f's{i}') for i in range(schemas)]
+
+    for j in range(tables):
+        schema = schema_list[j % schemas]
+        drifted = is_drifted(j, drift)
+        table = xpgdiff.Table(next(oids), schema, owner, f't{j}', None)
+        for colnum in range(columns):
+            sqltype, typname, typmod = column_type(colnum, drifted)
+            table.add_column(xpgdiff.Column(table, colnum + 1, f'c{colnum}', typname, colnum == 0, None, None, 0, typmod))
+        if drifted:
+            table.add_column(xpgdiff.Column(table, columns + 1, 'extra', 'text', False, None, None, 0, -1))
+        pkey_columns = [table.get_column(1)]
+        table.set_primary_key(xpgdiff.PrimaryKey(next(oids), table, f't{j}_pkey', pkey_columns, 'PRIMARY KEY (c0)'))
+        table.add_index(xpgdiff.Index(next(oids), table, f't{j}_pkey', pkey_columns, True, True, 'btree', f'CREATE UNIQUE INDEX t{j}_pkey ON {schema.name}.t{j} USING btree (c0)'))
+        table.add_index(xpgdiff.Index(next(oids), table, f't{j}_c1_idx', [table.get_column(2)], False, False, 'btree', f'CREATE INDEX t{j}_c1_idx ON {schema.name}.t{j} USING btree (c1)'))
+        schema.add_table(table)
+
+    for j in range(functions):
+        schema = schema_list[j % schemas]
+        definition = function_definition(schema.name, j, is_drifted(j, drift))
+        schema.add_function(xpgdiff.Function(next(oids), schema, owner, f'f{j}', ['int4'], 23, 14, False, False, None, definition))
+
+    return schema_list
@@ -0,0 +1,84 @@
+import unittest
+
+import xpgdiff
+
+
+def make_column(_type, notnull=False, default=None, typmod=-1, ndims=0):
+    schema = xpgdiff.Schema(1, 's0')
+    table = xpgdiff.Table(100, schema, 'owner', 't0', [])
+    return xpgdiff.Column(table, 1, 'c1', _type, notnull, default, None, ndims, typmod)
+
+
+def numeric_typmod(precision, scale):
+    return (precision << 16 | scale) + 4
+
+
+class AlterStrsTest(unittest.TestCase):
+    prefix = 'ALTER TABLE s0.t0 ALTER COLUMN c1'
+
+    def test_only_the_attributes_that_differ_are_altered(self):
+        self.assertEqual([f'{self.prefix} TYPE int8;'], make_column('int8').alterstrs(make_column('int4')))
+        self.assertEqual([f'{self.prefix} SET DEFAULT 0;'], make_column('int4', default='0').alterstrs(make_column('int4')))
+        self.assertEqual([f'{self.prefix} DROP DEFAULT;'], make_column('int4').alterstrs(make_column('int4', default='0')))
+        self.assertEqual([f'{self.prefix} SET NOT NULL;'], make_column('int4', notnull=True).alterstrs(make_column('int4')))
+        self.assertEqual([f'{self.prefix} DROP NOT NULL;'], make_column('int4').alterstrs(make_column('int4', notnull=True)))
+
+    def test_changed_default_is_set_without_being_dropped(self):
+        self.assertEqual([f'{self.prefix} SET DEFAULT 1;'], make_column('int4', default='1').alterstrs(make_column('int4', default='0')))
+
+    def test_default_is_dropped_before_a_type_change(self):
+        source = make_column('int4', default='0')
+        target = make_column('text', default="'0'::text")
+        self.assertEqual([f'{self.prefix} DROP DEFAULT;',
+                          f'{self.prefix} TYPE text;',
+                          f"{self.prefix} SET DEFAULT '0'::text;"], target.alterstrs(source))
+
+    def test_not_null_is_dropped_first_and_set_last(self):
+        source = make_column('int4', notnull=True)
+        self.assertEqual([f'{self.prefix} DROP NOT NULL;', f'{self.prefix} TYPE int8;'], make_column('int8').alterstrs(source))
+        source = make_column('int4')
+        self.assertEqual([f'{self.prefix} TYPE int8;', f'{self.prefix} SET NOT NULL;'], make_column('int8', notnull=True).alterstrs(source))
+
+    def test_typmod_and_dimensions_are_type_changes(self):
+        self.assertEqual([f'{self.prefix} TYPE varchar(20);'], make_column('varchar', typmod=24).alterstrs(make_column('varchar', typmod=14)))
+        self.assertEqual([f'{self.prefix} TYPE numeric(12, 2);'],
+                         make_column('numeric', typmod=numeric_typmod(12, 2)).alterstrs(make_column('numeric', typmod=numeric_typmod(10, 2))))
+        self.assertEqual([f'{self.prefix} TYPE int4[];'], make_column('int4', ndims=1).alterstrs(make_column('int4')))
+
+
+class TypeChangeRewritesTest(unittest.TestCase):
+    def assertRewrites(self, source, target):
+        self.assertTrue(xpgdiff.type_change_rewrites(source, target))
+
+    def assertDoesNotRewrite(self, source, target):
+        self.assertFalse(xpgdiff.type_change_rewrites(source, target))
+
+    def test_binary_coercible_types(self):
+        for source_type, target_type in xpgdiff._BINARY_COERCIBLE_TYPES:
+            self.assertDoesNotRewrite(make_column(source_type), make_column(target_type))
+        self.assertRewrites(make_column('text'), make_column('varchar', typmod=14))
+        self.assertRewrites(make_column('inet'), make_column('cidr'))
+        self.assertRewrites(make_column('int4'), make_column('int8'))
+
+    def test_widening_the_typmod(self):
+        for _type in xpgdiff._WIDENABLE_TYPES:
+            self.assertDoesNotRewrite(make_column(_type, typmod=6), make_column(_type, typmod=8))
+            self.assertDoesNotRewrite(make_column(_type, typmod=6), make_column(_type))
+            self.assertRewrites(make_column(_type, typmod=8), make_column(_type, typmod=6))
+            self.assertRewrites(make_column(_type), make_column(_type, typmod=8))
+        self.assertRewrites(make_column('bpchar', typmod=6), make_column('bpchar', typmod=8))
+        self.assertRewrites(make_column('varchar', typmod=6, ndims=1), make_column('varchar', typmod=8, ndims=1))
+
+    def test_numeric_precision_and_scale(self):
+        self.assertDoesNotRewrite(make_column('numeric', typmod=numeric_typmod(10, 2)), make_column('numeric', typmod=numeric_typmod(12, 2)))
+        self.assertDoesNotRewrite(make_column('numeric', typmod=numeric_typmod(10, 2)), make_column('numeric'))
+        self.assertRewrites(make_column('numeric', typmod=numeric_typmod(12, 2)), make_column('numeric', typmod=numeric_typmod(10, 2)))
+        self.assertRewrites(make_column('numeric', typmod=numeric_typmod(10, 2)), make_column('numeric', typmod=numeric_typmod(12, 3)))
+
+    def test_dimensions(self):
+        self.assertRewrites(make_column('varchar'), make_column('varchar', ndims=1))
+        self.assertDoesNotRewrite(make_column('int4', ndims=1), make_column('int4', ndims=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
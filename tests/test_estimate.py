@@ -0,0 +1,25 @@
+import unittest
+
+import xpgdiff
+
+
+class StatementCostTest(unittest.TestCase):
+    def test_views_and_functions_lock_no_table(self):
+        for statement in ['DROP VIEW s0.v0;', 'CREATE VIEW s0.v0 AS\n SELECT 1;', 'ALTER VIEW s0.v0 OWNER TO owner;',
+                          'DROP FUNCTION s0.f0(int4);', 'CREATE OR REPLACE FUNCTION s0.f0(i integer)\n RETURNS integer',
+                          'ALTER FUNCTION s0.f0(int4) OWNER TO owner;', 'GRANT SELECT ON s0.t0 TO owner;']:
+            cost = xpgdiff.statement_cost(statement, {})
+            self.assertIsNone(cost.lock, statement)
+            self.assertEqual('metadata', cost.impact, statement)
+
+    def test_table_statements_lock_the_table(self):
+        for statement in ['DROP TABLE s0.t0;', 'ALTER TABLE s0.t0 OWNER TO owner;', 'DROP SCHEMA s0 CASCADE;']:
+            self.assertEqual('ACCESS EXCLUSIVE', xpgdiff.statement_cost(statement, {}).lock, statement)
+
+    def test_strongest_clause_wins(self):
+        cost = xpgdiff.statement_cost('ALTER TABLE s0.t0\n  ALTER COLUMN c1 DROP NOT NULL,\n  ALTER COLUMN c2 SET NOT NULL;', {})
+        self.assertEqual(('ACCESS EXCLUSIVE', 'scan'), (cost.lock, cost.impact))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+import xpgdiff
+
+
+def make_schemas():
+    schema = xpgdiff.Schema(1, 'app')
+    for oid, name in enumerate(['orders', 'orders_archive', 'users'], 100):
+        schema.add_table(xpgdiff.Table(oid, schema, 'owner', name, []))
+    schema.add_view(xpgdiff.View(200, schema, 'owner', 'orders_v', [], 'SELECT 1'))
+    schema.add_function(xpgdiff.Function(300, schema, 'owner', 'f0', [], 23, 14, False, False, [], 'body'))
+    return [schema, xpgdiff.Schema(2, 'audit')]
+
+
+class NamePatternTest(unittest.TestCase):
+    def test_glob_matches_the_whole_name(self):
+        regex = xpgdiff.name_pattern_regex('order?_*')
+        self.assertTrue(xpgdiff.name_matches('orders_2024', [regex], []))
+        self.assertFalse(xpgdiff.name_matches('orders', [regex], []))
+        self.assertFalse(xpgdiff.name_matches('old_orders_2024', [regex], []))
+
+    def test_glob_escapes_regex_characters(self):
+        regex = xpgdiff.name_pattern_regex('a.b')
+        self.assertTrue(xpgdiff.name_matches('a.b', [regex], []))
+        self.assertFalse(xpgdiff.name_matches('axb', [regex], []))
+
+    def test_tilde_pattern_is_a_regex(self):
+        self.assertEqual('_archive$', xpgdiff.name_pattern_regex('~_archive$'))
+
+    def test_exclude_wins_over_include(self):
+        include = [xpgdiff.name_pattern_regex('orders*')]
+        exclude = [xpgdiff.name_pattern_regex('~_archive$')]
+        self.assertTrue(xpgdiff.name_matches('orders', include, exclude))
+        self.assertFalse(xpgdiff.name_matches('orders_archive', include, exclude))
+        self.assertFalse(xpgdiff.name_matches('users', include, exclude))
+
+
+class ObjectFilterTest(unittest.TestCase):
+    def test_conditions_pass_patterns_as_parameters(self):
+        filters = xpgdiff.ObjectFilter(include_tables=['orders*'], exclude_tables=['~_archive$'])
+        self.assertEqual(('c.relname ~ any(%s::text[]) and not c.relname ~ any(%s::text[])', (['^orders.*$'], ['_archive$'])),
+                         filters.table_condition('c.relname'))
+        self.assertEqual(('TRUE', ()), filters.schema_condition('nspname'))
+
+    def test_filter_schemas(self):
+        filters = xpgdiff.ObjectFilter(include_schemas=['app'], exclude_tables=['~_archive$'])
+        kept = filters.filter_schemas(make_schemas())
+        self.assertEqual(['app'], [schema.name for schema in kept])
+        self.assertEqual(['orders', 'users'], [table.name for table in kept[0].tables])
+        self.assertEqual(['orders_v'], [view.name for view in kept[0].views])
+        self.assertEqual(['f0'], [function.name for function in kept[0].functions])
+
+    def test_filter_schemas_by_kind(self):
+        kept = xpgdiff.ObjectFilter(kinds=['functions']).filter_schemas(make_schemas())
+        self.assertEqual([[], [], ['f0']], [[obj.name for obj in objs] for objs in (kept[0].tables, kept[0].views, kept[0].functions)])
+
+    def test_no_filter_keeps_the_schemas(self):
+        schemas = make_schemas()
+        self.assertIs(schemas, xpgdiff.ObjectFilter().filter_schemas(schemas))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+
+import xpgdiff
+
+INSERT, SELECT, UPDATE, DELETE = (1 << xpgdiff.ACL_PRIVILEGES.index(name) for name in ('INSERT', 'SELECT', 'UPDATE', 'DELETE'))
+EXECUTE = 1 << xpgdiff.ACL_PRIVILEGES.index('EXECUTE')
+
+
+def make_table(acl):
+    return xpgdiff.Table(100, xpgdiff.Schema(1, 's0'), 'owner', 't0', acl)
+
+
+def migrate(source_grant, target_grant):
+    table = make_table([])
+    return list(xpgdiff.grant_migration_ddl(table, xpgdiff.Grant(table, 'r', *source_grant), xpgdiff.Grant(table, 'r', *target_grant)))
+
+
+class GrantsForAclTest(unittest.TestCase):
+    def test_roles_without_known_privileges_are_left_out(self):
+        table = make_table([['r', SELECT | UPDATE, SELECT], ['w', INSERT, None], ['x', 0, 0]])
+        self.assertEqual([('r', SELECT | UPDATE, SELECT), ('w', INSERT, 0)],
+                         [(grant.role, grant.privileges, grant.grantable) for grant in table.grants])
+
+    def test_privileges_are_listed_in_acl_order(self):
+        self.assertEqual('INSERT, SELECT, DELETE', xpgdiff.grant_privileges(DELETE | SELECT | INSERT))
+
+
+class GrantMigrationTest(unittest.TestCase):
+    def test_only_the_privileges_that_differ_are_granted_or_revoked(self):
+        self.assertEqual(['REVOKE INSERT, DELETE ON s0.t0 FROM r;', 'GRANT UPDATE ON s0.t0 TO r;'],
+                         migrate((SELECT | INSERT | DELETE,), (SELECT | UPDATE,)))
+
+    def test_unchanged_grant_needs_nothing(self):
+        self.assertEqual([], migrate((SELECT | UPDATE, SELECT), (SELECT | UPDATE, SELECT)))
+
+    def test_grant_option_is_revoked_from_a_kept_privilege(self):
+        self.assertEqual(['REVOKE GRANT OPTION FOR SELECT ON s0.t0 FROM r;'], migrate((SELECT | UPDATE, SELECT), (SELECT | UPDATE,)))
+
+    def test_revoked_privilege_takes_its_grant_option_with_it(self):
+        self.assertEqual(['REVOKE SELECT ON s0.t0 FROM r;'], migrate((SELECT | UPDATE, SELECT), (UPDATE,)))
+
+    def test_grant_option_is_granted_for_kept_and_new_privileges(self):
+        self.assertEqual(['GRANT SELECT, UPDATE ON s0.t0 TO r WITH GRANT OPTION;'], migrate((SELECT,), (SELECT | UPDATE, SELECT | UPDATE)))
+        self.assertEqual(['GRANT INSERT ON s0.t0 TO r;', 'GRANT UPDATE ON s0.t0 TO r WITH GRANT OPTION;'],
+                         migrate((SELECT,), (SELECT | INSERT | UPDATE, UPDATE)))
+
+    def test_function_grants(self):
+        schema = xpgdiff.Schema(1, 's0')
+        source = xpgdiff.Function(200, schema, 'owner', 'f0', ['int4'], 23, 14, False, False, [['r', EXECUTE, 0], ['w', EXECUTE, 0]], 'body')
+        target = xpgdiff.Function(300, schema, 'owner', 'f0', ['int4'], 23, 14, False, False, [['r', EXECUTE, EXECUTE], ['x', EXECUTE, 0]], 'body')
+        self.assertEqual(['REVOKE EXECUTE ON FUNCTION s0.f0(int4) FROM w;',
+                          'GRANT EXECUTE ON FUNCTION s0.f0(int4) TO r WITH GRANT OPTION;',
+                          'GRANT EXECUTE ON FUNCTION s0.f0(int4) TO x;'], list(xpgdiff.grants_migration_ddl(source, target)))
+
+
+if __name__ == '__main__':
+    unittest.main()
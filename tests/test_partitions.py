@@ -0,0 +1,153 @@
+import unittest
+
+import xpgdiff
+
+
+def make_table(schema, oid, name, shape, partition_key=None, parent=None, partition_bound=None):
+    table = xpgdiff.Table(oid, schema, 'owner', name, [], partitioned=partition_key is not None)
+    table.partition_key = partition_key
+    table.partition_bound = partition_bound
+    table.shape = shape
+    if parent is not None:
+        parent.add_partition(table)
+    return table
+
+
+def add_details(table, indexes):
+    for colnum, column in enumerate(['id', 'ts'], 1):
+        table.add_column(xpgdiff.Column(table, colnum, column, 'int8', True, None, None, 0, -1))
+    table.add_check(xpgdiff.Check(table.oid + 1, table, 'id_check', '(id > 0)', 'CHECK ((id > 0))'))
+    only = 'ONLY ' if table.partitioned else ''
+    for offset, column in enumerate(indexes, 2):
+        definition = f'CREATE INDEX {table.name}_{column}_idx ON {only}{table.fullname} USING btree ({column})'
+        table.add_index(xpgdiff.Index(table.oid + offset, table, f'{table.name}_{column}_idx', [], False, False, 'btree', definition))
+
+
+def make_events(child_indexes):
+    """
+    Builds events, partitioned by year into events_2024, which has the
+    same shape as events and so no details, partitioned by month into
+    events_2024_01, which has an index of its own.
+    """
+    schema = xpgdiff.Schema(1, 's')
+    events = make_table(schema, 100, 'events', 'parent', 'RANGE (ts)')
+    add_details(events, ['ts'])
+    schema.add_table(events)
+    year = make_table(schema, 200, 'events_2024', 'parent', 'RANGE (ts)', events, "FOR VALUES FROM (2024) TO (2025)")
+    month = make_table(schema, 300, 'events_2024_01', 'child ' + ' '.join(child_indexes), None, year, "FOR VALUES FROM (202401) TO (202402)")
+    add_details(month, ['ts'] + child_indexes)
+    return schema, events, year, month
+
+
+class TwoLevelPartitionTest(unittest.TestCase):
+    def test_local_objects_leave_out_what_the_grandparent_has(self):
+        schema, events, year, month = make_events(['id'])
+        self.assertTrue(year.matches_parent())
+        checks, indexes, triggers = month.get_local_objects()
+        self.assertEqual([], checks)
+        self.assertEqual(['events_2024_01_id_idx'], [index.name for index in indexes])
+        self.assertEqual([], triggers)
+
+    def test_partition_ddl_creates_only_local_objects(self):
+        schema, events, year, month = make_events(['id'])
+        ddl = str(events)
+        self.assertIn('CREATE TABLE s.events_2024 PARTITION OF s.events FOR VALUES FROM (2024) TO (2025) PARTITION BY RANGE (ts);', ddl)
+        self.assertIn('CREATE TABLE s.events_2024_01 PARTITION OF s.events_2024 FOR VALUES FROM (202401) TO (202402);', ddl)
+        self.assertIn('CREATE INDEX events_2024_01_id_idx ON s.events_2024_01 USING btree (id);', ddl)
+        self.assertNotIn('events_2024_01_ts_idx', ddl)
+        self.assertNotIn('ALTER TABLE s.events_2024_01 ADD CONSTRAINT', ddl)
+
+    def test_migration_adds_only_the_local_index(self):
+        source_schema, source_events, _, _ = make_events([])
+        target_schema, target_events, _, _ = make_events(['id'])
+        statements = list(xpgdiff.table_migration_ddl(source_events, target_events))
+        self.assertEqual(['CREATE INDEX events_2024_01_id_idx ON s.events_2024_01 USING btree (id);'], statements)
+
+    def test_migration_adds_a_local_unique_key(self):
+        source_schema, source_events, _, _ = make_events([])
+        target_schema, target_events, _, target_month = make_events([])
+        target_month.shape = 'child unique'
+        target_month.add_unique_key(xpgdiff.UniqueKey(310, target_month, 'events_2024_01_id_key', [], 'UNIQUE (id, ts)'))
+        target_month.add_index(xpgdiff.Index(311, target_month, 'events_2024_01_id_key', [], True, False, 'btree', 'CREATE UNIQUE INDEX events_2024_01_id_key ON s.events_2024_01 USING btree (id, ts)'))
+        statements = list(xpgdiff.table_migration_ddl(source_events, target_events))
+        self.assertEqual(['ALTER TABLE s.events_2024_01 ADD CONSTRAINT events_2024_01_id_key UNIQUE (id, ts);'], statements)
+        statements = list(xpgdiff.table_migration_ddl(target_events, source_events))
+        self.assertEqual(['ALTER TABLE s.events_2024_01 DROP CONSTRAINT events_2024_01_id_key;'], statements)
+
+    def test_migration_alters_local_column_attributes(self):
+        source_schema, source_events, _, source_month = make_events([])
+        target_schema, target_events, _, target_month = make_events([])
+        for table in (source_events, target_events, source_month, target_month):
+            table.get_column(2).notnull = False
+        target_month.shape = 'child not null'
+        target_month.get_column(2).notnull = True
+        target_month.get_column(2).default = '0'
+        statements = list(xpgdiff.table_migration_ddl(source_events, target_events))
+        self.assertEqual(['ALTER TABLE s.events_2024_01\n  ALTER COLUMN ts SET DEFAULT 0,\n  ALTER COLUMN ts SET NOT NULL;'], statements)
+        statements = list(xpgdiff.table_migration_ddl(target_events, source_events))
+        self.assertEqual(['ALTER TABLE s.events_2024_01\n  ALTER COLUMN ts DROP DEFAULT,\n  ALTER COLUMN ts DROP NOT NULL;'], statements)
+
+    def test_migration_keeps_a_local_default_the_parent_changes(self):
+        source_schema, source_events, _, source_month = make_events([])
+        target_schema, target_events, _, target_month = make_events([])
+        for month in (source_month, target_month):
+            month.shape = 'child default'
+            month.get_column(1).default = '0'
+        target_events.get_column(1).default = '1'
+        statements = list(xpgdiff.table_migration_ddl(source_events, target_events))
+        self.assertEqual(['ALTER TABLE s.events ALTER COLUMN id SET DEFAULT 1;', 'ALTER TABLE s.events_2024_01 ALTER COLUMN id SET DEFAULT 0;'], statements)
+
+    def test_partition_ddl_creates_local_keys_and_defaults(self):
+        schema, events, year, month = make_events([])
+        month.shape = 'child unique default'
+        month.get_column(1).default = '0'
+        month.add_unique_key(xpgdiff.UniqueKey(310, month, 'events_2024_01_id_key', [], 'UNIQUE (id, ts)'))
+        ddl = str(events)
+        self.assertIn('ALTER TABLE s.events_2024_01 ALTER COLUMN id SET DEFAULT 0;', ddl)
+        self.assertIn('ALTER TABLE s.events_2024_01 ADD CONSTRAINT events_2024_01_id_key UNIQUE (id, ts);', ddl)
+
+    def test_migration_adds_a_local_foreign_key_after_the_tables(self):
+        source_schema, source_events, _, _ = make_events([])
+        target_schema, target_events, _, target_month = make_events([])
+        target_month.shape = 'child foreign key'
+        target_month.add_foreign_key(xpgdiff.ForeignKey(320, target_month, 'events_2024_01_id_fkey', [], None, [], 's', 'a', 'a', 'FOREIGN KEY (id) REFERENCES s.other(id)'))
+        statements = [str(statement) for statement in xpgdiff.tables_migration_ddl(source_schema, target_schema) if not statement.startswith('--')]
+        self.assertEqual(['ALTER TABLE s.events_2024_01 ADD CONSTRAINT events_2024_01_id_fkey FOREIGN KEY (id) REFERENCES s.other(id);'], statements)
+        statements = [str(statement) for statement in xpgdiff.tables_migration_ddl(target_schema, source_schema) if not statement.startswith('--')]
+        self.assertEqual(['ALTER TABLE s.events_2024_01 DROP CONSTRAINT events_2024_01_id_fkey;'], statements)
+
+
+class PartitionedIndexTest(unittest.TestCase):
+    def test_index_is_created_on_the_table_and_its_partitions(self):
+        source_schema, source_events, _, _ = make_events([])
+        target_schema, target_events, _, _ = make_events([])
+        target_events.add_index(xpgdiff.Index(110, target_events, 'events_id_idx', [], False, False, 'btree', 'CREATE INDEX events_id_idx ON ONLY s.events USING btree (id)'))
+        statements = list(xpgdiff.table_migration_ddl(source_events, target_events))
+        self.assertEqual(['CREATE INDEX events_id_idx ON s.events USING btree (id);'], statements)
+
+    def test_online_index_is_not_built_concurrently(self):
+        source_schema, source_events, _, _ = make_events([])
+        target_schema, target_events, _, _ = make_events([])
+        target_events.add_index(xpgdiff.Index(110, target_events, 'events_id_idx', [], False, False, 'btree', 'CREATE INDEX events_id_idx ON ONLY s.events USING btree (id)'))
+        statements = list(xpgdiff.table_migration_ddl(source_events, target_events, online=True))
+        self.assertEqual(['CREATE INDEX events_id_idx ON s.events USING btree (id);'], statements)
+        statements = list(xpgdiff.table_migration_ddl(target_events, source_events, online=True))
+        self.assertEqual(['DROP INDEX s.events_id_idx;'], statements)
+
+    def test_online_unique_key_is_not_added_using_an_index(self):
+        source_schema, source_events, _, _ = make_events([])
+        target_schema, target_events, _, _ = make_events([])
+        target_events.add_unique_key(xpgdiff.UniqueKey(120, target_events, 'events_id_ts_key', [], 'UNIQUE (id, ts)'))
+        target_events.add_index(xpgdiff.Index(121, target_events, 'events_id_ts_key', [], True, False, 'btree', 'CREATE UNIQUE INDEX events_id_ts_key ON ONLY s.events USING btree (id, ts)'))
+        statements = list(xpgdiff.table_migration_ddl(source_events, target_events, online=True))
+        self.assertEqual(['ALTER TABLE s.events ADD CONSTRAINT events_id_ts_key UNIQUE (id, ts);'], statements)
+
+    def test_index_on_a_partition_is_built_concurrently(self):
+        source_schema, source_events, _, _ = make_events([])
+        target_schema, target_events, _, _ = make_events(['id'])
+        statements = list(xpgdiff.table_migration_ddl(source_events, target_events, online=True))
+        self.assertEqual(['CREATE INDEX CONCURRENTLY events_2024_01_id_idx ON s.events_2024_01 USING btree (id);'], statements)
+
+
+if __name__ == '__main__':
+    unittest.main()
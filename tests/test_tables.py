@@ -0,0 +1,43 @@
+import unittest
+
+import xpgdiff
+
+
+def make_table(columns):
+    schema = xpgdiff.Schema(1, 's0')
+    table = xpgdiff.Table(100, schema, 'owner', 't0', [])
+    for colnum, (name, _type, notnull, default, sequence_name) in enumerate(columns, 1):
+        table.add_column(xpgdiff.Column(table, colnum, name, _type, notnull, default, sequence_name, 0, -1))
+    schema.add_table(table)
+    return table
+
+
+class CoalescedAlterTableTest(unittest.TestCase):
+    def test_changes_are_made_in_one_statement(self):
+        source = make_table([('c1', 'int4', False, None, None)])
+        target = make_table([('c1', 'int8', False, None, None), ('extra', 'text', False, None, None)])
+        statements = list(xpgdiff.table_migration_ddl(source, target))
+        self.assertEqual(['ALTER TABLE s0.t0\n  ALTER COLUMN c1 TYPE int8,\n  ADD extra text NULL;'], statements)
+
+    def test_serial_default_does_not_end_the_statement(self):
+        source = make_table([('c1', 'int4', False, None, None)])
+        target = make_table([('c1', 'int8', False, None, None), ('extra', 'text', False, None, None),
+                             ('sid', 'int4', True, "nextval('s0.t0_sid_seq'::regclass)", 's0.t0_sid_seq')])
+        statements = list(xpgdiff.table_migration_ddl(source, target))
+        self.assertEqual(["ALTER TABLE s0.t0\n"
+                          "  ALTER COLUMN c1 TYPE int8,\n"
+                          "  ADD extra text NULL,\n"
+                          "  ADD sid serial NOT NULL /* DEFAULT nextval('s0.t0_sid_seq'::regclass) */;"], statements)
+        self.assertNotIn('--', statements[0])
+
+    def test_validate_constraint_runs_on_its_own(self):
+        source = make_table([('c1', 'int4', False, None, None)])
+        target = make_table([('c1', 'int4', False, None, None), ('extra', 'text', False, None, None)])
+        target.add_check(xpgdiff.Check(200, target, 'c1_check', '(c1 > 0)', 'CHECK ((c1 > 0))'))
+        statements = list(xpgdiff.table_migration_ddl(source, target, online=True))
+        self.assertEqual(['ALTER TABLE s0.t0\n  ADD extra text NULL,\n  ADD CONSTRAINT c1_check CHECK ((c1 > 0)) NOT VALID;',
+                          'ALTER TABLE s0.t0 VALIDATE CONSTRAINT c1_check;'], statements)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,7 +5,17 @@ migration script.  Alternatively prints DDL for a single PostgreSQL
 database schema, but that is mainly for troubleshooting as
 `pg_dump --schema-only` is the definitive way to generate DDL.
 
-Usage: xpgdiff.py source-libpq-connstr [target_libpq-connstr]
+Usage: xpgdiff.py [--include-schema PATTERN] [--exclude-schema PATTERN] [--include-table PATTERN] [--exclude-table PATTERN] [--only KINDS | --skip KINDS] [--online] [--stats[=FORMAT]] [--profile FILE] [--jobs N] [--fetch-size N] [--lazy-definitions] [--columnar] [--two-phase] [--save-snapshot FILE] [-o FILE] source-libpq-connstr [target_libpq-connstr]
+
+Either connection string may be replaced by --from-snapshot FILE.
+
+Fleet usage: xpgdiff.py --fleet FILE [--fleet-output DIR] [--concurrency N] baseline-libpq-connstr
+
+Apply usage: xpgdiff.py --apply [--apply-jobs N] source-libpq-connstr target-libpq-connstr
+
+Estimate usage: xpgdiff.py --estimate [--top N] source-libpq-connstr target-libpq-connstr
+
+Service usage: xpgdiff.py --serve HOST:PORT|SOCKET-PATH [--jobs N] [--max-databases N] [libpq-connstr ...]
 
 TODOs:
 
@@ -20,16 +30,55 @@ TODOs:
 - Consider typing
 """
 
+import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import gc
+import gzip
+import hashlib
+import http.server
+import itertools
+import json
+import operator
+import os
+import pickle
+import queue
+import re
+import socket
+import socketserver
+import stat
 import sys
+import threading
+import time
+import zlib
 
 import psycopg2
+import psycopg2.extensions
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 ############################################################################
 # CLASSES
 ############################################################################
 
+class CatalogCache:
+    """ The objects read from a database, with the catalog version markers they were read at """
+    def __init__(self, identity=None, schemas=None, markers=None):
+        self.identity = identity
+        self.schemas = schemas if schemas is not None else []
+        self.markers = markers if markers is not None else {}
+
 class Check:
     """ A check constraint on a table """
+    __slots__ = ('oid', 'table', 'name', 'expression', 'definition')
+
     def __init__(self, oid, table, name, expression, definition):
         self.oid = oid
         self.table = table
@@ -43,6 +92,9 @@ class Check:
     def dropstr(self):
         return f'ALTER TABLE {self.table.fullname} DROP CONSTRAINT {self.name};'
 
+    def online_addstrs(self):
+        return not_valid_addstrs(self)
+
     def __eq__(self, other):
         if not isinstance(other, Check):
             raise TypeError('other')
@@ -54,11 +106,13 @@ class Check:
 
 class Column:
     """ A column in a table """
+    __slots__ = ('table', 'colnum', 'name', 'type', 'notnull', 'default', 'sequence_name', 'ndims', 'typmod')
+
     def __init__(self, table, colnum, name, _type, notnull, _default, sequence_name, ndims, typmod):
         self.table = table
         self.colnum = colnum
-        self.name = name
-        self.type = _type
+        self.name = sys.intern(name)
+        self.type = sys.intern(_type)
         self.notnull = notnull
         self.default = _default
         self.sequence_name = sequence_name
@@ -68,8 +122,31 @@ class Column:
     def addstr(self):
         return f'ALTER TABLE {self.table.fullname} ADD {str(self)};'
 
-    def alterstr(self):
-        return f'ALTER TABLE {self.table.fullname} ALTER COLUMN {str(self)};'
+    def alterstrs(self, source):
+        """
+        Gets the statements that alter a column to this definition, one
+        per attribute that differs.  A default that changes along with
+        the type is dropped first, in case it does not cast to the new
+        type.
+
+        :param source: The column as it is in the source schema.
+        :returns: A list of DDL statements.
+        """
+        prefix = f'ALTER TABLE {self.table.fullname} ALTER COLUMN {self.name}'
+        type_changed = self.type != source.type or self.typmod != source.typmod or self.ndims != source.ndims
+        default_changed = self.default != source.default
+        strs = []
+        if default_changed and source.default is not None and (self.default is None or type_changed):
+            strs.append(f'{prefix} DROP DEFAULT;')
+        if source.notnull and not self.notnull:
+            strs.append(f'{prefix} DROP NOT NULL;')
+        if type_changed:
+            strs.append(f'{prefix} TYPE {self._typestr()};')
+        if default_changed and self.default is not None:
+            strs.append(f'{prefix} SET DEFAULT {self.default};')
+        if self.notnull and not source.notnull:
+            strs.append(f'{prefix} SET NOT NULL;')
+        return strs
 
     def dropstr(self):
         return f'ALTER TABLE {self.table.fullname} DROP COLUMN {self.name};'
@@ -82,7 +159,7 @@ class Column:
             if self.type in ('bpchar', 'varchar'):
                 length = f'({self.typmod - 4})'
             elif self.type == 'numeric':
-                length = f'({self.typmod >> 16}, {(self.typmod & 0x0ffff) >> 1})'
+                length = '({}, {})'.format(*numeric_precision_scale(self.typmod))
             elif self.type == 'interval':
                 length = f'({self.typmod & 0x0ffff})'
             else:
@@ -92,7 +169,7 @@ class Column:
     def __eq__(self, other):
         if not isinstance(other, Column):
             raise TypeError('other')
-        return self.name == other.name and self.type == other.type and self.notnull == other.notnull and self.default == other.default and self.ndims == other.ndims
+        return self.name == other.name and self.type == other.type and self.notnull == other.notnull and self.default == other.default and self.ndims == other.ndims and self.typmod == other.typmod
 
     def __str__(self):
         if self.sequence_name and self.type in ('int4', 'int8', 'int2'):
@@ -102,12 +179,103 @@ class Column:
                 _type = 'bigserial'
             elif self.type == 'int2':
                 _type = 'smallserial'
-            return f'{self.name} {_type} {"NOT " if self.notnull else ""}NULL{" -- DEFAULT " + self.default if self.default else ""}'
+            # The default is left in a block comment, since the column may
+            # be one clause of several in an ALTER TABLE.
+            return f'{self.name} {_type} {"NOT " if self.notnull else ""}NULL{" /* DEFAULT " + self.default + " */" if self.default else ""}'
 
         return f'{self.name} {self._typestr()} {"NOT " if self.notnull else ""}NULL{" DEFAULT " + self.default if self.default else ""}'
 
+class ColumnStore:
+    """ The columns of many tables in parallel arrays, in (table oid, attnum) order """
+    def __init__(self):
+        self.colnums = array.array('i')
+        self.names = []
+        self.type_ids = array.array('i')
+        self.typmods = array.array('i')
+        self.notnulls = bytearray()
+        self.default_hashes = array.array('q')
+        self.ndims = array.array('i')
+        # Few columns have defaults or sequences, so their text is kept
+        # only for those, by row.
+        self.defaults = {}
+        self.sequence_names = {}
+        self.types = []
+        self._type_ids = {}
+        # The rows of each table's columns, by table oid
+        self.ranges = {}
+
+    def add(self, table, colnum, name, _type, notnull, _default, sequence_name, ndims, typmod):
+        """
+        Adds a column of a table, after any columns already added for it.
+        The table's columns are then read from the store.
+
+        :param table: The table.
+        The other parameters are those of Column.
+        """
+        row = len(self.names)
+        start, stop = self.ranges.get(table.oid, (row, row))
+        if stop != row:
+            raise ValueError(f'Columns of {table.fullname} must be added together')
+        self.ranges[table.oid] = (start, row + 1)
+        table.column_store = self
+        type_id = self._type_ids.get(_type)
+        if type_id is None:
+            type_id = self._type_ids[_type] = len(self.types)
+            self.types.append(sys.intern(_type))
+        self.colnums.append(colnum)
+        self.names.append(sys.intern(name))
+        self.type_ids.append(type_id)
+        self.typmods.append(typmod)
+        self.notnulls.append(1 if notnull else 0)
+        self.ndims.append(ndims)
+        if _default is None:
+            self.default_hashes.append(0)
+        else:
+            self.default_hashes.append(int.from_bytes(hashlib.blake2b(_default.encode('utf-8'), digest_size=8).digest(), 'little', signed=True) or 1)
+            self.defaults[row] = _default
+        if sequence_name is not None:
+            self.sequence_names[row] = sequence_name
+
+    def column(self, table, row):
+        """
+        Gets a column as a Column, made when asked for and not kept.
+
+        :param table: The table the column is in.
+        :param row: The row of the column in the store.
+        :returns: The Column.
+        """
+        return Column(table, self.colnums[row], self.names[row], self.types[self.type_ids[row]], bool(self.notnulls[row]),
+                      self.defaults.get(row), self.sequence_names.get(row), self.ndims[row], self.typmods[row])
+
+    def columns(self, table):
+        start, stop = self.ranges.get(table.oid, (0, 0))
+        return [self.column(table, row) for row in range(start, stop)]
+
+    def get_column(self, table, colnum):
+        start, stop = self.ranges.get(table.oid, (0, 0))
+        row = bisect.bisect_left(self.colnums, colnum, start, stop)
+        if row == stop or self.colnums[row] != colnum:
+            raise KeyError(colnum)
+        return self.column(table, row)
+
+    def signature(self, table):
+        """
+        Gets what Column.__eq__ compares for all the columns of a table at
+        once, so that two tables' columns are compared as a set, in C,
+        without making a Column for each.  Default text is compared by
+        hash.
+
+        :param table: The table.
+        :returns: A frozenset of a tuple per column.
+        """
+        start, stop = self.ranges.get(table.oid, (0, 0))
+        types = map(self.types.__getitem__, self.type_ids[start:stop])
+        return frozenset(zip(self.names[start:stop], types, self.notnulls[start:stop], self.default_hashes[start:stop], self.ndims[start:stop], self.typmods[start:stop]))
+
 class ForeignKey:
     """ A foreign key on a table """
+    __slots__ = ('oid', 'table', 'name', 'columns', 'reftable', 'refcolumns', 'matchtype', 'ondelete', 'onupdate', 'definition')
+
     def __init__(self, oid, table, name, columns, reftable, refcolumns, matchtype, ondelete, onupdate, definition):
         self.oid = oid
         self.table = table
@@ -126,18 +294,26 @@ class ForeignKey:
     def dropstr(self):
         return f'ALTER TABLE {self.table.fullname} DROP CONSTRAINT {str(self.name)};'
 
+    def online_addstrs(self):
+        return not_valid_addstrs(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, ForeignKey):
+            raise TypeError('other')
+        return self.name == other.name and self.definition == other.definition
+
     def __str__(self):
 #        return f'CONSTRAINT {self.name} FOREIGN KEY ({column_name_list(self.columns)}) REFERENCES {self.reftable.name} ({column_name_list(self.refcolumns)}) {self.matchtype} ON DELETE {self.ondelete} ON UPDATE {self.onupdate}'
         return f'CONSTRAINT {self.name} {self.definition}'
 
 class Function:
     """ A function/procedure in a schema """
-    def __init__(self, oid, schema, owner, name, argtypes, rettype, lang, isagg, iswindow, acl, definition):
+    def __init__(self, oid, schema, owner, name, argtypes, rettype, lang, isagg, iswindow, acl, definition, digest=None):
         self.oid = oid
         self.schema = schema
-        self.owner = owner
+        self.owner = sys.intern(owner)
         self.name = name
-        self.argtypes = argtypes if argtypes != [None] else []
+        self.argtypes = [sys.intern(argtype) for argtype in argtypes] if argtypes != [None] else []
         self.rettype = rettype
         self.lang = lang
         self.isagg = isagg
@@ -145,6 +321,7 @@ class Function:
         self.acl = acl
         self.grants = grants_for_acl(self, acl)
         self.definition = definition
+        self.digest = definition_digest(definition) if definition is not None else digest
         self.fullname = f'{schema.name}.{name}({", ".join(self.argtypes)})'
 
     def dropstr(self):
@@ -161,31 +338,50 @@ class Function:
         return s
 
 class Grant:
-    """ A grant on an object in a schema """
-    def __init__(self, obj, role, privilegestr):
-        self.obj = obj
-        self.role = role
-        self.privilegestr = privilegestr
-
-    def grantstr(self):
-        return self._grantrevokestr('GRANT')
+    """ The privileges granted to a role on an object in a schema, as bitmasks of ACL_PRIVILEGES """
+    __slots__ = ('obj', 'role', 'privileges', 'grantable')
 
-    def revokestr(self):
-        return self._grantrevokestr('REVOKE')
-
-    def _grantrevokestr(self, which):
-        return f'{which} {grant_privileges(self.privilegestr)} ON {"FUNCTION " if isinstance(self.obj, Function) else ""}{self.obj.fullname} {"TO" if which == "GRANT" else "FROM"} {self.role};'
+    def __init__(self, obj, role, privileges, grantable=0):
+        self.obj = obj
+        self.role = sys.intern(role)
+        self.privileges = privileges
+        self.grantable = grantable
+
+    def grantstrs(self):
+        """
+        Gets the statements that grant the privileges, with a separate
+        statement for those held WITH GRANT OPTION.
+
+        :returns: A list of DDL statements.
+        """
+        strs = []
+        if self.privileges & ~self.grantable:
+            strs.append(self._grantrevokestr('GRANT', self.privileges & ~self.grantable))
+        if self.grantable:
+            strs.append(self._grantrevokestr('GRANT', self.grantable, True))
+        return strs
+
+    def revokestr(self, grant_option=False):
+        return self._grantrevokestr('REVOKE', self.privileges, grant_option)
+
+    def _grantrevokestr(self, which, privileges, grant_option=False):
+        on = f'{"FUNCTION " if isinstance(self.obj, Function) else ""}{self.obj.fullname}'
+        if which == 'GRANT':
+            return f'GRANT {grant_privileges(privileges)} ON {on} TO {self.role}{" WITH GRANT OPTION" if grant_option else ""};'
+        return f'REVOKE {"GRANT OPTION FOR " if grant_option else ""}{grant_privileges(privileges)} ON {on} FROM {self.role};'
 
     def __eq__(self, other):
         if not isinstance(other, Grant):
             raise TypeError('other')
-        return type(self.obj) is type(other.obj) and self.obj.name == other.obj.name and self.role == other.role and self.privilegestr == other.privilegestr
+        return type(self.obj) is type(other.obj) and self.obj.name == other.obj.name and self.role == other.role and self.privileges == other.privileges and self.grantable == other.grantable
 
     def __str__(self):
-        return self._grantrevokestr('GRANT')
+        return '\n'.join(self.grantstrs())
 
 class Index:
     """ An index on a table (or a view?) """
+    __slots__ = ('oid', 'table', 'name', 'columns', 'isunique', 'isprimary', 'am', 'definition', 'fullname')
+
     def __init__(self, oid, table, name, columns, isunique, isprimary, am, definition):
         self.oid = oid
         self.table = table
@@ -193,7 +389,7 @@ class Index:
         self.columns = columns
         self.isunique = isunique
         self.isprimary = isprimary
-        self.am = am
+        self.am = sys.intern(am)
         self.definition = definition
         self.fullname = f'{table.schema.name}.{name}'
     def addstr(self):
@@ -202,19 +398,169 @@ class Index:
     def dropstr(self):
         return f'DROP INDEX {self.fullname};'
 
+    def online_addstrs(self):
+        # Indexes on partitioned tables cannot be built concurrently.
+        if self.table.partitioned:
+            return [self.addstr()]
+        # pg_get_indexdef gives CREATE [UNIQUE] INDEX name ON ...
+        return [re.sub(r'^CREATE (UNIQUE )?INDEX ', r'CREATE \1INDEX CONCURRENTLY ', self.definition, count=1) + ';']
+
+    def online_dropstr(self):
+        if self.table.partitioned:
+            return self.dropstr()
+        return f'DROP INDEX CONCURRENTLY {self.fullname};'
+
     def __eq__(self, other):
         if not isinstance(other, Index):
             raise TypeError('other')
-        if self.definition != other.definition:
-            print(f'self: {self.definition} other: {other.definition}')
         return self.definition == other.definition
 
     def __str__(self):
 #        return f'CREATE{" UNIQUE" if self.isunique else ""} INDEX {self.name} ON {self.table.name} USING {self.am} ({column_name_list(self.columns)});'
+        if self.table.partitioned:
+            # pg_get_indexdef gives ON ONLY for a partitioned table, which
+            # would leave the index invalid and its partitions without it.
+            return re.sub(r' ON ONLY ', ' ON ', self.definition, count=1) + ';'
         return f'{self.definition};'
 
+class InstrumentedCursor:
+    """ A cursor that records the queries run on another cursor in a QueryStats, by the kind of query; see execute_query """
+    def __init__(self, cur, stats):
+        self.cur = cur
+        self.stats = stats
+        self.kind = None
+
+    def execute(self, query, params=None, kind='other'):
+        self.kind = kind
+        start = time.perf_counter()
+        try:
+            self.cur.execute(query, params)
+        finally:
+            self.stats.add_query(self.kind, time.perf_counter() - start)
+
+    @property
+    def connection(self):
+        return self.cur.connection
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self.cur.fetchone()
+        self.stats.add_rows(self.kind, [row] if row is not None else [], time.perf_counter() - start)
+        return row
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self.cur.fetchall()
+        self.stats.add_rows(self.kind, rows, time.perf_counter() - start)
+        return rows
+
+    def close(self):
+        self.cur.close()
+
+    def __iter__(self):
+        # Rows are counted as they are fetched, and added up once at the end
+        # rather than locking the stats for each row.
+        rows = iter(self.cur)
+        count = 0
+        size = 0
+        seconds = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start
+                count += 1
+                size += row_size(row)
+                yield row
+        finally:
+            self.stats.add_fetched(self.kind, count, size, seconds)
+
+class ObjectFilter:
+    """ Patterns and object kinds selecting the objects to read and diff """
+    def __init__(self, include_schemas=(), exclude_schemas=(), include_tables=(), exclude_tables=(), kinds=None):
+        self.include_schemas = [name_pattern_regex(pattern) for pattern in include_schemas]
+        self.exclude_schemas = [name_pattern_regex(pattern) for pattern in exclude_schemas]
+        self.include_tables = [name_pattern_regex(pattern) for pattern in include_tables]
+        self.exclude_tables = [name_pattern_regex(pattern) for pattern in exclude_tables]
+        self.kinds = frozenset(kinds if kinds is not None else OBJECT_KINDS)
+
+    def reads(self, *kinds):
+        return any(kind in self.kinds for kind in kinds)
+
+    def reads_tables(self):
+        return self.reads('tables', 'columns', 'constraints', 'indexes', 'triggers', 'grants')
+
+    def reads_columns(self):
+        # New tables are created with their columns, and constraints and
+        # indexes refer to their columns.
+        return self.reads('tables', 'columns', 'constraints', 'indexes')
+
+    def reads_constraints(self):
+        # Indexes that back constraints are told apart by the constraints.
+        return self.reads('constraints', 'indexes')
+
+    def reads_views(self):
+        return self.reads('views', 'grants')
+
+    def reads_functions(self):
+        return self.reads('functions', 'grants')
+
+    def schema_condition(self, column):
+        return name_condition(column, self.include_schemas, self.exclude_schemas)
+
+    def table_condition(self, column):
+        return name_condition(column, self.include_tables, self.exclude_tables)
+
+    def matches_schema(self, name):
+        return name_matches(name, self.include_schemas, self.exclude_schemas)
+
+    def matches_table(self, name):
+        return name_matches(name, self.include_tables, self.exclude_tables)
+
+    def filter_schemas(self, schemas):
+        """
+        Filters schemas that were read without this filter, such as from
+        a snapshot or a cache, leaving out the schemas, tables, views and
+        functions it excludes.  The schemas given are not changed; the
+        kept objects are put in new Schema objects.  Details of the tables
+        kept are left as they are, since the diff skips the kinds of
+        objects not selected.
+
+        :param schemas: The schemas.
+        :returns: The list of schemas kept.
+        """
+        if not (self.include_schemas or self.exclude_schemas or self.include_tables or self.exclude_tables) and self.kinds == OBJECT_KINDS:
+            return schemas
+        kept = []
+        for schema in schemas:
+            if not self.matches_schema(schema.name):
+                continue
+            kept_schema = Schema(schema.oid, schema.name)
+            if self.reads_tables():
+                for table in schema.tables:
+                    if self.matches_table(table.name):
+                        kept_schema.add_table(table)
+            if self.reads_views():
+                for view in schema.views:
+                    if self.matches_table(view.name):
+                        kept_schema.add_view(view)
+            if self.reads_functions():
+                for function in schema.functions:
+                    kept_schema.add_function(function)
+            kept.append(kept_schema)
+        return kept
+
+# The kinds of objects that can be selected for reading and diffing
+OBJECT_KINDS = frozenset(('tables', 'columns', 'constraints', 'indexes', 'triggers', 'views', 'functions', 'grants'))
+
 class PrimaryKey:
     """ A primary key constraint on a table """
+    __slots__ = ('oid', 'table', 'name', 'columns', 'definition')
+
     def __init__(self, oid, table, name, columns, definition):
         self.oid = oid
         self.table = table
@@ -223,10 +569,13 @@ class PrimaryKey:
         self.definition = definition
 
     def addstr(self):
-        return f'ALTER TABLE {self.table.fullname} ADD {str(self)}'
+        return f'ALTER TABLE {self.table.fullname} ADD {str(self)};'
 
     def dropstr(self):
-        return f'ALTER TABLE {self.table.fullname} DROP CONSTRAINT {self.name}'
+        return f'ALTER TABLE {self.table.fullname} DROP CONSTRAINT {self.name};'
+
+    def online_addstrs(self):
+        return using_index_addstrs(self, 'PRIMARY KEY')
 
     def __eq__(self, other):
         if not isinstance(other, PrimaryKey):
@@ -236,6 +585,83 @@ class PrimaryKey:
     def __str__(self):
         return f'CONSTRAINT {self.name} {self.definition}'
 
+class QueryStats:
+    """ Counts, times, rows and bytes of catalog queries by kind, and times of the phases of a run """
+    def __init__(self):
+        self.queries = {}
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def _query(self, kind):
+        if kind not in self.queries:
+            self.queries[kind] = {'count': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0}
+        return self.queries[kind]
+
+    def add_query(self, kind, seconds):
+        with self._lock:
+            query = self._query(kind)
+            query['count'] += 1
+            query['seconds'] += seconds
+
+    def add_fetched(self, kind, rows, size, seconds):
+        with self._lock:
+            query = self._query(kind)
+            query['rows'] += rows
+            query['bytes'] += size
+            query['seconds'] += seconds
+
+    def add_rows(self, kind, rows, seconds):
+        self.add_fetched(kind, len(rows), sum(row_size(row) for row in rows), seconds)
+
+    def add_phase(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(phase, time.perf_counter() - start)
+
+    def timed_iter(self, phase, iterable):
+        """
+        Passes items through from an iterable, adding the time spent
+        producing them, such as in a DDL generator, to a phase.
+
+        :param phase: The phase name.
+        :param iterable: The iterable.
+        :returns: A generator of the items.
+        """
+        items = iter(iterable)
+        seconds = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start
+                yield item
+        finally:
+            self.add_phase(phase, seconds)
+
+    def report(self):
+        lines = [f'{"phase":<24} {"seconds":>10}']
+        for phase, seconds in self.phases.items():
+            lines.append(f'{phase:<24} {seconds:>10.3f}')
+        lines.append('')
+        lines.append(f'{"query":<24} {"count":>8} {"seconds":>10} {"rows":>10} {"bytes":>12}')
+        for kind, query in sorted(self.queries.items(), key=lambda item: -item[1]['seconds']):
+            lines.append(f'{kind:<24} {query["count"]:>8} {query["seconds"]:>10.3f} {query["rows"]:>10} {query["bytes"]:>12}')
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return json.dumps({'phases': self.phases, 'queries': self.queries}, indent=2)
+
 class Schema:
     """ A database namespace """
     def __init__(self, oid, name):
@@ -255,6 +681,12 @@ class Schema:
     def add_function(self, function):
         self.functions.append(function)
 
+    def clear(self):
+        self.tables = []
+        self.table_lookup = {}
+        self.views = []
+        self.functions = []
+
     def add_table(self, table):
         self.tables.append(table)
         self.table_lookup[table.oid] = table
@@ -265,17 +697,59 @@ class Schema:
     def add_view(self, view):
         self.views.append(view)
 
+class StreamingCursor:
+    """ A cursor that runs each query on a new server-side cursor, fetching rows in batches as they are iterated """
+    def __init__(self, conn, fetch_size):
+        self.conn = conn
+        self.fetch_size = fetch_size
+        self.query_count = 0
+        self._cur = None
+
+    def execute(self, query, params=None):
+        self.close()
+        self.query_count += 1
+        self._cur = self.conn.cursor(name=f'xpgdiff_{id(self):x}_{self.query_count}')
+        self._cur.itersize = self.fetch_size
+        self._cur.execute(query, params)
+
+    @property
+    def connection(self):
+        return self.conn
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def close(self):
+        if self._cur is not None:
+            self._cur.close()
+            self._cur = None
+
+    def __iter__(self):
+        return iter(self._cur)
+
 class Table:
-    """ A table in a schema """
-    def __init__(self, oid, schema, owner, name, acl):
+    """ A table in a schema, which may be partitioned or a partition """
+    def __init__(self, oid, schema, owner, name, acl, pages=0, rows=None, partitioned=False):
         self.oid = oid
         self.schema = schema
-        self.owner = owner
+        self.owner = sys.intern(owner)
         self.name = name
         self.acl = acl
+        self.pages = pages
+        self.rows = rows
+        self.partitioned = partitioned
+        self.partition_key = None
+        self.parent = None
+        self.partition_bound = None
+        self.shape = None
+        self.partitions = []
         self.grants = grants_for_acl(self, acl)
-        self.columns = []
+        self._columns = []
         self.column_lookup = {}
+        self.column_store = None
         self.primary_key = None
         self.unique_keys = []
         self.unique_key_names = set()
@@ -294,11 +768,117 @@ class Table:
     def add_check(self, check):
         self.checks.append(check)
 
+    def add_partition(self, partition):
+        partition.parent = self
+        self.partitions.append(partition)
+
+    def matches_parent(self):
+        """
+        Tells whether a partition has the same columns, constraints,
+        indexes and triggers as its parent, leaving names aside, so that
+        it has nothing of its own to diff.
+
+        :returns: True if it is a partition with its parent's shape.
+        """
+        return self.parent is not None and self.shape == self.parent.shape
+
+    def defining_table(self):
+        """
+        Gets the table whose columns and other details a partition has:
+        the partition itself, unless it matches its parent, in which case
+        its details were not read and are those of the parent.
+
+        :returns: The partition or one of the tables above it.
+        """
+        table = self
+        while table.matches_parent():
+            table = table.parent
+        return table
+
+    def get_local_objects(self):
+        """
+        Gets the checks, indexes and triggers of a partition that are not
+        also on its parent or on a table above that, by definition with
+        names left out.  Partitions that match their parent have no
+        details read, so all of the ancestors are looked at.
+
+        :returns: A tuple of lists of the checks, indexes and triggers.
+        """
+        if self.matches_parent():
+            return [], [], []
+        inherited = self._inherited_definitions()
+        return tuple([obj for obj in objs if normalized_definition(obj.definition) not in inherited]
+                     for objs in (self.checks, self.get_non_constraint_indexes(), self.get_non_constraint_triggers()))
+
+    def get_local_constraints(self):
+        """
+        Gets the primary key, unique keys and foreign keys of a partition
+        that are not also on a table above it; see get_local_objects.
+
+        :returns: A tuple of the primary key or None, and lists of the unique keys and foreign keys.
+        """
+        if self.matches_parent():
+            return None, [], []
+        inherited = self._inherited_definitions()
+        primary_key = self.primary_key if self.primary_key is not None and self.primary_key.definition not in inherited else None
+        return (primary_key, [unique_key for unique_key in self.unique_keys if unique_key.definition not in inherited],
+                [foreign_key for foreign_key in self.foreign_keys if foreign_key.definition not in inherited])
+
+    def get_local_columns(self):
+        """
+        Gets the columns of a partition whose NOT NULL constraint or
+        default is not its parent's, with the parent's column.
+
+        :returns: A list of (parent column, column) tuples.
+        """
+        if self.matches_parent():
+            return []
+        parent_columns = {column.name: column for column in self.parent.defining_table().columns}
+        return [(parent_columns[column.name], column) for column in self.columns
+                if column.name in parent_columns and column != parent_columns[column.name]]
+
+    def _inherited_definitions(self):
+        inherited = set()
+        ancestor = self.parent
+        while ancestor is not None:
+            objs = ancestor.checks + ancestor.indexes + ancestor.triggers + ancestor.unique_keys + ancestor.foreign_keys
+            if ancestor.primary_key is not None:
+                objs.append(ancestor.primary_key)
+            inherited.update(normalized_definition(obj.definition) for obj in objs)
+            ancestor = ancestor.parent
+        return inherited
+
+    def all_partitions(self):
+        """
+        Gets the partitions of a table and their partitions in turn.
+
+        :returns: A list of partitions, each before its own.
+        """
+        partitions = []
+        for partition in self.partitions:
+            partitions.append(partition)
+            partitions.extend(partition.all_partitions())
+        return partitions
+
+    def partitionstr(self):
+        s = f'CREATE TABLE {self.fullname} PARTITION OF {self.parent.fullname} {self.partition_bound}'
+        if self.partition_key:
+            s += f' PARTITION BY {self.partition_key}'
+        return s + ';'
+
+    @property
+    def columns(self):
+        if self.column_store is not None:
+            return self.column_store.columns(self)
+        return self._columns
+
     def add_column(self, column):
-        self.columns.append(column)
+        self._columns.append(column)
         self.column_lookup[column.colnum] = column
 
     def get_column(self, colnum):
+        if self.column_store is not None:
+            return self.column_store.get_column(self, colnum)
         return self.column_lookup[colnum]
 
     def get_columns(self, colnums):
@@ -327,6 +907,8 @@ class Table:
         self.unique_key_names.add(unique_key.name)
 
     def __str__(self):
+        if self.parent is not None:
+            return self._partition_ddl()
         s = f'CREATE TABLE {self.fullname} (\n'
         for i, column in enumerate(self.columns):
             if i == 0:
@@ -341,7 +923,10 @@ class Table:
 #            s += f', {str(foreign_key)}\n'
         for check in self.checks:
             s += f', {str(check)}\n'
-        s += ');'
+        s += ')'
+        if self.partition_key:
+            s += f' PARTITION BY {self.partition_key}'
+        s += ';'
         for index in self.get_non_constraint_indexes():
             s += f'\n{str(index)}'
         for trigger in self.get_non_constraint_triggers():
@@ -349,10 +934,40 @@ class Table:
         for grant in self.grants:
             s += f'\n{str(grant)}'
         s += f'\n{self.ownerstr()}'
+        for partition in self.partitions:
+            s += f'\n{str(partition)}'
+        return s
+
+    def _partition_ddl(self):
+        # A partition gets its columns and whatever its parent has from
+        # the parent, so only what is its own is created here.
+        s = self.partitionstr()
+        for parent_column, column in self.get_local_columns():
+            for alterstr in column.alterstrs(parent_column):
+                s += f'\n{alterstr}'
+        primary_key, unique_keys, _ = self.get_local_constraints()
+        if primary_key is not None:
+            s += f'\n{primary_key.addstr()}'
+        for unique_key in unique_keys:
+            s += f'\n{unique_key.addstr()}'
+        checks, indexes, triggers = self.get_local_objects()
+        for check in checks:
+            s += f'\n{check.addstr()}'
+        for index in indexes:
+            s += f'\n{str(index)}'
+        for trigger in triggers:
+            s += f'\n{str(trigger)}'
+        for grant in self.grants:
+            s += f'\n{str(grant)}'
+        s += f'\n{self.ownerstr()}'
+        for partition in self.partitions:
+            s += f'\n{str(partition)}'
         return s
 
 class Trigger:
     """ A trigger on a table or view """
+    __slots__ = ('table_or_view', 'name', 'constraint', 'definition')
+
     def __init__(self, table_or_view, name, constraint, definition):
         self.table_or_view = table_or_view
         self.name = name
@@ -360,10 +975,10 @@ class Trigger:
         self.definition = definition
 
     def addstr(self):
-        return f'ALTER {"TABLE" if isinstance(self.table_or_view, Table) else "VIEW"} {self.table_or_view.fullname} ADD {str(self)}'
+        return str(self)
 
     def dropstr(self):
-        return f'ALTER {"TABLE" if isinstance(self.table_or_view, Table) else "VIEW"} {self.table_or_view.fullname} DROP TRIGGER {self.name}'
+        return f'DROP TRIGGER {self.name} ON {self.table_or_view.fullname};'
 
     def __eq__(self, other):
         if not isinstance(other, Trigger):
@@ -375,6 +990,8 @@ class Trigger:
 
 class UniqueKey:
     """ A unique constraint (aka alternate key) on a table """
+    __slots__ = ('oid', 'table', 'name', 'columns', 'definition')
+
     def __init__(self, oid, table, name, columns, definition):
         self.oid = oid
         self.table = table
@@ -388,6 +1005,9 @@ class UniqueKey:
     def dropstr(self):
         return f'ALTER TABLE {self.table.fullname} DROP CONSTRAINT {self.name};'
 
+    def online_addstrs(self):
+        return using_index_addstrs(self, 'UNIQUE')
+
     def __eq__(self, other):
         if not isinstance(other, UniqueKey):
             raise TypeError('other')
@@ -399,14 +1019,15 @@ class UniqueKey:
 
 class View:
     """ A view in a schema """
-    def __init__(self, oid, schema, owner, name, acl, definition):
+    def __init__(self, oid, schema, owner, name, acl, definition, digest=None):
         self.oid = oid
         self.schema = schema
-        self.owner = owner
+        self.owner = sys.intern(owner)
         self.name = name
         self.acl = acl
         self.grants = grants_for_acl(self, acl)
         self.definition = definition
+        self.digest = definition_digest(definition) if definition is not None else digest
         self.triggers = []
         self.fullname = f'{schema.name}.{name}'
 
@@ -445,6 +1066,16 @@ def column_name_list(columns):
         return ''
     return ', '.join([column.name for column in columns])
 
+def numeric_precision_scale(typmod):
+    """
+    Decodes the atttypmod of a numeric column.
+
+    :param typmod: The atttypmod, which is not -1.
+    :returns: A (precision, scale) tuple.
+    """
+    typmod -= 4
+    return typmod >> 16, typmod & 0x0ffff
+
 _FK_ACTIONS = {
     'a': 'NO ACTION',
     'r': 'RESTRICT',
@@ -453,6 +1084,28 @@ _FK_ACTIONS = {
     'd': 'SET DEFAULT'
 }
 
+def definition_digest(definition):
+    """
+    Gets the digest of an object definition, the same as
+    definition_digest_expression gets in the database.
+
+    :param definition: The definition.
+    :returns: The digest as a hex string.
+    """
+    return hashlib.md5(definition.encode('utf-8')).hexdigest()
+
+def definition_digest_expression(expression):
+    """
+    Gets a SQL expression for the digest of an object definition, the same
+    as definition_digest gets.  The definition is hashed as UTF-8 whatever
+    the encoding of the database, so that digests read from databases in
+    other encodings, or computed from snapshots, can be compared.
+
+    :param expression: A SQL expression for the definition.
+    :returns: The SQL expression.
+    """
+    return f"md5(convert_to({expression}, 'UTF8'))"
+
 def fk_action(action):
     """
     Gets the full name for a foreign key action abbreviation.
@@ -477,75 +1130,292 @@ def fk_matchtype(matchtype):
     """
     return _FK_MATCHTYPE[matchtype]
 
-_GRANT_PRIVS = {
-    'r': 'SELECT',
-    'a': 'INSERT',
-    'w': 'UPDATE',
-    'd': 'DELETE',
-    'D': 'TRUNCATE',
-    'x': 'REFERENCES',
-    't': 'TRIGGER',
-    'X': 'EXECUTE'
-}
+# Privileges as aclexplode names them, in the order of their bits in
+# PostgreSQL's AclMode, which is the order of the letters in ACL text.
+ACL_PRIVILEGES = ['INSERT', 'SELECT', 'UPDATE', 'DELETE', 'TRUNCATE', 'REFERENCES', 'TRIGGER', 'EXECUTE', 'USAGE', 'CREATE', 'TEMPORARY', 'CONNECT', 'SET', 'ALTER SYSTEM', 'MAINTAIN']
+
+def grant_privileges(privileges):
+    """
+    Gets a comma-separated list of privilege names for a bitmask.
+
+    :param privileges: The bitmask of ACL_PRIVILEGES.
+    :returns: A comma-separated list of privilege names.
+    """
+    return ', '.join([name for bit, name in enumerate(ACL_PRIVILEGES) if privileges & (1 << bit)])
+
+def acl_expression(column):
+    """
+    Gets a SQL expression that expands an ACL with aclexplode into a JSON
+    array of [role, privileges, grantable] for each role it grants to, in
+    the order of the ACL, where privileges and grantable are bitmasks of
+    ACL_PRIVILEGES.  Privileges a role holds from itself, as the owner
+    does, are left out.
+
+    :param column: The ACL column, e.g. c.relacl.
+    :returns: The expression.
+    """
+    bit = f"1 << (array_position(array[{', '.join(repr(name) for name in ACL_PRIVILEGES)}], e.privilege_type) - 1)"
+    return f"""(select json_agg(json_build_array(g.role, g.privileges, g.grantable) order by g.n)
+    from (select case when e.grantee = 0 then 'PUBLIC' else quote_ident(pg_get_userbyid(e.grantee)) end as role,
+            bit_or({bit}) as privileges,
+            bit_or(case when e.is_grantable then {bit} else 0 end) as grantable,
+            min(e.n) as n
+        from aclexplode({column}) with ordinality e(grantor, grantee, privilege_type, is_grantable, n)
+        where e.grantee <> e.grantor
+        group by e.grantee) g)"""
+
+# Rewrites of index and trigger definitions that leave out their names
+# and the table they are on, so that the definitions on a partition and
+# on its parent compare equal.  The patterns are the same in Python and
+# in PostgreSQL regular expressions.
+_DEFINITION_NAMES = [
+    (r'^CREATE (UNIQUE )?INDEX \S+ ON (ONLY )?\S+ ', r'CREATE \1INDEX ON '),
+    (r'^CREATE (CONSTRAINT )?TRIGGER \S+ (.*) ON \S+ ', r'CREATE \1TRIGGER \2 ON '),
+]
+
+def normalized_definition(definition):
+    """
+    Gets the definition of a check, index or trigger without the names
+    of the object and its table.
+
+    :param definition: The definition.
+    :returns: The definition without names.
+    """
+    for pattern, replacement in _DEFINITION_NAMES:
+        definition = re.sub(pattern, replacement, definition, count=1)
+    return definition
+
+def shape_expression(column):
+    """
+    Gets a SQL expression that computes an md5 of the structure of a
+    table: its columns, constraints, indexes and triggers, without their
+    names and without the table's name, owner and ACL.  A partition with
+    the same shape as its parent has nothing of its own.
+
+    :param column: The table oid column, e.g. c.oid.
+    :returns: The expression.
+    """
+    (index_pattern, index_replacement), (trigger_pattern, trigger_replacement) = _DEFINITION_NAMES
+    return f"""md5(concat_ws('|',
+    (select string_agg(concat_ws(',', at.attname, format_type(at.atttypid, at.atttypmod), at.attnotnull, at.attndims, pg_get_expr(d.adbin, d.adrelid)), ';' order by at.attname)
+     from pg_attribute at
+     left outer join pg_attrdef d on d.adrelid = at.attrelid and d.adnum = at.attnum
+     where at.attrelid = {column} and at.attnum >= 1 and at.attisdropped = FALSE),
+    (select string_agg(s.definition, ';' order by s.definition)
+     from (select o.contype || pg_get_constraintdef(o.oid) as definition from pg_constraint o where o.conrelid = {column}
+           union all
+           select regexp_replace(pg_get_indexdef(i.indexrelid), '{index_pattern}', '{index_replacement}') from pg_index i where i.indrelid = {column}
+           union all
+           select regexp_replace(pg_get_triggerdef(tg.oid), '{trigger_pattern}', '{trigger_replacement}') from pg_trigger tg where tg.tgrelid = {column} and tg.tgisinternal = FALSE) s)))"""
+
+def function_kind_expression(cur, alias, kind):
+    """
+    Gets a SQL expression that tells whether a pg_proc row is an aggregate
+    or a window function.  PostgreSQL 11 replaced proisagg and proiswindow
+    with prokind, so the column is picked by the version of the server,
+    which libpq reads on connecting.
+
+    :param cur: A cursor on the server to run the expression on.
+    :param alias: The alias of pg_proc, e.g. p.
+    :param kind: 'a' for aggregates or 'w' for window functions.
+    :returns: The expression.
+    """
+    if cur.connection.server_version >= 110000:
+        return f"{alias}.prokind = '{kind}'"
+    column = {'a': 'proisagg', 'w': 'proiswindow'}[kind]
+    return f'{alias}.{column}'
+
+def not_partition_condition(column):
+    """
+    Gets a SQL condition that a relation is not a partition.  It looks
+    for a partitioned parent in pg_inherits rather than at
+    pg_class.relispartition, which PostgreSQL before 10 does not have.
+
+    :param column: The relation oid column, e.g. c.oid.
+    :returns: The condition.
+    """
+    return f"""not exists (select 1 from pg_inherits pi join pg_class pc on pc.oid = pi.inhparent where pi.inhrelid = {column} and pc.relkind = 'p')"""
+
+def partitions_fingerprint_expression(column):
+    """
+    Gets a SQL expression that lists the name, owner, ACL, bound and
+    shape of every partition of a partitioned table, and of their
+    partitions in turn.  The bound is taken from the pg_class row as JSON,
+    with the parse locations in it left out, so that the query still runs
+    on PostgreSQL before 10, which has no relpartbound.
+
+    :param column: The table oid column, e.g. c.oid.
+    :returns: The expression.
+    """
+    return f"""(with recursive partitions(oid) as (
+        select i.inhrelid from pg_inherits i where i.inhparent = {column}
+        union all
+        select i.inhrelid from partitions p join pg_inherits i on i.inhparent = p.oid
+     )
+     select string_agg(concat_ws(',', pn.nspname, pc.relname, pa.rolname, pc.relacl::text,
+         regexp_replace(to_json(pc)->>'relpartbound', ':location -?[0-9]+', '', 'g'), {shape_expression('pc.oid')}), ';' order by pn.nspname, pc.relname)
+     from partitions p
+     join pg_class pc on pc.oid = p.oid
+     join pg_namespace pn on pn.oid = pc.relnamespace
+     join pg_authid pa on pa.oid = pc.relowner)"""
+
+def oid_condition(column, oids):
+    """
+    Gets a SQL condition restricting a column to a set of oids, and the
+    query parameters for it.
+
+    :param column: The column holding oids.
+    :param oids: The oids to allow, or None to allow all.
+    :returns: A tuple of the condition and its parameters (None if there are none).
+    """
+    if oids is None:
+        return 'TRUE', None
+    return f'{column} = any(%s::oid[])', (list(oids),)
+
+def name_pattern_regex(pattern):
+    """
+    Converts a name pattern to a regular expression.  A pattern starting
+    with ~ is a regular expression already; any other pattern is a glob
+    matching the whole name, where * matches any characters and ? any one
+    character.
+
+    :param pattern: The pattern.
+    :returns: The regular expression, usable both by PostgreSQL and by re.
+    """
+    if pattern.startswith('~'):
+        return pattern[1:]
+    return '^' + ''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in pattern) + '$'
+
+def name_condition(column, include, exclude):
+    """
+    Gets a SQL condition restricting a name column to names that match
+    any of a list of regular expressions and none of another, and the
+    query parameters for it.
+
+    :param column: The column holding names.
+    :param include: The regular expressions to match, or an empty list to allow all.
+    :param exclude: The regular expressions not to match.
+    :returns: A tuple of the condition and its parameters.
+    """
+    conditions = []
+    params = []
+    if include:
+        conditions.append(f'{column} ~ any(%s::text[])')
+        params.append(list(include))
+    if exclude:
+        conditions.append(f'not {column} ~ any(%s::text[])')
+        params.append(list(exclude))
+    return ' and '.join(conditions) or 'TRUE', tuple(params)
+
+def name_matches(name, include, exclude):
+    """
+    Tells whether a name matches any of a list of regular expressions
+    and none of another, as name_condition does on the server.
+
+    :param name: The name.
+    :param include: The regular expressions to match, or an empty list to allow all.
+    :param exclude: The regular expressions not to match.
+    :returns: True if the name matches.
+    """
+    if include and not any(re.search(regex, name) for regex in include):
+        return False
+    return not any(re.search(regex, name) for regex in exclude)
+
+def row_size(row):
+    """
+    Gets the approximate number of bytes in a result row, counting text
+    and binary values by length and anything else as 8 bytes.
+
+    :param row: The row.
+    :returns: The size.
+    """
+    size = 0
+    for value in row:
+        if isinstance(value, (str, bytes)):
+            size += len(value)
+        elif value is not None:
+            size += 8
+    return size
+
+def not_valid_addstrs(constraint):
+    """
+    Gets the statements that add a check or foreign key constraint without
+    blocking writes while existing rows are checked: the constraint is
+    added NOT VALID, then validated, which only blocks schema changes.
+    A constraint that is not valid in the target is left that way.
+
+    :param constraint: The Check or ForeignKey.
+    :returns: A list of statements.
+    """
+    if constraint.definition.endswith(' NOT VALID'):
+        return [constraint.addstr()]
+    return [f'ALTER TABLE {constraint.table.fullname} ADD {str(constraint)} NOT VALID;',
+            f'ALTER TABLE {constraint.table.fullname} VALIDATE CONSTRAINT {constraint.name};']
 
-def grant_privileges(perms):
+def using_index_addstrs(constraint, constraint_type):
     """
-    Gets a comma-separated list of privilege full names for a string of abbreviations.
+    Gets the statements that add a primary or unique key without blocking
+    writes while its index is built: the index is created concurrently,
+    then the constraint is added using it.
 
-    :param perms: The string of privilege abbreviations.
-    :returns: A comma-separated list of privilege full names.
+    :param constraint: The PrimaryKey or UniqueKey.
+    :param constraint_type: 'PRIMARY KEY' or 'UNIQUE'.
+    :returns: A list of statements.
     """
-    return ', '.join([_GRANT_PRIVS[perm] for perm in perms])
+    # A partitioned table's indexes cannot be built concurrently, nor can
+    # its constraints be added using an index.
+    if constraint.table.partitioned:
+        return [constraint.addstr()]
+    for index in constraint.table.indexes:
+        if index.name == constraint.name:
+            create = index.online_addstrs()[0]
+            break
+    else:
+        create = f'CREATE UNIQUE INDEX CONCURRENTLY {constraint.name} ON {constraint.table.fullname} ({column_name_list(constraint.columns)});'
+    return [create, f'ALTER TABLE {constraint.table.fullname} ADD CONSTRAINT {constraint.name} {constraint_type} USING INDEX {constraint.name};']
 
 def grants_for_acl(obj, acl):
     """
-    Gets a list of grants (Grant instances) for an ACL string.
+    Gets a list of grants (Grant instances) for an ACL.
 
     :param obj: The object the ACL applies to.
-    :param acl: The ACL as a string.
+    :param acl: The ACL as acl_expression expands it, or None.
     :returns: The list of grants.
     """
-    if not isinstance(acl, str) or len(acl) <= 2:
-        return []
-    if acl[0] != '{' or acl[-1] != '}':
+    if not acl:
         return []
-    acls = acl[1:-2].split(',')
-    grants = []
-    for _acl in acls:
-        role_privileges, owner = _acl.split('/')
-        role, privilegestr = role_privileges.split('=')
-        if role == owner:
-            continue
-        grants.append(Grant(obj, role if role else 'PUBLIC', privilegestr))
-    return grants
+    # Privileges PostgreSQL has added since ACL_PRIVILEGES are left out.
+    return [Grant(obj, role, privileges, grantable or 0) for role, privileges, grantable in acl if privileges]
 
 ############################################################################
 # FUNCTIONS THAT READ DATABASE METADATA
 ############################################################################
 
-def get_checks(cur, table):
+def execute_query(cur, kind, query, params=None):
     """
-    Gets CHECK constraints for a table, adding them to the table.
+    Runs a catalog query, recording it under a kind of query when the
+    cursor keeps QueryStats.  Any other cursor just runs it.
 
     :param cur: A cursor to execute commands on.
-    :param table: The table to get CHECKs for.
+    :param kind: The kind of query, the name of the loader that runs it.
+    :param query: The query.
+    :param params: The query parameters, if any.
     """
-    cur.execute(f"""select oid, conname, consrc, pg_get_constraintdef(oid)
-from pg_constraint
-where conrelid = {table.oid}
-and contype = 'c'
-order by conname;""")
-    for row in cur:
-        table.add_check(Check(row[0], table, row[1], row[2], row[3]))
+    if isinstance(cur, InstrumentedCursor):
+        cur.execute(query, params, kind=kind)
+    else:
+        cur.execute(query, params)
 
-def get_columns(cur, table):
+def get_all_columns(cur, tables, columnar=False):
     """
-    Gets columns for a table, adding them to the table.
+    Gets columns for many tables with a single query, adding them to
+    the tables.
 
     :param cur: A cursor to execute commands on.
-    :param table: The table to get columns for.
+    :param tables: A dict of the tables to get columns for, keyed by oid.
+    :param columnar: Whether to keep the columns in a ColumnStore rather than as a Column each.
     """
-    cur.execute(f"""select a.attnum, a.attname, coalesce(bt.typname, t.typname), a.attnotnull, d.adsrc, pg_get_serial_sequence('{table.name}', a.attname), a.attndims, a.atttypmod
+    execute_query(cur, 'get_all_columns', """select a.attrelid, a.attnum, a.attname, coalesce(bt.typname, t.typname), a.attnotnull, pg_get_expr(d.adbin, d.adrelid), pg_get_serial_sequence(a.attrelid::regclass::text, a.attname), a.attndims, a.atttypmod
 from pg_attribute a
 join pg_type t
 on t.oid = a.atttypid
@@ -554,669 +1424,3067 @@ on bt.oid = t.typelem
 left outer join pg_attrdef d
 on d.adrelid = a.attrelid
 and d.adnum = a.attnum
-where a.attrelid = '{table.oid}'
+where a.attrelid = any(%s::oid[])
 and a.attisdropped = FALSE
 and a.attnum >= 1
-order by a.attnum;""")
+order by a.attrelid, a.attnum;""", (list(tables),))
+    store = ColumnStore() if columnar else None
     for row in cur:
-        table.add_column(Column(table, row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7]))
+        table = tables[row[0]]
+        if store is not None:
+            store.add(table, row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8])
+        else:
+            table.add_column(Column(table, row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8]))
 
-def get_foreign_keys(cur, table):
+def get_all_constraints(cur, tables, reftables=None):
     """
-    Gets FK constraints for a table, adding them to the table.
+    Gets PK, UNIQUE, CHECK and FK constraints for many tables with a
+    single query, adding them to the tables.  Columns must already have
+    been added to the tables, including any tables referenced by FKs.
 
     :param cur: A cursor to execute commands on.
-    :param table: The table to get FKs for.
+    :param tables: A dict of the tables to get constraints for, keyed by oid.
+    :param reftables: A dict of the tables FKs may reference, keyed by oid;
+                      defaults to tables.  An FK whose referenced table is
+                      not in it gets None for reftable and refcolumns.
     """
-    cur.execute(f"""select oid, conname, conkey, confrelid, confkey, confmatchtype, confdeltype, confupdtype, pg_get_constraintdef(oid)
+    if reftables is None:
+        reftables = tables
+    execute_query(cur, 'get_all_constraints', """select conrelid, oid, contype, conname, conkey, confrelid, confkey, confmatchtype, confdeltype, confupdtype, pg_get_expr(conbin, conrelid), pg_get_constraintdef(oid)
 from pg_constraint
-where conrelid = {table.oid}
-and contype = 'f'
-order by conname;""")
+where conrelid = any(%s::oid[])
+and contype in ('p', 'u', 'c', 'f')
+order by conrelid, conname;""", (list(tables),))
     for row in cur:
-        reftable = table.schema.get_table(row[3])
-        table.add_foreign_key(ForeignKey(row[0], table, row[1], table.get_columns(row[2]), reftable, reftable.get_columns(row[4]), fk_matchtype(row[5]), fk_action(row[6]), fk_action(row[7]), row[8]))
+        table = tables[row[0]]
+        contype = row[2]
+        if contype == 'p':
+            if table.primary_key is not None:
+                print(f'More than one primary key on {table.name}?', file=sys.stderr)
+            else:
+                table.set_primary_key(PrimaryKey(row[1], table, row[3], table.get_columns(row[4]), row[11]))
+        elif contype == 'u':
+            table.add_unique_key(UniqueKey(row[1], table, row[3], table.get_columns(row[4]), row[11]))
+        elif contype == 'c':
+            table.add_check(Check(row[1], table, row[3], row[10], row[11]))
+        else:
+            reftable = reftables.get(row[5])
+            refcolumns = reftable.get_columns(row[6]) if reftable is not None else None
+            table.add_foreign_key(ForeignKey(row[1], table, row[3], table.get_columns(row[4]), reftable, refcolumns, fk_matchtype(row[7]), fk_action(row[8]), fk_action(row[9]), row[11]))
 
-def get_functions(cur, schema):
+def get_all_indexes(cur, tables):
     """
-    Gets functions for a schema, adding them to the schema.
+    Gets indexes for many tables with a single query, adding them to
+    the tables.
 
     :param cur: A cursor to execute commands on.
-    :param schema: The schema to get functions for.
+    :param tables: A dict of the tables to get indexes for, keyed by oid.
     """
-    cur.execute(f"""select s.*, case when s.proisagg = FALSE then pg_get_functiondef(s.oid) else null end as definition
-from (
-    select p.oid, a.rolname, p.proname, array_agg(t.typname), p.prorettype, p.prolang, p.proisagg, p.proiswindow, p.proacl
-    from pg_proc p
-    join pg_authid a
-    on p.proowner = a.oid
-    left outer join pg_type t
-    on t.oid = any(p.proargtypes)
-    where p.pronamespace = {schema.oid}
-    group by p.oid, a.rolname, p.proname, p.proargtypes, p.prorettype, p.prolang, p.proisagg, p.proiswindow, p.proacl
-) s
-order by s.proname;""")
+    execute_query(cur, 'get_all_indexes', """select i.indrelid, c.oid, c.relname, i.indkey, i.indisunique, i.indisprimary, a.amname, pg_get_indexdef(i.indexrelid)
+from pg_index i
+join pg_class c
+on c.oid = i.indexrelid
+join pg_am a
+on a.oid = c.relam
+where i.indrelid = any(%s::oid[])
+order by i.indrelid, c.relname;""", (list(tables),))
     for row in cur:
-        schema.add_function(Function(row[0], schema, row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9]))
+        table = tables[row[0]]
+        colnums = [int(col) for col in row[3].split(' ')]
+        table.add_index(Index(row[1], table, row[2], table.get_columns(colnums), row[4], row[5], row[6], row[7]))
 
-def get_indexes(cur, table):
+def get_all_triggers(cur, tables_and_views):
     """
-    Gets indexes for a table, adding them to the table.
+    Gets triggers for many tables and views with a single query, adding
+    them to the tables and views.
 
     :param cur: A cursor to execute commands on.
-    :param table: The table to get indexes for.
+    :param tables_and_views: A dict of the tables and views to get triggers for, keyed by oid.
     """
-    cur.execute(f"""select c.oid, c.relname, i.indkey, i.indisunique, i.indisprimary, a.amname, pg_get_indexdef(i.indexrelid)
-from pg_index i
-join pg_class c
-on c.oid = i.indexrelid
-join pg_am a
-on a.oid = c.relam
-where i.indrelid = {table.oid}
-order by c.relname;""")
+    execute_query(cur, 'get_all_triggers', """select tgrelid, tgname, tgconstraint, pg_get_triggerdef(oid)
+from pg_trigger
+where tgrelid = any(%s::oid[])
+order by tgrelid, tgname;""", (list(tables_and_views),))
     for row in cur:
-        colnums = [int(col) for col in row[2].split(' ')]
-        table.add_index(Index(row[0], table, row[1], table.get_columns(colnums), row[3], row[4], row[5], row[6]))
+        table_or_view = tables_and_views[row[0]]
+        table_or_view.add_trigger(Trigger(table_or_view, row[1], row[2], row[3]))
 
-def get_primary_key(cur, table):
+def get_functions(cur, schema, oids=None, lazy=False, filters=None):
     """
-    Gets the PK constraint for a table, adding it to the table.
+    Gets functions for a schema, adding them to the schema.
 
     :param cur: A cursor to execute commands on.
-    :param table: The table to get the PK for.
+    :param schema: The schema to get functions for.
+    :param oids: The oids of the functions to get, if not all of them.
+    :param lazy: Whether to get only the digests of the definitions; see get_definitions.
+    :param filters: An ObjectFilter; definitions are not read unless it selects functions, nor ACLs unless it selects grants.
     """
-    cur.execute(f"""select oid, conname, conkey, pg_get_constraintdef(oid)
-from pg_constraint
-where conrelid = {table.oid}
-and contype = 'p'
-order by conname;""")
-    primary_key = None
+    if filters is None:
+        filters = ObjectFilter()
+    condition, params = oid_condition('p.oid', oids)
+    lazy = lazy or not filters.reads('functions')
+    if not filters.reads('functions'):
+        definition = 'null'
+    elif lazy:
+        definition = definition_digest_expression('pg_get_functiondef(p.oid)')
+    else:
+        definition = 'pg_get_functiondef(p.oid)'
+    execute_query(cur, 'get_functions', f"""select p.oid, a.rolname, p.proname,
+    array(select t.typname from generate_series(0, array_upper(p.proargtypes, 1)) i join pg_type t on t.oid = p.proargtypes[i] order by i),
+    p.prorettype, p.prolang, {function_kind_expression(cur, 'p', 'a')}, {function_kind_expression(cur, 'p', 'w')}, {acl_expression('p.proacl') if filters.reads('grants') else 'null'},
+    case when {function_kind_expression(cur, 'p', 'a')} then null else {definition} end as definition
+from pg_proc p
+join pg_authid a
+on p.proowner = a.oid
+where p.pronamespace = {schema.oid}
+and {condition}
+order by p.proname;""", params)
     for row in cur:
-        if primary_key is not None:
-            print(f'More than one primary key on {table.name}?', file=sys.stderr)
+        if lazy:
+            schema.add_function(Function(row[0], schema, row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], None, row[9]))
         else:
-            primary_key = PrimaryKey(row[0], table, row[1], table.get_columns(row[2]), row[3])
+            schema.add_function(Function(row[0], schema, row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9]))
 
-    if primary_key:
-        table.set_primary_key(primary_key)
-
-def get_schemas(cur, schemas):
+def get_schemas(cur, schemas, filters=None):
     """
     Gets schemas for a database, adding them to a list.
 
     :param cur: A cursor to execute commands on.
     :param schemas: The list schemas are added to.
+    :param filters: An ObjectFilter selecting the schemas to get, if not all of them.
     """
-    cur.execute(f"""select oid, nspname
+    condition, params = filters.schema_condition('nspname') if filters else ('TRUE', ())
+    execute_query(cur, 'get_schemas', f"""select oid, nspname
 from pg_namespace
 where nspname != 'information_schema'
-and not nspname like 'pg_%'
-order by nspname;""")
+and not nspname like %s
+and {condition}
+order by nspname;""", ('pg_%',) + params)
     for row in cur:
         schemas.append(Schema(row[0], row[1]))
 
-def get_tables(cur, schema):
+def get_tables(cur, schema, oids=None, filters=None):
     """
-    Gets tables for a schema, adding them to the schema.
+    Gets tables for a schema, adding them to the schema.  Partitioned
+    tables are included, but not their partitions; see get_partitions.
 
     :param cur: A cursor to execute commands on.
     :param schema: The schema to get tables for.
+    :param oids: The oids of the tables to get, if not all of them.
+    :param filters: An ObjectFilter selecting the tables to get, if not all of them; ACLs are not read unless it selects grants.
     """
-    cur.execute(f"""select c.oid, a.rolname, c.relname, c.relacl
+    if filters is None:
+        filters = ObjectFilter()
+    condition, params = oid_condition('c.oid', oids)
+    table_condition, table_params = filters.table_condition('c.relname')
+    execute_query(cur, 'get_tables', f"""select c.oid, a.rolname, c.relname, {acl_expression('c.relacl') if filters.reads('grants') else 'null'}, c.relpages, c.reltuples, c.relkind = 'p'
 from pg_class c
 join pg_authid a
 on a.oid = c.relowner
 where c.relnamespace = {schema.oid}
-and c.relkind = 'r'
-order by c.relname;""")
+and c.relkind in ('r', 'p')
+and {not_partition_condition('c.oid')}
+and {condition}
+and {table_condition}
+order by c.relname;""", ((params or ()) + table_params) or None)
     for row in cur:
-        schema.add_table(Table(row[0], schema, row[1], row[2], row[3]))
+        # reltuples is -1 (0 before PostgreSQL 14) until the table is first vacuumed or analyzed
+        schema.add_table(Table(row[0], schema, row[1], row[2], row[3], row[4], int(row[5]) if row[5] >= 0 else None, row[6]))
 
-def get_triggers(cur, table_or_view):
+def get_views(cur, schema, oids=None, lazy=False, filters=None):
     """
-    Gets triggers for a table or view, adding them to the table or view.
+    Gets views for a schema, adding them to the schema.
 
     :param cur: A cursor to execute commands on.
-    :param table_or_view: The table or view to get triggers for.
+    :param schema: The schema to get views for.
+    :param oids: The oids of the views to get, if not all of them.
+    :param lazy: Whether to get only the digests of the definitions; see get_definitions.
+    :param filters: An ObjectFilter selecting the views to get, by the table
+                    patterns, if not all of them; definitions are not read
+                    unless it selects views, nor ACLs unless it selects grants.
     """
-    cur.execute(f"""select tgname, tgconstraint, pg_get_triggerdef(oid)
-from pg_trigger
-where tgrelid = {table_or_view.oid}
-order by tgname;""")
+    if filters is None:
+        filters = ObjectFilter()
+    condition, params = oid_condition('c.oid', oids)
+    table_condition, table_params = filters.table_condition('c.relname')
+    lazy = lazy or not filters.reads('views')
+    if not filters.reads('views'):
+        definition = 'null'
+    elif lazy:
+        definition = definition_digest_expression('pg_get_viewdef(c.oid)')
+    else:
+        definition = 'pg_get_viewdef(c.oid)'
+    execute_query(cur, 'get_views', f"""select c.oid, a.rolname, c.relname, {acl_expression('c.relacl') if filters.reads('grants') else 'null'}, {definition}
+from pg_class c
+join pg_authid a
+on c.relowner = a.oid
+where c.relnamespace = {schema.oid}
+and c.relkind = 'v'
+and {condition}
+and {table_condition}
+order by c.relname;""", ((params or ()) + table_params) or None)
     for row in cur:
-        table_or_view.add_trigger(Trigger(table_or_view, row[0], row[1], row[2]))
+        if lazy:
+            schema.add_view(View(row[0], schema, row[1], row[2], row[3], None, row[4]))
+        else:
+            schema.add_view(View(row[0], schema, row[1], row[2], row[3], row[4]))
 
-def get_unique_keys(cur, table):
+def get_definitions(cur, functions, views):
     """
-    Gets UNIQUE constraints for a table, adding them to the table.
+    Gets the definitions of functions and views that were read with only
+    their digests, with a single query, setting them on the objects.
 
     :param cur: A cursor to execute commands on.
-    :param table: The table to get UNIQUEs for.
+    :param functions: A dict of the functions to get definitions for, keyed by oid.
+    :param views: A dict of the views to get definitions for, keyed by oid.
     """
-    cur.execute(f"""select oid, conname, conkey, pg_get_constraintdef(oid)
-from pg_constraint
-where conrelid = {table.oid}
-and contype = 'u'
-order by conname;""")
+    execute_query(cur, 'get_definitions', """select 'f', p.oid, pg_get_functiondef(p.oid)
+from pg_proc p
+where p.oid = any(%s::oid[])
+union all
+select 'v', c.oid, pg_get_viewdef(c.oid)
+from pg_class c
+where c.oid = any(%s::oid[]);""", (list(functions), list(views)))
     for row in cur:
-        table.add_unique_key(UniqueKey(row[0], table, row[1], table.get_columns(row[2]), row[3]))
+        obj = functions[row[1]] if row[0] == 'f' else views[row[1]]
+        if definition_digest(row[2]) != obj.digest:
+            print(f'Definition of {obj.fullname} changed while it was being read', file=sys.stderr)
+        obj.definition = row[2]
 
-def get_views(cur, schema):
+def get_object_dependencies(cur, tables, views, functions):
     """
-    Gets views for a schema, adding them to the schema.
+    Gets the tables, views and functions that tables, views and functions
+    depend on, as recorded in pg_depend: through a table's column types,
+    defaults, constraints other than FKs, indexes and triggers, a view's
+    rewrite rule and triggers, and a function's argument and return
+    types.  A sequence stands for the table that owns it.  What a
+    function in SQL reads is checked when it is created but not recorded,
+    so a None in its set marks its dependencies as unknown.
 
     :param cur: A cursor to execute commands on.
-    :param schema: The schema to get views for.
+    :param tables: The tables, as a dict keyed by oid.
+    :param views: The views, as a dict keyed by oid.
+    :param functions: The functions, as a dict keyed by oid.
+    :returns: A dict of sets of the identity keys of the objects each object depends on, keyed by oid.
     """
-    cur.execute(f"""select c.oid, a.rolname, c.relname, c.relacl, pg_get_viewdef(c.oid)
-from pg_class c
+    dependencies = {oid: set() for oid in itertools.chain(tables, views, functions)}
+    if not dependencies:
+        return dependencies
+    relations = list(tables) + list(views)
+    execute_query(cur, 'get_object_dependencies', """with dependent(oid, classid, objid) as (
+    select c.oid, 'pg_class'::regclass, c.oid from pg_class c where c.oid = any(%s::oid[])
+    union all
+    select a.adrelid, 'pg_attrdef'::regclass, a.oid from pg_attrdef a where a.adrelid = any(%s::oid[])
+    union all
+    select c.conrelid, 'pg_constraint'::regclass, c.oid from pg_constraint c where c.conrelid = any(%s::oid[]) and c.contype != 'f'
+    union all
+    select i.indrelid, 'pg_class'::regclass, i.indexrelid from pg_index i where i.indrelid = any(%s::oid[])
+    union all
+    select t.tgrelid, 'pg_trigger'::regclass, t.oid from pg_trigger t where t.tgrelid = any(%s::oid[]) and not t.tgisinternal
+    union all
+    select r.ev_class, 'pg_rewrite'::regclass, r.oid from pg_rewrite r where r.ev_class = any(%s::oid[])
+    union all
+    select p.oid, 'pg_proc'::regclass, p.oid from pg_proc p where p.oid = any(%s::oid[])
+), referenced(oid, relid, procid) as (
+    select o.oid,
+        case
+            when d.refclassid = 'pg_type'::regclass then
+                (select coalesce(nullif(t.typrelid, 0), e.typrelid) from pg_type t left join pg_type e on e.oid = t.typelem where t.oid = d.refobjid)
+            when c.relkind = 'S' then
+                (select s.refobjid from pg_depend s
+                 where s.classid = 'pg_class'::regclass and s.objid = c.oid and s.refclassid = 'pg_class'::regclass and s.deptype in ('a', 'i'))
+            else c.oid
+        end,
+        case when d.refclassid = 'pg_proc'::regclass then d.refobjid end
+    from dependent o
+    join pg_depend d on d.classid = o.classid and d.objid = o.objid and d.refclassid in ('pg_class'::regclass, 'pg_type'::regclass, 'pg_proc'::regclass)
+    left join pg_class c on d.refclassid = 'pg_class'::regclass and c.oid = d.refobjid
+)
+select distinct r.oid, n.nspname, c.relname, null
+from referenced r
+join pg_class c on c.oid = r.relid and c.relkind in ('r', 'p', 'v', 'm', 'f')
+join pg_namespace n on n.oid = c.relnamespace
+union
+select distinct r.oid, n.nspname, p.proname,
+    array(select t.typname from generate_series(0, array_upper(p.proargtypes, 1)) i join pg_type t on t.oid = p.proargtypes[i] order by i)
+from referenced r
+join pg_proc p on p.oid = r.procid
+join pg_namespace n on n.oid = p.pronamespace
+union
+select p.oid, null, null, null
+from pg_proc p
+join pg_language l on l.oid = p.prolang
+where p.oid = any(%s::oid[])
+and l.lanname = 'sql';""", (list(tables), list(tables), list(tables), list(tables), relations, list(views), list(functions), list(functions)))
+    for oid, schema_name, name, argtypes in cur:
+        if name is None:
+            dependencies[oid].add(None)
+        else:
+            dependencies[oid].add((schema_name, name) if argtypes is None else (schema_name, name, tuple(argtypes)))
+    return dependencies
+
+def get_relation_details(cur, tables, views, reftables=None, filters=None, columnar=False):
+    """
+    Gets columns, constraints, indexes and triggers for tables and views.
+    Each kind of object is read with one query for all of them rather
+    than one query per table, so the number of queries does not depend
+    on the number of tables.
+
+    :param cur: A cursor to execute commands on.
+    :param tables: A dict of the tables to get details for, keyed by oid.
+    :param views: A dict of the views to get details for, keyed by oid.
+    :param reftables: A dict of the tables FKs may reference, keyed by oid; defaults to tables.
+    :param filters: An ObjectFilter selecting the kinds of details to get, if not all of them.
+    :param columnar: Whether to keep the columns in a ColumnStore rather than as a Column each.
+    """
+    if filters is None:
+        filters = ObjectFilter()
+    tables_and_views = dict(tables)
+    tables_and_views.update(views)
+    if filters.reads_columns():
+        get_all_columns(cur, tables, columnar)
+    if filters.reads_constraints():
+        get_all_constraints(cur, tables, reftables)
+    if filters.reads('indexes'):
+        get_all_indexes(cur, tables)
+    if filters.reads('triggers'):
+        get_all_triggers(cur, tables_and_views)
+
+def get_partitions(cur, tables, filters=None, columnar=False, kept=None):
+    """
+    Gets the partitions of partitioned tables, and their partitions in
+    turn, adding them to the tables they partition rather than to a
+    schema.  The shape of each partition is computed on the server (see
+    shape_expression), and details are read only for the partitions whose
+    shape differs from their parent's, so a table with thousands of
+    partitions like itself costs hardly more to read than one without.
+    The details of the partitioned tables must already have been read.
+
+    :param cur: A cursor to execute commands on.
+    :param tables: A dict of tables, keyed by oid, to get the partitions of the partitioned ones of.
+    :param filters: An ObjectFilter selecting the kinds of details to get, if not all of them; ACLs are not read unless it selects grants.
+    :param columnar: Whether to keep the columns in a ColumnStore rather than as a Column each.
+    :param kept: A dict of partitions and partitioned tables read before
+                 that have not changed since, keyed by oid, whose shapes
+                 and details are reused rather than read again.
+    """
+    if filters is None:
+        filters = ObjectFilter()
+    if kept is None:
+        kept = {}
+    parents = {oid: table for oid, table in tables.items() if table.partitioned}
+    if not parents:
+        return
+    execute_query(cur, 'get_partitions', f"""with recursive partitions(oid, parent, depth) as (
+    select c.oid, null::oid, 0
+    from pg_class c
+    where c.oid = any(%s::oid[])
+    union all
+    select i.inhrelid, i.inhparent, p.depth + 1
+    from partitions p
+    join pg_inherits i
+    on i.inhparent = p.oid
+)
+select c.oid, p.parent, n.oid, n.nspname, a.rolname, c.relname, {acl_expression('c.relacl') if filters.reads('grants') else 'null'}, c.relpages, c.reltuples, c.relkind = 'p',
+    case when c.relkind = 'p' then pg_get_partkeydef(c.oid) end, pg_get_expr(c.relpartbound, c.oid),
+    case when c.oid = any(%s::oid[]) then null else {shape_expression('c.oid')} end
+from partitions p
+join pg_class c
+on c.oid = p.oid
+join pg_namespace n
+on n.oid = c.relnamespace
 join pg_authid a
-on c.relowner = a.oid
-where c.relnamespace = {schema.oid}
-and c.relkind = 'v'
-order by c.relname;""")
+on a.oid = c.relowner
+order by p.depth, p.parent, c.relname;""", (list(parents), list(kept)))
+    # Partitions may be in schemas that were not read.
+    schemas = {table.schema.oid: table.schema for table in tables.values()}
+    partitioned = {}
+    deviating = {}
     for row in cur:
-        schema.add_view(View(row[0], schema, row[1], row[2], row[3], row[4]))
+        table = kept.get(row[0])
+        if row[1] is None:
+            table = parents[row[0]]
+            table.partitions = []
+        elif table is not None:
+            # A kept partition whose parent's shape changed may no longer
+            # match it, and then needs the details it was not read with.
+            had_details = not table.matches_parent()
+            table.partitions = []
+            partitioned[row[1]].add_partition(table)
+            if not had_details and not table.matches_parent():
+                deviating[table.oid] = table
+        else:
+            schema = schemas.setdefault(row[2], Schema(row[2], row[3]))
+            table = Table(row[0], schema, row[4], row[5], row[6], row[7], int(row[8]) if row[8] >= 0 else None, row[9])
+            table.partition_bound = row[11]
+            partitioned[row[1]].add_partition(table)
+        if row[0] not in kept:
+            table.partition_key = row[10]
+            table.shape = row[12]
+            if table.parent is not None and not table.matches_parent():
+                deviating[table.oid] = table
+        if table.partitioned:
+            partitioned[table.oid] = table
+    if deviating:
+        get_relation_details(cur, deviating, {}, tables, filters, columnar)
+
+def get_database_identity(cur):
+    """
+    Gets values that identify a database, so that cached objects are
+    only reused for the database they were read from.
 
-def get_schema_objects(libpq_connstr):
+    :param cur: A cursor to execute commands on.
+    :returns: A tuple identifying the database.
     """
-    Gets all objects in all schemas.
+    execute_query(cur, 'get_database_identity', """select inet_server_addr()::text, inet_server_port(), d.oid, d.datname
+from pg_database d
+where d.datname = current_database();""")
+    return tuple(cur.fetchone())
+
+def get_fingerprints(cur, schemas, filters=None):
+    """
+    Gets a fingerprint of every table, view and function in a list of
+    schemas, computed on the server as an md5 over everything the diff
+    compares: owner, ACL, columns, constraints, indexes, triggers and
+    definitions, and for a partitioned table its partitions.  Only names
+    and digests are sent, so two databases can be compared without
+    reading the objects themselves.  Fingerprints contain no oids and are
+    taken over UTF-8 text, and so can be compared across databases, in
+    any encoding.
+
+    :param cur: A cursor to execute commands on.
+    :param schemas: The schemas to get fingerprints for.
+    :param filters: An ObjectFilter selecting the tables and views to get fingerprints for, if not all of them.
+    :returns: A list of (oid, schema oid, kind, name, argument types, fingerprint) tuples, where kind is 'r' (for partitioned tables as well), 'v' or 'f' and argument types are only given for functions.
+    """
+    if filters is None:
+        filters = ObjectFilter()
+    table_condition, table_params = filters.table_condition('c.relname')
+    relkinds = [relkind for relkind, reads in (('r', filters.reads_tables()), ('p', filters.reads_tables()), ('v', filters.reads_views())) if reads]
+    schema_oids = [schema.oid for schema in schemas]
+    execute_query(cur, 'get_fingerprints', f"""select c.oid, c.relnamespace, case when c.relkind = 'p' then 'r' else c.relkind::text end, c.relname, null::name[], md5(convert_to(concat_ws('|', c.relname, a.rolname, c.relacl::text,
+    (select string_agg(concat_ws(',', at.attname, coalesce(bt.typname, t.typname), at.attnotnull, pg_get_expr(d.adbin, d.adrelid), at.attndims, at.atttypmod), ';' order by at.attname)
+     from pg_attribute at
+     join pg_type t on t.oid = at.atttypid
+     left outer join pg_type bt on bt.oid = t.typelem
+     left outer join pg_attrdef d on d.adrelid = at.attrelid and d.adnum = at.attnum
+     where at.attrelid = c.oid and at.attnum >= 1 and at.attisdropped = FALSE),
+    (select string_agg(concat_ws(',', o.conname, o.contype, pg_get_constraintdef(o.oid)), ';' order by o.conname)
+     from pg_constraint o
+     where o.conrelid = c.oid),
+    (select string_agg(concat_ws(',', ic.relname, pg_get_indexdef(i.indexrelid)), ';' order by ic.relname)
+     from pg_index i join pg_class ic on ic.oid = i.indexrelid
+     where i.indrelid = c.oid),
+    (select string_agg(concat_ws(',', tg.tgname, tg.tgconstraint, pg_get_triggerdef(tg.oid)), ';' order by tg.tgname)
+     from pg_trigger tg
+     where tg.tgrelid = c.oid),
+    case when c.relkind = 'v' then pg_get_viewdef(c.oid) end,
+    case when c.relkind = 'p' then {partitions_fingerprint_expression('c.oid')} end), 'UTF8'))
+from pg_class c
+join pg_authid a
+on a.oid = c.relowner
+where c.relnamespace = any(%s::oid[])
+and c.relkind = any(%s::"char"[])
+and {not_partition_condition('c.oid')}
+and {table_condition}
+union all
+select f.oid, f.pronamespace, 'f', f.proname, f.argtypes, md5(convert_to(concat_ws('|', f.proname, array_to_string(f.argtypes, ','), f.rolname, f.proacl::text, f.definition), 'UTF8'))
+from (
+    select p.oid, p.pronamespace, p.proname, a.rolname, p.proacl,
+        array(select t.typname from generate_series(0, array_upper(p.proargtypes, 1)) i join pg_type t on t.oid = p.proargtypes[i] order by i) as argtypes,
+        case when {function_kind_expression(cur, 'p', 'a')} then null else pg_get_functiondef(p.oid) end as definition
+    from pg_proc p
+    join pg_authid a
+    on p.proowner = a.oid
+    where p.pronamespace = any(%s::oid[])
+    and {filters.reads_functions()}
+) f;""", (schema_oids, relkinds) + table_params + (schema_oids,))
+    return [tuple(row) for row in cur]
+
+def get_catalog_markers(cur, schemas, filters=None):
+    """
+    Gets catalog version markers for all tables, views and functions in
+    a list of schemas, and for the partitions of the partitioned tables.
+    A marker is a digest of the xmin of every catalog row the object is
+    loaded from, including rows of referenced objects whose names appear
+    in its definitions, so it changes whenever the object has to be read
+    again.
+
+    :param cur: A cursor to execute commands on.
+    :param schemas: The schemas to get markers for.
+    :param filters: An ObjectFilter selecting the tables and views to get markers for, if not all of them.
+    :returns: A list of (oid, schema oid, kind, marker) tuples, where kind is 'r' (for partitioned tables as well), 'v', 'f' or 'p' for partitions, which may be in other schemas, in load order.
+    """
+    if filters is None:
+        filters = ObjectFilter()
+    table_condition, table_params = filters.table_condition('c.relname')
+    relkinds = [relkind for relkind, reads in (('r', filters.reads_tables()), ('p', filters.reads_tables()), ('v', filters.reads_views())) if reads]
+    schema_oids = [schema.oid for schema in schemas]
+    marker = """concat_ws(' ', c.xmin,
+    (select string_agg(a.xmin::text, ' ' order by a.attnum) from pg_attribute a where a.attrelid = c.oid and a.attnum > 0),
+    (select string_agg(d.xmin::text, ' ' order by d.adnum) from pg_attrdef d where d.adrelid = c.oid),
+    (select string_agg(o.xmin::text || ' ' || coalesce(rc.xmin::text, ''), ' ' order by o.oid)
+     from pg_constraint o left outer join pg_class rc on rc.oid = o.confrelid
+     where o.conrelid = c.oid),
+    (select string_agg(ra.xmin::text, ' ' order by o.oid, ra.attnum)
+     from pg_constraint o join pg_attribute ra on ra.attrelid = o.confrelid and ra.attnum = any(o.confkey)
+     where o.conrelid = c.oid and o.contype = 'f'),
+    (select string_agg(i.xmin::text || ' ' || ic.xmin::text, ' ' order by i.indexrelid)
+     from pg_index i join pg_class ic on ic.oid = i.indexrelid
+     where i.indrelid = c.oid),
+    (select string_agg(t.xmin::text || ' ' || tp.xmin::text, ' ' order by t.oid)
+     from pg_trigger t join pg_proc tp on tp.oid = t.tgfoid
+     where t.tgrelid = c.oid)"""
+    execute_query(cur, 'get_catalog_markers', f"""with recursive partition_oids(oid) as (
+    select i.inhrelid
+    from pg_class c
+    join pg_inherits i
+    on i.inhparent = c.oid
+    where c.relnamespace = any(%s::oid[])
+    and c.relkind = 'p'
+    and {filters.reads_tables()}
+    and {not_partition_condition('c.oid')}
+    and {table_condition}
+    union all
+    select i.inhrelid
+    from partition_oids p
+    join pg_inherits i
+    on i.inhparent = p.oid
+)
+select oid, nspoid, kind, marker
+from (
+select c.oid, c.relnamespace as nspoid, case when c.relkind = 'p' then 'r' else c.relkind::text end as kind, c.relname::text as name, md5(concat_ws(' ', {marker},
+    (select string_agg(r.xmin::text, ' ' order by r.oid) from pg_rewrite r where r.ev_class = c.oid),
+    (select string_agg(dc.xmin::text || ' ' || coalesce(da.xmin::text, ''), ' ' order by d.refobjid, d.refobjsubid)
+     from pg_rewrite r
+     join pg_depend d on d.classid = 'pg_rewrite'::regclass and d.objid = r.oid and d.refclassid = 'pg_class'::regclass
+     join pg_class dc on dc.oid = d.refobjid
+     left outer join pg_attribute da on da.attrelid = d.refobjid and da.attnum = d.refobjsubid
+     where r.ev_class = c.oid and d.refobjid != c.oid))) as marker
+from pg_class c
+where c.relnamespace = any(%s::oid[])
+and c.relkind = any(%s::"char"[])
+and {not_partition_condition('c.oid')}
+and {table_condition}
+union all
+select c.oid, c.relnamespace, 'p', c.relname::text, md5(concat_ws(' ', {marker}, n.xmin))
+from partition_oids p
+join pg_class c
+on c.oid = p.oid
+join pg_namespace n
+on n.oid = c.relnamespace
+union all
+select p.oid, p.pronamespace, 'f', p.proname::text, md5(p.xmin::text)
+from pg_proc p
+where p.pronamespace = any(%s::oid[])
+and {filters.reads_functions()}
+) m
+order by nspoid, kind, name;""", (schema_oids,) + table_params + (schema_oids, relkinds) + table_params + (schema_oids,))
+    return [tuple(row) for row in cur]
+
+def connect(libpq_connstr, snapshot_id=None):
+    """
+    Opens a read-only, repeatable read connection to a database so that
+    all catalog queries on it see one consistent state.
 
     :param libpq_connstr: A libpq connection string to a database.
-    :returns: A list of schemas.
+    :param snapshot_id: An exported snapshot for the connection to share, if any.
+    :returns: The connection.
     """
     conn = psycopg2.connect(libpq_connstr)
-    try:
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    if snapshot_id:
         cur = conn.cursor()
         try:
-            schemas = []
-            get_schemas(cur, schemas)
-            for schema in schemas:
-                get_tables(cur, schema)
-                for table in schema.tables:
-                    get_columns(cur, table)
-                    get_primary_key(cur, table)
-                    get_unique_keys(cur, table)
-                    get_checks(cur, table)
-                    get_indexes(cur, table)
-                    get_triggers(cur, table)
-                for table in schema.tables:
-                    get_foreign_keys(cur, table)
-                get_views(cur, schema)
-                for view in schema.views:
-                    get_triggers(cur, view)
-                get_functions(cur, schema)
-            return schemas
+            cur.execute('set transaction snapshot %s;', (snapshot_id,))
         finally:
             cur.close()
-    finally:
-        conn.close()
+    return conn
 
-############################################################################
-# FUNCTIONS FOR PRINTING MIGRATION DDL
-############################################################################
+DEFAULT_FETCH_SIZE = 2000
 
-def next_or_none(seq):
+def open_cursor(conn, fetch_size=DEFAULT_FETCH_SIZE, stats=None):
     """
-    Gets an iterator-like function for sequence.  Instead of raising a
-    StopIteration exception, the function returns None when the sequence
-    is exhausted.
-
-    :param seq: The sequence to iterate over.
-    :returns: The iterator-like function.
+    Opens a cursor for reading the catalog.  With a fetch size, each query
+    runs on a server-side cursor and rows are fetched in batches of that
+    size as they are turned into objects, so client memory is bounded by
+    the batch rather than the largest result; without one, each result is
+    buffered in full by the client.
+
+    :param conn: The connection.
+    :param fetch_size: The number of rows to fetch at a time, or 0 to buffer whole results.
+    :param stats: A QueryStats to record the queries run in, if any.
+    :returns: The cursor.
     """
-    def _next():
+    cur = conn.cursor() if not fetch_size else StreamingCursor(conn, fetch_size)
+    return InstrumentedCursor(cur, stats) if stats is not None else cur
+
+class ConnectionSource:
+    """ The catalog connections to one database, opened from a libpq connection string or borrowed from the caller """
+    def __init__(self, database):
+        """
+        :param database: A libpq connection string; a psycopg2 connection;
+                         a psycopg2 connection pool, or anything else with
+                         getconn and putconn methods; or a callable that
+                         returns a cursor whose rows are sequences.  A
+                         borrowed connection must not be in a transaction.
+                         The catalog is read in a read-only, repeatable
+                         read transaction that is rolled back when done,
+                         without changing the session settings.
+        """
+        self.database = database
+        self._cursors = []
+        self._opened = []
+        self._borrowed = []
+
+    def shares_snapshots(self):
+        """
+        Tells whether more connections can be had that share the snapshot
+        of the first, so that queries can be spread over them.  Cursors
+        from a factory may all be on one connection, so they cannot.
+
+        :returns: True for a connection string or a pool.
+        """
+        return isinstance(self.database, str) or hasattr(self.database, 'getconn')
+
+    def cursor(self, fetch_size=DEFAULT_FETCH_SIZE, stats=None, snapshot_id=None):
+        """
+        Opens a cursor for reading the catalog on a connection of its own,
+        or on the borrowed connection.
+
+        :param fetch_size: The number of rows to fetch at a time, or 0 to buffer whole results.  Cursors from a factory are used as they are.
+        :param stats: A QueryStats to record the queries run in, if any.
+        :param snapshot_id: An exported snapshot for the connection to share, if any.
+        :returns: The cursor.
+        """
+        database = self.database
+        if isinstance(database, str):
+            conn = connect(database, snapshot_id)
+            self._opened.append(conn)
+            cur = open_cursor(conn, fetch_size, stats)
+        elif isinstance(database, psycopg2.extensions.connection):
+            self._begin(database, None, snapshot_id)
+            cur = open_cursor(database, fetch_size, stats)
+        elif hasattr(database, 'getconn'):
+            conn = database.getconn()
+            try:
+                self._begin(conn, None, snapshot_id)
+            except Exception:
+                database.putconn(conn)
+                raise
+            cur = open_cursor(conn, fetch_size, stats)
+        else:
+            cur = database()
+            self._begin(cur.connection, cur, snapshot_id)
+            if stats is not None:
+                cur = InstrumentedCursor(cur, stats)
+        self._cursors.append(cur)
+        return cur
+
+    def _begin(self, conn, cur, snapshot_id):
+        if conn.status != psycopg2.extensions.STATUS_READY:
+            raise ValueError('Cannot read the catalog on a connection that is in a transaction')
+        # The connection is only kept for close to give back once it is set
+        # up; until then it is put back as it was here, and the caller gives
+        # a pool connection back.
+        autocommit = conn.autocommit
+        conn.autocommit = False
         try:
-            return next(_iter)
-        except StopIteration:
-            return None
-
-    _iter = iter(seq)
-    return _next
+            setup_cur = cur if cur is not None else conn.cursor()
+            try:
+                setup_cur.execute('set transaction isolation level repeatable read, read only;')
+                if snapshot_id:
+                    setup_cur.execute('set transaction snapshot %s;', (snapshot_id,))
+            finally:
+                if cur is None:
+                    setup_cur.close()
+        except Exception:
+            conn.rollback()
+            conn.autocommit = autocommit
+            raise
+        self._borrowed.append((conn, autocommit))
+
+    def close(self):
+        """
+        Closes the cursors, closes the connections that were opened and
+        gives back the borrowed ones, as they were.
+        """
+        for cur in self._cursors:
+            cur.close()
+        self._cursors = []
+        for conn in self._opened:
+            conn.close()
+        self._opened = []
+        for conn, autocommit in self._borrowed:
+            conn.rollback()
+            conn.autocommit = autocommit
+            if hasattr(self.database, 'getconn'):
+                self.database.putconn(conn)
+        self._borrowed = []
+
+def run_parallel(cursors, tasks):
+    """
+    Runs loader tasks on a set of cursors, one task per cursor at a time.
 
-def print_column_migration_ddl(source_table, source_column, target_column):
+    :param cursors: The cursors to run tasks on, each on its own connection.
+    :param tasks: A list of tuples of a loader function and its arguments other than the cursor.
     """
-    Prints the migration DDL for a column.
+    free_cursors = queue.Queue()
+    for cur in cursors:
+        free_cursors.put(cur)
 
-    N.B. This does not check that the DDL will work on data in the column.
+    def run(loader, *args):
+        cur = free_cursors.get()
+        try:
+            loader(cur, *args)
+        finally:
+            free_cursors.put(cur)
 
-    :param source_table: The table in the source schema.
-    :param source_column: The column in the source schema.
-    :param target_column: The column in the target schema.
-    """
-    if source_column != target_column:
-        print(target_column.alterstr())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(cursors)) as executor:
+        futures = [executor.submit(run, *task) for task in tasks]
+        for future in futures:
+            future.result()
 
-def print_grant_migration_ddl(source_object, source_grant, target_grant):
+def get_schema_objects_parallel(cursors, schemas, lazy=False, filters=None, columnar=False):
     """
-    Prints the migration DDL for a single grant on an object.
-
-    :param source_object: The object in the source schema.
-    :param source_grant: The grant on the object in the source schema.
-    :param target_grant: The grant on the object in the target schema.
+    Gets all objects in a list of schemas, spreading the per-schema
+    queries over several cursors.
+
+    :param cursors: The cursors to execute commands on, each on its own connection.
+    :param schemas: The schemas to get objects for.
+    :param lazy: Whether to get only the digests of function and view definitions.
+    :param filters: An ObjectFilter selecting the objects to get, if not all of them.
+    :param columnar: Whether to keep the columns of each schema's tables in a ColumnStore rather than as a Column each.
     """
-    revokes = set(source_grant.privilegestr) - set(target_grant.privilegestr)
-    grants = set(target_grant.privilegestr) - set(source_grant.privilegestr)
-
-    if revokes:
-        print(Grant(source_object, source_grant.role, "".join(revokes)).revokestr())
-
-    if grants:
-        print(Grant(source_object, source_grant.role, "".join(grants)).grantstr())
-
-def print_grants_migration_ddl(source_object, target_object):
+    if filters is None:
+        filters = ObjectFilter()
+    tasks = []
+    for schema in schemas:
+        if filters.reads_tables():
+            tasks.append((get_tables, schema, None, filters))
+        if filters.reads_views():
+            tasks.append((get_views, schema, None, lazy, filters))
+        if filters.reads_functions():
+            tasks.append((get_functions, schema, None, lazy, filters))
+    run_parallel(cursors, tasks)
+
+    # Columns must be loaded everywhere before constraints, since FKs may
+    # reference tables in other schemas.
+    all_tables = {table.oid: table for schema in schemas for table in schema.tables}
+    tasks = []
+    for schema in schemas:
+        tables = {table.oid: table for table in schema.tables}
+        tables_and_views = dict(tables)
+        tables_and_views.update((view.oid, view) for view in schema.views)
+        if filters.reads_columns():
+            tasks.append((get_all_columns, tables, columnar))
+        if filters.reads('triggers'):
+            tasks.append((get_all_triggers, tables_and_views))
+    run_parallel(cursors, tasks)
+
+    tasks = []
+    for schema in schemas:
+        tables = {table.oid: table for table in schema.tables}
+        if filters.reads_constraints():
+            tasks.append((get_all_constraints, tables, all_tables))
+        if filters.reads('indexes'):
+            tasks.append((get_all_indexes, tables))
+    run_parallel(cursors, tasks)
+
+    get_partitions(cursors[0], all_tables, filters, columnar)
+
+def get_selected_objects(cur, schemas, selected, filters=None):
     """
-    Prints the migration DDL for grants on an object.
+    Gets selected tables, views and functions, adding them to their
+    schemas.  Details of the tables and views are not read.
 
-    :param source_object: The object in the source schema.
-    :param target_object: The object in the target schema.
+    :param cur: A cursor to execute commands on.
+    :param schemas: The schemas the objects are in.
+    :param selected: A dict of lists of the oids to get, keyed by (schema oid, kind), where kind is 'r', 'v' or 'f'.
+    :param filters: An ObjectFilter selecting the kinds of objects to get, if not all of them.
+    :returns: A tuple of dicts of the tables and the views read, keyed by oid.
     """
-    next_source_grant = next_or_none(sorted(source_object.grants, key=lambda g: g.role))
-    next_target_grant = next_or_none(sorted(target_object.grants, key=lambda g: g.role))
-
-    source_grant = next_source_grant()
-    target_grant = next_target_grant()
+    tables = {}
+    views = {}
+    for schema in schemas:
+        oids = selected.get((schema.oid, 'r'))
+        if oids:
+            count = len(schema.tables)
+            get_tables(cur, schema, oids, filters)
+            tables.update((table.oid, table) for table in schema.tables[count:])
+        oids = selected.get((schema.oid, 'v'))
+        if oids:
+            count = len(schema.views)
+            get_views(cur, schema, oids, filters=filters)
+            views.update((view.oid, view) for view in schema.views[count:])
+        oids = selected.get((schema.oid, 'f'))
+        if oids:
+            get_functions(cur, schema, oids, filters=filters)
+    return tables, views
+
+def refresh_schema_objects(cur, schemas, cache, markers, filters=None):
+    """
+    Gets all objects in a list of schemas, reusing the objects in a cache
+    whose catalog version markers have not changed and reading only new
+    and changed objects from the database.
 
-    while source_grant or target_grant:
-        if not target_grant:
-            print(f'{source_grant.revokestr()}')
-            source_grant = next_source_grant()
+    :param cur: A cursor to execute commands on.
+    :param schemas: The schemas to get objects for.
+    :param cache: The cache of objects read earlier from the same database.
+    :param markers: The current catalog version markers, as returned by get_catalog_markers.
+    :param filters: An ObjectFilter selecting the kinds of objects to read, if not all of them.
+    """
+    # Reuse the cached Schema objects, which the kept objects refer to,
+    # unless the schema has been renamed.
+    cached_schemas = {schema.oid: schema for schema in cache.schemas}
+    for i, schema in enumerate(schemas):
+        cached_schema = cached_schemas.get(schema.oid)
+        if cached_schema is not None and cached_schema.name == schema.name:
+            schemas[i] = cached_schema
+    reused_schemas = {schema.oid for schema in schemas if cached_schemas.get(schema.oid) is schema}
+
+    cached_objects = {}
+    cached_partitions = {}
+    for schema in cache.schemas:
+        for obj in schema.tables + schema.views + schema.functions:
+            cached_objects[obj.oid] = obj
+        for table in schema.tables:
+            cached_partitions.update((partition.oid, partition) for partition in table.all_partitions())
+    for schema in schemas:
+        schema.clear()
+
+    changed = {}
+    kept_partitions = {}
+    for oid, schema_oid, kind, marker in markers:
+        if kind == 'p':
+            if oid in cached_partitions and cache.markers.get(oid) == marker:
+                kept_partitions[oid] = cached_partitions[oid]
+        elif schema_oid not in reused_schemas or oid not in cached_objects or cache.markers.get(oid) != marker:
+            changed.setdefault((schema_oid, kind), []).append(oid)
+
+    new_tables, new_views = get_selected_objects(cur, schemas, changed, filters)
+
+    # Put new and kept objects together in the order the loaders would have
+    # read them.
+    loaded = {}
+    for schema in schemas:
+        for obj in schema.tables + schema.views + schema.functions:
+            loaded[obj.oid] = obj
+        schema.clear()
+    schema_lookup = {schema.oid: schema for schema in schemas}
+    for oid, schema_oid, kind, marker in markers:
+        if kind == 'p':
             continue
-
-        if not source_grant:
-            print(f'{str(target_grant)}')
-            target_grant = next_target_grant()
+        schema = schema_lookup[schema_oid]
+        obj = loaded.get(oid) or cached_objects[oid]
+        if kind == 'r':
+            schema.add_table(obj)
+        elif kind == 'v':
+            schema.add_view(obj)
+        else:
+            schema.add_function(obj)
+
+    all_tables = {table.oid: table for schema in schemas for table in schema.tables}
+    if new_tables or new_views:
+        get_relation_details(cur, new_tables, new_views, all_tables, filters)
+    # The partitions are read again, reusing the unchanged ones, unless all
+    # of them are unchanged and still partition the same kept tables.
+    partition_oids = {oid for oid, schema_oid, kind, marker in markers if kind == 'p'}
+    kept_parents = {oid: table for oid, table in all_tables.items() if table.partitioned and oid not in new_tables}
+    if (any(table.partitioned for table in new_tables.values()) or len(kept_partitions) < len(partition_oids)
+            or {partition.oid for table in kept_parents.values() for partition in table.all_partitions()} != partition_oids):
+        kept = dict(kept_partitions)
+        kept.update(kept_parents)
+        get_partitions(cur, all_tables, filters, kept=kept)
+
+    # Kept FKs may reference tables that were read again.
+    partitions = [partition for table in all_tables.values() for partition in table.all_partitions()]
+    for table in list(all_tables.values()) + partitions:
+        if table.oid in new_tables:
             continue
+        for foreign_key in table.foreign_keys:
+            reftable = new_tables.get(foreign_key.reftable.oid) if foreign_key.reftable is not None else None
+            if reftable is not None:
+                foreign_key.reftable = reftable
+                foreign_key.refcolumns = reftable.get_columns([column.colnum for column in foreign_key.refcolumns])
 
-        if source_grant.role < target_grant.role:
-            print(f'{source_grant.revokestr()}')
-            source_grant = next_source_grant()
-            continue
+def get_schema_objects(database, jobs=1, cache=None, fetch_size=DEFAULT_FETCH_SIZE, lazy=False, filters=None, stats=None, columnar=False):
+    """
+    Gets all objects in all schemas.
+
+    :param database: A libpq connection string to a database, or a
+                     connection, pool or cursor factory; see ConnectionSource.
+    :param jobs: The number of connections to load schemas over in
+                 parallel.  Only for a connection string or a pool.
+    :param cache: A CatalogCache to reuse unchanged objects from, if it
+                  was filled from the same database, and to update with
+                  the objects read.
+    :param fetch_size: The number of catalog rows to fetch at a time, or 0 to buffer whole results.
+    :param lazy: Whether to get only the digests of function and view
+                 definitions; see get_definitions.  Not with a cache.
+    :param filters: An ObjectFilter selecting the schemas, tables and
+                    views and the kinds of objects to get, if not all of
+                    them.  A cache must have been filled with the same
+                    object kinds.
+    :param stats: A QueryStats to record the queries run in, if any.
+    :param columnar: Whether to keep table columns in ColumnStores rather
+                     than as a Column each, which takes less memory for
+                     large catalogs.  Objects read again to refresh a cache
+                     are not.
+    :returns: A list of schemas.
+    """
+    if filters is None:
+        filters = ObjectFilter()
+    source = ConnectionSource(database)
+    try:
+        cursors = [source.cursor(fetch_size, stats)]
+        schemas = []
+        identity = get_database_identity(cursors[0]) if cache is not None else None
+        get_schemas(cursors[0], schemas, filters)
+        if cache is not None and cache.identity == identity:
+            markers = get_catalog_markers(cursors[0], schemas, filters)
+            refresh_schema_objects(cursors[0], schemas, cache, markers, filters)
+        else:
+            if jobs > 1 and source.shares_snapshots():
+                execute_query(cursors[0], 'export_snapshot', 'select pg_export_snapshot();')
+                snapshot_id = cursors[0].fetchone()[0]
+                for _ in range(jobs - 1):
+                    cursors.append(source.cursor(fetch_size, stats, snapshot_id))
+                get_schema_objects_parallel(cursors, schemas, lazy, filters, columnar)
+            else:
+                cur = cursors[0]
+                for schema in schemas:
+                    if filters.reads_tables():
+                        get_tables(cur, schema, filters=filters)
+                    if filters.reads_views():
+                        get_views(cur, schema, lazy=lazy, filters=filters)
+                    if filters.reads_functions():
+                        get_functions(cur, schema, lazy=lazy, filters=filters)
+                tables = {table.oid: table for schema in schemas for table in schema.tables}
+                views = {view.oid: view for schema in schemas for view in schema.views}
+                get_relation_details(cur, tables, views, filters=filters, columnar=columnar)
+                get_partitions(cur, tables, filters, columnar)
+            if cache is not None:
+                markers = get_catalog_markers(cursors[0], schemas, filters)
+        if cache is not None:
+            cache.identity = identity
+            cache.schemas = schemas
+            cache.markers = {marker[0]: marker[3] for marker in markers}
+        return schemas
+    finally:
+        source.close()
+
+def load_definitions(database, objects, fetch_size=DEFAULT_FETCH_SIZE, stats=None):
+    """
+    Gets the definitions of functions and views that were read with only
+    their digests.
 
-        if source_grant.role > target_grant.role:
-            print(f'{str(target_grant)}')
-            target_grant = next_target_grant()
+    :param database: A libpq connection string to the database the objects were read from, or a connection, pool or cursor factory; see ConnectionSource.
+    :param objects: The functions and views to get definitions for.
+    :param fetch_size: The number of catalog rows to fetch at a time, or 0 to buffer whole results.
+    :param stats: A QueryStats to record the queries run in, if any.
+    """
+    functions = {obj.oid: obj for obj in objects if isinstance(obj, Function)}
+    views = {obj.oid: obj for obj in objects if isinstance(obj, View)}
+    if not functions and not views:
+        return
+    source = ConnectionSource(database)
+    try:
+        get_definitions(source.cursor(fetch_size, stats), functions, views)
+    finally:
+        source.close()
+
+def _get_schemas_and_fingerprints(cur, filters):
+    schemas = []
+    get_schemas(cur, schemas, filters)
+    return schemas, get_fingerprints(cur, schemas, filters)
+
+def _select_by_fingerprint(schemas, fingerprints, other_schemas, other_fingerprints, skip_unmatched_schemas):
+    # Selects the objects whose fingerprints differ from, or are missing
+    # in, the other database.
+    schema_names = {schema.oid: schema.name for schema in schemas}
+    other_schema_names = {schema.oid: schema.name for schema in other_schemas}
+    other = {}
+    for oid, schema_oid, kind, name, argtypes, fingerprint in other_fingerprints:
+        other[(other_schema_names[schema_oid], kind, name, tuple(argtypes or ()))] = fingerprint
+    matched_schemas = set(other_schema_names.values())
+    selected = {}
+    for oid, schema_oid, kind, name, argtypes, fingerprint in fingerprints:
+        schema_name = schema_names[schema_oid]
+        if skip_unmatched_schemas and schema_name not in matched_schemas:
             continue
+        if other.get((schema_name, kind, name, tuple(argtypes or ()))) != fingerprint:
+            selected.setdefault((schema_oid, kind), []).append(oid)
+    return selected
+
+def _get_selected_objects_and_details(cur, schemas, selected, filters):
+    tables, views = get_selected_objects(cur, schemas, selected, filters)
+    get_relation_details(cur, tables, views, filters=filters)
+    get_partitions(cur, tables, filters)
+
+def get_schema_objects_two_phase(source_database, target_database, fetch_size=DEFAULT_FETCH_SIZE, filters=None, stats=None):
+    """
+    Gets the objects of two databases that differ.  The first phase reads
+    only a server-side fingerprint of each table, view and function; the
+    second reads in full only the objects whose fingerprints differ or
+    that exist in one database only.  Objects that are the same in both
+    are left out of both lists of schemas, as are the contents of source
+    schemas the target lacks, so the result is only fit for diffing.
+
+    :param source_database: A libpq connection string to the source database, or a connection, pool or cursor factory; see ConnectionSource.
+    :param target_database: The same for the target database.
+    :param fetch_size: The number of catalog rows to fetch at a time, or 0 to buffer whole results.
+    :param filters: An ObjectFilter selecting the schemas, tables and views to compare, if not all of them.
+    :param stats: A QueryStats to record the queries run in, if any.
+    :returns: A tuple of the source and target lists of schemas.
+    """
+    sources = [ConnectionSource(source_database), ConnectionSource(target_database)]
+    try:
+        cursors = [source.cursor(fetch_size, stats) for source in sources]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            (source_schemas, source_fingerprints), (target_schemas, target_fingerprints) = executor.map(_get_schemas_and_fingerprints, cursors, (filters, filters))
+            source_selected = _select_by_fingerprint(source_schemas, source_fingerprints, target_schemas, target_fingerprints, True)
+            target_selected = _select_by_fingerprint(target_schemas, target_fingerprints, source_schemas, source_fingerprints, False)
+            list(executor.map(_get_selected_objects_and_details, cursors, (source_schemas, target_schemas), (source_selected, target_selected), (filters, filters)))
+        return source_schemas, target_schemas
+    finally:
+        for source in sources:
+            source.close()
 
-        print_grant_migration_ddl(source_object, source_grant, target_grant)
-        source_grant = next_source_grant()
-        target_grant = next_target_grant()
+############################################################################
+# FUNCTIONS FOR SNAPSHOT FILES
+############################################################################
 
-# def print_unique_key_migration_ddl(source_unique_key, target_unique_key):
-#     if source_unique_key != target_unique_key:
-#         print(source_unique_key.dropstr())
-#         print(target_unique_key.addstr())
+SNAPSHOT_MAGIC = b'xpgdiff-snapshot'
 
-# def print_check_migration_ddl(source_check, target_check):
-#     if source_check != target_check:
-#         print(source_check.dropstr())
-#         print(target_check.addstr())
+# Bump whenever the model classes change in a way that old pickles cannot
+# be loaded into.
+SNAPSHOT_VERSION = 8
 
-# def print_trigger_migration_ddl(source_trigger, target_trigger):
-#     if source_trigger != target_trigger:
-#         print(source_trigger.dropstr())
-#         print(target_trigger.addstr())
+def save_snapshot(path, cache):
+    """
+    Saves the objects read from a database to a snapshot file, so that
+    they can later be diffed without connecting to the database, or
+    refreshed by reading only what has changed.
 
-# def print_index_migration_ddl(source_index, target_index):
-#     if source_index != target_index:
-#         print(source_index.dropstr())
-#         print(target_index.addstr())
+    The file is a one-line header with the format version followed by
+    the compressed, pickled CatalogCache.  As with any pickle, only load
+    snapshot files from a trusted source.
 
-def print_dropadd_migration_ddl(source_objs, target_objs):
+    :param path: The path of the snapshot file.
+    :param cache: The CatalogCache to save.
     """
-    Prints migration DDL for objects that are always drop or add.
-    The class for the objects must have a name field; addstr and dropstr
-    methods; and a meaningful implementation of __eq__.
+    data = zlib.compress(pickle.dumps(cache, protocol=pickle.HIGHEST_PROTOCOL), 1)
+    with open(path, 'wb') as f:
+        f.write(b'%s %d\n' % (SNAPSHOT_MAGIC, SNAPSHOT_VERSION))
+        f.write(data)
+
+def load_snapshot(path):
+    """
+    Loads the objects read from a database from a snapshot file.
+
+    :param path: The path of the snapshot file.
+    :returns: A CatalogCache.
+    """
+    with open(path, 'rb') as f:
+        header = f.readline().split()
+        if len(header) != 2 or header[0] != SNAPSHOT_MAGIC:
+            raise ValueError(f'{path} is not an xpgdiff snapshot')
+        if int(header[1]) != SNAPSHOT_VERSION:
+            raise ValueError(f'{path} is snapshot version {int(header[1])}, expected {SNAPSHOT_VERSION}')
+        data = f.read()
+    # The model is a large graph of small objects that contains no garbage;
+    # cyclic GC passes triggered while building it are pure overhead.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return pickle.loads(zlib.decompress(data))
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+############################################################################
+# FUNCTIONS FOR GENERATING MIGRATION DDL
+############################################################################
+
+class Statement(str):
+    """
+    A DDL statement that creates, drops or alters one object.  It is a
+    str, so it prints like any other statement, and keeps the object for
+    working out which statements depend on which; see migration_graph.
+    """
+    def __new__(cls, text, obj, action):
+        statement = super().__new__(cls, text)
+        statement.obj = obj
+        statement.action = action
+        return statement
+
+def _statements(texts, obj, action):
+    for text in texts:
+        yield Statement(text, obj, action)
+
+class ObjectDiff:
+    """ The objects in two collections, matched by identity key """
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.changed = []
+        self.unchanged = []
+
+def identity_key(obj):
+    """
+    Gets the key that identifies an object in either database: the schema
+    name and name for tables and views, plus the argument types for
+    functions, and the name for anything else.
 
-    The passed sequences must already be sorted by name.
+    :param obj: The object.
+    :returns: The key.
+    """
+    if isinstance(obj, Function):
+        return (obj.schema.name, obj.name, tuple(obj.argtypes))
+    if isinstance(obj, (Table, View)):
+        return (obj.schema.name, obj.name)
+    return obj.name
+
+def diff_objects(source_objs, target_objs, key=identity_key, same=None):
+    """
+    Matches the objects in two collections by identity key, in time linear
+    in their size and without sorting them.
 
     :param source_objs: The objects in the source schema.
     :param target_objs: The objects in the target schema.
+    :param key: A function that gets the identity key of an object.
+    :param same: A function that tells whether a matched source and target
+                 object are the same; if None, every matched pair is
+                 reported as changed for the caller to compare in detail.
+    :returns: An ObjectDiff whose added and removed lists are in target and
+              source order, and whose changed and unchanged lists hold
+              (source, target) pairs in source order.
     """
+    diff = ObjectDiff()
+    targets = {key(target_obj): target_obj for target_obj in target_objs}
+    matched = set()
+    for source_obj in source_objs:
+        source_key = key(source_obj)
+        target_obj = targets.get(source_key)
+        if target_obj is None:
+            diff.removed.append(source_obj)
+            continue
+        matched.add(source_key)
+        if same is not None and same(source_obj, target_obj):
+            diff.unchanged.append((source_obj, target_obj))
+        else:
+            diff.changed.append((source_obj, target_obj))
+    if len(matched) < len(targets):
+        diff.added = [target_obj for target_key, target_obj in targets.items() if target_key not in matched]
+    return diff
 
-    next_source_obj = next_or_none(source_objs)
-    next_target_obj = next_or_none(target_objs)
+# Type changes that PostgreSQL makes without rewriting the table, since
+# the types are binary coercible, as (source, target) pg_type.typname
+# pairs; the target must not have a length limit.
+_BINARY_COERCIBLE_TYPES = {('varchar', 'text'), ('text', 'varchar'), ('xml', 'text'), ('cidr', 'inet')}
 
-    source_obj = next_source_obj()
-    target_obj = next_target_obj()
+# Types whose typmod can be widened or removed without a rewrite, since
+# the values already fit; numeric is handled on its own.
+_WIDENABLE_TYPES = ('varchar', 'varbit', 'time', 'timestamp', 'timestamptz')
 
-    while source_obj or target_obj:
-        if not target_obj:
-            print(source_obj.dropstr())
-            source_obj = next_source_obj()
-            continue
+def type_change_rewrites(source_column, target_column):
+    """
+    Tells whether changing the type of a column rewrites its table.
+    Widening varchar(n) or the precision of numeric, time and timestamp
+    values, or removing the limit, only changes the catalog, as does a
+    change between binary coercible types such as varchar and text.
 
-        if not source_obj:
-            print(target_obj.addstr())
-            target_obj = next_target_obj()
-            continue
+    :param source_column: The column in the source schema.
+    :param target_column: The column in the target schema.
+    :returns: True if the table is rewritten, and its indexes on the column rebuilt.
+    """
+    if source_column.ndims != target_column.ndims:
+        return True
+    if source_column.type != target_column.type:
+        return (source_column.type, target_column.type) not in _BINARY_COERCIBLE_TYPES or target_column.typmod != -1
+    if source_column.typmod == target_column.typmod:
+        return False
+    # Arrays are coerced element by element, which is not simplified away.
+    if source_column.ndims or source_column.typmod == -1:
+        return True
+    if target_column.typmod == -1:
+        return source_column.type not in _WIDENABLE_TYPES + ('numeric',)
+    if source_column.type == 'numeric':
+        source_precision, source_scale = numeric_precision_scale(source_column.typmod)
+        target_precision, target_scale = numeric_precision_scale(target_column.typmod)
+        return target_scale != source_scale or target_precision < source_precision
+    return source_column.type not in _WIDENABLE_TYPES or target_column.typmod < source_column.typmod
+
+def column_migration_ddl(source_table, source_column, target_column):
+    """
+    Generates the migration DDL for a column.
 
-        if source_obj.name < target_obj.name:
-            print(source_obj.dropstr())
-            source_obj = next_source_obj()
-            continue
+    N.B. This does not check that the DDL will work on data in the column.
 
-        if source_obj.name > target_obj.name:
-            print(target_obj.addstr())
-            target_obj = next_target_obj()
-            continue
+    :param source_table: The table in the source schema.
+    :param source_column: The column in the source schema.
+    :param target_column: The column in the target schema.
+    :returns: A generator of DDL statements.
+    """
+    if source_column != target_column:
+        yield from target_column.alterstrs(source_column)
+
+def grant_migration_ddl(source_object, source_grant, target_grant):
+    """
+    Generates the migration DDL for a single grant on an object.
+
+    :param source_object: The object in the source schema.
+    :param source_grant: The grant on the object in the source schema.
+    :param target_grant: The grant on the object in the target schema.
+    :returns: A generator of DDL statements.
+    """
+    revokes = source_grant.privileges & ~target_grant.privileges
+    # Grant options are revoked from the privileges that are kept, and
+    # granted for new privileges and kept ones alike.
+    revoke_options = source_grant.grantable & ~target_grant.grantable & target_grant.privileges
+    grants = target_grant.privileges & ~source_grant.privileges & ~target_grant.grantable
+    grant_options = target_grant.grantable & ~source_grant.grantable
 
-        if source_obj != target_obj:
-            print('Yes')
-            print(source_obj.dropstr())
-            print(target_obj.addstr())
+    if revokes:
+        yield Grant(source_object, source_grant.role, revokes).revokestr()
 
-        source_obj = next_source_obj()
-        target_obj = next_target_obj()
+    if revoke_options:
+        yield Grant(source_object, source_grant.role, revoke_options).revokestr(grant_option=True)
 
-def print_table_migration_ddl(source_table, target_table):
+    if grants or grant_options:
+        yield from Grant(source_object, source_grant.role, grants | grant_options, grant_options).grantstrs()
+
+def grants_migration_ddl(source_object, target_object):
     """
-    Prints DDL to migrate a table in one schema to the structure in
-    another schema, including columns, constraints, indexes, triggers
-    and permissions.
+    Generates the migration DDL for grants on an object.
 
-    N.B. The migration does not enforce identical column ordering.
+    :param source_object: The object in the source schema.
+    :param target_object: The object in the target schema.
+    :returns: A generator of DDL statements.
+    """
+    diff = diff_objects(source_object.grants, target_object.grants, key=lambda g: g.role)
+    for source_grant in diff.removed:
+        yield source_grant.revokestr()
+    for source_grant, target_grant in diff.changed:
+        yield from grant_migration_ddl(source_object, source_grant, target_grant)
+    for target_grant in diff.added:
+        yield from target_grant.grantstrs()
+
+def _addstrs(obj, online):
+    return obj.online_addstrs() if online and hasattr(obj, 'online_addstrs') else [obj.addstr()]
+
+def _dropstr(obj, online):
+    return obj.online_dropstr() if online and hasattr(obj, 'online_dropstr') else obj.dropstr()
+
+def dropadd_migration_ddl(source_objs, target_objs, online=False):
+    """
+    Generates migration DDL for objects that are always drop or add.
+    The class for the objects must have a name field; addstr and dropstr
+    methods; and a meaningful implementation of __eq__.  For online
+    migrations, objects with online_addstrs and online_dropstr methods
+    are added and dropped with those.
+
+    :param source_objs: The objects in the source schema.
+    :param target_objs: The objects in the target schema.
+    :param online: Whether to add and drop objects without blocking writes where possible.
+    :returns: A generator of DDL statements.
+    """
+    diff = diff_objects(source_objs, target_objs, same=operator.eq)
+    for source_obj in diff.removed:
+        yield _dropstr(source_obj, online)
+    for source_obj, target_obj in diff.changed:
+        yield _dropstr(source_obj, online)
+        yield from _addstrs(target_obj, online)
+    for target_obj in diff.added:
+        yield from _addstrs(target_obj, online)
+
+def columns_equal(source_table, target_table):
+    """
+    Tells whether two tables' columns are the same, without comparing
+    them one by one where both tables' columns are in ColumnStores.
 
     :param source_table: The source table.
     :param target_table: The target table.
+    :returns: True if they are known to be the same; False if they differ or must be compared one by one.
     """
-    next_source_column = next_or_none(sorted(source_table.columns, key=lambda c: c.name))
-    next_target_column = next_or_none(sorted(target_table.columns, key=lambda c: c.name))
+    if source_table.column_store is None or target_table.column_store is None:
+        return False
+    return source_table.column_store.signature(source_table) == target_table.column_store.signature(target_table)
 
-    source_column = next_source_column()
-    target_column = next_target_column()
+def columns_constraints_migration_ddl(source_table, target_table, filters, online=False):
+    """
+    Generates DDL to migrate the columns and constraints of a table,
+    other than foreign keys, one statement per change.
 
-    while source_column or target_column:
-        if not target_column:
-            print(source_column.dropstr())
-            source_column = next_source_column()
-            continue
+    :param source_table: The source table.
+    :param target_table: The target table.
+    :param filters: An ObjectFilter selecting the kinds of objects to diff.
+    :param online: Whether to build indexes concurrently and validate constraints separately.
+    :returns: A generator of DDL statements.
+    """
+    if filters.reads('columns') and not columns_equal(source_table, target_table):
+        diff = diff_objects(source_table.columns, target_table.columns)
+        for source_column in diff.removed:
+            yield source_column.dropstr()
+        for source_column, target_column in diff.changed:
+            yield from column_migration_ddl(source_table, source_column, target_column)
+        for target_column in diff.added:
+            yield target_column.addstr()
+
+    if filters.reads('constraints'):
+        yield from primary_key_migration_ddl(source_table.primary_key, target_table.primary_key, online)
+        yield from dropadd_migration_ddl(source_table.unique_keys, target_table.unique_keys, online)
+        yield from dropadd_migration_ddl(source_table.checks, target_table.checks, online)
+
+def primary_key_migration_ddl(source_primary_key, target_primary_key, online=False):
+    """
+    Generates DDL to migrate the primary key of a table.
 
-        if not source_column:
-            print(target_column.addstr())
-            target_column = next_target_column()
-            continue
+    :param source_primary_key: The primary key in the source schema, or None.
+    :param target_primary_key: The primary key in the target schema, or None.
+    :param online: Whether to build the index concurrently.
+    :returns: A generator of DDL statements.
+    """
+    if source_primary_key is None and target_primary_key is not None:
+        yield from _addstrs(target_primary_key, online)
+    elif source_primary_key is not None and target_primary_key is None:
+        yield source_primary_key.dropstr()
+    elif source_primary_key is not None and target_primary_key is not None:
+        if source_primary_key != target_primary_key:
+            yield source_primary_key.dropstr()
+            yield from _addstrs(target_primary_key, online)
+
+def alter_table_str(table, clauses):
+    """
+    Gets an ALTER TABLE statement that makes several changes to a table.
 
-        if source_column.name < target_column.name:
-            print(source_column.dropstr())
-            source_column = next_source_column()
-            continue
+    :param table: The table.
+    :param clauses: The ADD, DROP and ALTER clauses, without a trailing semicolon.
+    :returns: The statement, on one line for a single clause and with a line per clause otherwise.
+    """
+    if len(clauses) == 1:
+        return f'ALTER TABLE {table.fullname} {clauses[0]};'
+    return f'ALTER TABLE {table.fullname}\n  ' + ',\n  '.join(clauses) + ';'
 
-        if source_column.name > target_column.name:
-            print(target_column.addstr())
-            target_column = next_target_column()
+def coalesced_alter_table_ddl(table, statements):
+    """
+    Merges runs of ALTER TABLE statements on a table into one statement
+    with a clause for each, so that PostgreSQL locks the table once for
+    all of them and rewrites it at most once.  Any other statement ends a
+    run, as does VALIDATE CONSTRAINT, which must run on its own so that
+    it does not hold the lock the other clauses take.
+
+    :param table: The table.
+    :param statements: The DDL statements.
+    :returns: A generator of DDL statements.
+    """
+    prefix = f'ALTER TABLE {table.fullname} '
+    clauses = []
+    for statement in statements:
+        clause = statement[len(prefix):-1]
+        if statement.startswith(prefix) and statement.endswith(';') and not clause.startswith('VALIDATE CONSTRAINT '):
+            clauses.append(clause)
             continue
+        if clauses:
+            yield alter_table_str(table, clauses)
+            clauses = []
+        yield statement
+    if clauses:
+        yield alter_table_str(table, clauses)
+
+def table_migration_ddl(source_table, target_table, filters=None, online=False):
+    """
+    Generates DDL to migrate a table in one schema to the structure in
+    another schema, including columns, constraints, indexes, triggers,
+    permissions and partitions.  Foreign keys are left to
+    tables_migration_ddl.
+    Column and constraint changes are made in one ALTER TABLE where they
+    can be; see coalesced_alter_table_ddl.
 
-        print_column_migration_ddl(source_table, source_column, target_column)
-        source_column = next_source_column()
-        target_column = next_target_column()
+    N.B. The migration does not enforce identical column ordering.
 
-    if source_table.primary_key is None and target_table.primary_key is not None:
-        print(f'{str(target_table.primary_key)};')
-    elif source_table.primary_key is not None and target_table.primary_key is None:
-        print(source_table.primary_key.dropstr())
-    elif source_table.primary_key is not None and target_table.primary_key is not None:
-        if source_table.primary_key != target_table.primary_key:
-            print(source_table.primary_key.dropstr())
-            print(target_table.primary_key.addstr())
+    :param source_table: The source table.
+    :param target_table: The target table.
+    :param filters: An ObjectFilter selecting the kinds of objects to diff, if not all of them.
+    :param online: Whether to build indexes concurrently and validate constraints separately.
+    :returns: A generator of DDL statements.
+    """
+    if filters is None:
+        filters = ObjectFilter()
+    yield from coalesced_alter_table_ddl(target_table, columns_constraints_migration_ddl(source_table, target_table, filters, online))
+    if filters.reads('indexes'):
+        yield from dropadd_migration_ddl(source_table.get_non_constraint_indexes(), target_table.get_non_constraint_indexes(), online)
+    if filters.reads('triggers'):
+        yield from dropadd_migration_ddl(source_table.get_non_constraint_triggers(), target_table.get_non_constraint_triggers())
+
+    if filters.reads('grants'):
+        yield from grants_migration_ddl(source_table, target_table)
+    if filters.reads('tables') and source_table.owner != target_table.owner:
+        yield target_table.ownerstr()
+    if source_table.partitioned or target_table.partitioned:
+        yield from partitions_migration_ddl(source_table, target_table, filters, online)
+
+def partitions_migration_ddl(source_table, target_table, filters, online=False):
+    """
+    Generates DDL to migrate the partitions of a partitioned table,
+    matched by name.  Whatever a partition has because its parent has it
+    is migrated with the parent, so a partition with its parent's shape
+    in both databases only has its bound, grants and owner compared.
+    Changing the partition key is left to be done by hand, as the table
+    must be created again.
 
-    print_dropadd_migration_ddl(source_table.unique_keys, target_table.unique_keys)
-    print_dropadd_migration_ddl(source_table.checks, target_table.checks)
-    print_dropadd_migration_ddl(source_table.get_non_constraint_indexes(), target_table.get_non_constraint_indexes())
-    print_dropadd_migration_ddl(source_table.get_non_constraint_triggers(), target_table.get_non_constraint_triggers())
+    :param source_table: The source table.
+    :param target_table: The target table.
+    :param filters: An ObjectFilter selecting the kinds of objects to diff.
+    :param online: Whether to build indexes concurrently and validate constraints separately.
+    :returns: A generator of DDL statements.
+    """
+    if source_table.partition_key != target_table.partition_key:
+        yield f'-- {target_table.fullname} must be created again to change its partition key from {source_table.partition_key or "none"} to {target_table.partition_key or "none"}'
+        return
+    diff = diff_objects(source_table.partitions, target_table.partitions)
+    if filters.reads('tables'):
+        for source_partition in diff.removed:
+            yield source_partition.dropstr()
+    for source_partition, target_partition in diff.changed:
+        yield from partition_migration_ddl(source_partition, target_partition, filters, online)
+    if filters.reads('tables'):
+        for target_partition in diff.added:
+            yield str(target_partition)
+
+def partition_columns_migration_ddl(source_partition, target_partition):
+    """
+    Generates DDL to migrate the NOT NULL constraints and defaults of a
+    partition's columns that are not its parent's.  A partition has its
+    parent's columns, and migrating the parent changes them on the
+    partition as well, so each column is migrated from what that leaves
+    it as: the target parent's for what changed on the parent, and the
+    source partition's for the rest.
+
+    :param source_partition: The source partition.
+    :param target_partition: The target partition.
+    :returns: A generator of DDL statements.
+    """
+    source_columns = {column.name: column for column in source_partition.defining_table().columns}
+    source_parent_columns = {column.name: column for column in source_partition.parent.defining_table().columns}
+    target_parent_columns = {column.name: column for column in target_partition.parent.defining_table().columns}
+    for column in target_partition.defining_table().columns:
+        target_parent_column = target_parent_columns.get(column.name)
+        if target_parent_column is None:
+            continue
+        source_column = source_columns.get(column.name)
+        source_parent_column = source_parent_columns.get(column.name)
+        if source_column is None or source_parent_column is None:
+            # The column is added to the parent, and so to the partition
+            # as it is on the parent.
+            migrated = target_parent_column
+        else:
+            values = [getattr(target_parent_column if getattr(source_parent_column, attribute) != getattr(target_parent_column, attribute) else source_column, attribute)
+                      for attribute in ('type', 'notnull', 'default', 'ndims', 'typmod')]
+            migrated = Column(target_partition, column.colnum, column.name, values[0], values[1], values[2], column.sequence_name, values[3], values[4])
+        if column != migrated:
+            # The target column may be the parent's, when the target
+            # partition matches it.
+            column = Column(target_partition, column.colnum, column.name, column.type, column.notnull, column.default, column.sequence_name, column.ndims, column.typmod)
+            yield from column.alterstrs(migrated)
+
+def partition_migration_ddl(source_partition, target_partition, filters, online=False):
+    """
+    Generates DDL to migrate a partition: its bound, the column NOT NULL
+    constraints and defaults, keys, checks, indexes and triggers it has
+    that its parent does not, its grants and owner, and its own
+    partitions.  Foreign keys are left to tables_migration_ddl.
+
+    :param source_partition: The source partition.
+    :param target_partition: The target partition.
+    :param filters: An ObjectFilter selecting the kinds of objects to diff.
+    :param online: Whether to build indexes concurrently and validate constraints separately.
+    :returns: A generator of DDL statements.
+    """
+    if filters.reads('tables') and source_partition.partition_bound != target_partition.partition_bound:
+        parent = target_partition.parent
+        yield f'ALTER TABLE {parent.fullname} DETACH PARTITION {source_partition.fullname};'
+        yield f'ALTER TABLE {parent.fullname} ATTACH PARTITION {target_partition.fullname} {target_partition.partition_bound};'
+    deviates = not (source_partition.matches_parent() and target_partition.matches_parent())
+    statements = []
+    # Migrating the parent changes the columns of a partition with the
+    # same shape in both databases as well, so they are always looked at.
+    if deviates and filters.reads('columns'):
+        statements.append(partition_columns_migration_ddl(source_partition, target_partition))
+    if deviates and source_partition.shape != target_partition.shape:
+        source_primary_key, source_unique_keys, _ = source_partition.get_local_constraints()
+        target_primary_key, target_unique_keys, _ = target_partition.get_local_constraints()
+        source_checks, source_indexes, source_triggers = source_partition.get_local_objects()
+        target_checks, target_indexes, target_triggers = target_partition.get_local_objects()
+        if filters.reads('constraints'):
+            statements.append(primary_key_migration_ddl(source_primary_key, target_primary_key, online))
+            statements.append(dropadd_migration_ddl(source_unique_keys, target_unique_keys, online))
+            statements.append(dropadd_migration_ddl(source_checks, target_checks, online))
+    yield from coalesced_alter_table_ddl(target_partition, itertools.chain.from_iterable(statements))
+    if deviates and source_partition.shape != target_partition.shape:
+        if filters.reads('indexes'):
+            yield from dropadd_migration_ddl(source_indexes, target_indexes, online)
+        if filters.reads('triggers'):
+            yield from dropadd_migration_ddl(source_triggers, target_triggers)
+    if filters.reads('grants'):
+        yield from grants_migration_ddl(source_partition, target_partition)
+    if filters.reads('tables') and source_partition.owner != target_partition.owner:
+        yield target_partition.ownerstr()
+    if source_partition.partitioned or target_partition.partitioned:
+        yield from partitions_migration_ddl(source_partition, target_partition, filters, online)
+
+def partition_foreign_keys(table):
+    """
+    Gets the foreign keys that the partitions of a table, and their
+    partitions in turn, have of their own.
 
-    print_grants_migration_ddl(source_table, target_table)
-    if (source_table.owner != target_table.owner):
-        print(target_table.ownerstr())
+    :param table: The table.
+    :returns: A list of foreign keys.
+    """
+    foreign_keys = []
+    for partition in table.partitions:
+        foreign_keys.extend(partition.get_local_constraints()[2])
+        foreign_keys.extend(partition_foreign_keys(partition))
+    return foreign_keys
 
-def print_tables_migration_ddl(source_schema, target_schema):
+def partition_foreign_key_diffs(source_table, target_table):
     """
-    Prints DDL to migrate the tables in two schemas.
+    Matches the foreign keys that the partitions of a table, and their
+    partitions in turn, have of their own, for partitions in both
+    databases; see partitions_migration_ddl.
+
+    :param source_table: The source table.
+    :param target_table: The target table.
+    :returns: A tuple of a list of ObjectDiffs of the foreign keys of partitions in both databases, and a list of the foreign keys of partitions added.
+    """
+    if source_table.partition_key != target_table.partition_key:
+        return [], []
+    diff = diff_objects(source_table.partitions, target_table.partitions)
+    foreign_key_diffs = []
+    added_foreign_keys = []
+    for source_partition, target_partition in diff.changed:
+        foreign_key_diffs.append(diff_objects(source_partition.get_local_constraints()[2], target_partition.get_local_constraints()[2], same=operator.eq))
+        partition_diffs, partition_added = partition_foreign_key_diffs(source_partition, target_partition)
+        foreign_key_diffs.extend(partition_diffs)
+        added_foreign_keys.extend(partition_added)
+    for target_partition in diff.added:
+        added_foreign_keys.extend(target_partition.get_local_constraints()[2])
+        added_foreign_keys.extend(partition_foreign_keys(target_partition))
+    return foreign_key_diffs, added_foreign_keys
+
+def tables_migration_ddl(source_schema, target_schema, filters=None, online=False):
+    """
+    Generates DDL to migrate the tables in two schemas.  Foreign keys,
+    including those partitions have of their own, are dropped before,
+    and added after, everything else, so that the keys they reference
+    are in place.
 
     :param source_schema: The source schema.
     :param target_schema: The target schema.
+    :param filters: An ObjectFilter selecting the kinds of objects to diff, if not all of them.
+    :param online: Whether to build indexes concurrently and validate constraints separately.
+    :returns: A generator of DDL statements.
+    """
+    if filters is None:
+        filters = ObjectFilter()
+    yield '--'
+    yield '-- TABLES'
+    yield '--'
+    diff = diff_objects(source_schema.tables, target_schema.tables)
+    foreign_key_diffs = []
+    new_partition_foreign_keys = []
+    if filters.reads('constraints'):
+        for source_table, target_table in diff.changed:
+            foreign_key_diffs.append(diff_objects(source_table.foreign_keys, target_table.foreign_keys, same=operator.eq))
+            if source_table.partitioned and target_table.partitioned:
+                partition_diffs, partition_added = partition_foreign_key_diffs(source_table, target_table)
+                foreign_key_diffs.extend(partition_diffs)
+                new_partition_foreign_keys.extend(partition_added)
+        for foreign_key_diff in foreign_key_diffs:
+            for source_foreign_key in foreign_key_diff.removed:
+                yield Statement(source_foreign_key.dropstr(), source_foreign_key, 'drop')
+            for source_foreign_key, target_foreign_key in foreign_key_diff.changed:
+                yield Statement(source_foreign_key.dropstr(), source_foreign_key, 'drop')
+    if filters.reads('tables'):
+        for source_table in diff.removed:
+            yield Statement(source_table.dropstr(), source_table, 'drop')
+    for source_table, target_table in diff.changed:
+        yield from _statements(table_migration_ddl(source_table, target_table, filters, online), target_table, 'alter')
+    if filters.reads('tables'):
+        for target_table in diff.added:
+            yield Statement(str(target_table), target_table, 'create')
+    if filters.reads('constraints'):
+        added_foreign_keys = []
+        for foreign_key_diff in foreign_key_diffs:
+            added_foreign_keys.extend(target_foreign_key for source_foreign_key, target_foreign_key in foreign_key_diff.changed)
+            added_foreign_keys.extend(foreign_key_diff.added)
+        for foreign_key in added_foreign_keys:
+            yield from _statements(_addstrs(foreign_key, online), foreign_key, 'create')
+        if filters.reads('tables'):
+            # New tables and partitions are empty, so there is nothing to
+            # validate.
+            for foreign_key in new_partition_foreign_keys:
+                yield Statement(foreign_key.addstr(), foreign_key, 'create')
+            for target_table in diff.added:
+                for foreign_key in target_table.foreign_keys + partition_foreign_keys(target_table):
+                    yield Statement(foreign_key.addstr(), foreign_key, 'create')
+
+def views_migration_ddl(source_schema, target_schema, filters=None):
     """
-    print('--')
-    print('-- TABLES')
-    print('--')
-    next_source_table = next_or_none(source_schema.tables)
-    next_target_table = next_or_none(target_schema.tables)
+    Generates DDL to migrate the views in two schemas.
 
-    source_table = next_source_table()
-    target_table = next_target_table()
+    :param source_schema: The source schema.
+    :param target_schema: The target schema.
+    :param filters: An ObjectFilter selecting the kinds of objects to diff, if not all of them.
+    :returns: A generator of DDL statements.
+    """
+    if filters is None:
+        filters = ObjectFilter()
+    yield '--'
+    yield '-- VIEWS'
+    yield '--'
+    diff = diff_objects(source_schema.views, target_schema.views)
+    if filters.reads('views'):
+        for source_view in diff.removed:
+            yield Statement(source_view.dropstr(), source_view, 'drop')
+    for source_view, target_view in diff.changed:
+        if filters.reads('views') and source_view.digest != target_view.digest:
+            yield Statement(source_view.dropstr(), source_view, 'drop')
+            yield Statement(str(target_view), target_view, 'create')
+        else:
+            if filters.reads('grants'):
+                yield from _statements(grants_migration_ddl(source_view, target_view), target_view, 'alter')
+            if filters.reads('views') and source_view.owner != target_view.owner:
+                yield Statement(target_view.ownerstr(), target_view, 'alter')
+    if filters.reads('views'):
+        for target_view in diff.added:
+            yield Statement(str(target_view), target_view, 'create')
+
+def functions_migration_ddl(source_schema, target_schema, filters=None):
+    """
+    Generates DDL to migrate the functions in two schemas.  Overloaded
+    functions are told apart by their argument types.
 
-    while source_table or target_table:
-        if not target_table:
-            print(source_table.dropstr())
-            source_table = next_source_table()
-            continue
+    :param source_schema: The source schema.
+    :param target_schema: The target schema.
+    :param filters: An ObjectFilter selecting the kinds of objects to diff, if not all of them.
+    :returns: A generator of DDL statements.
+    """
+    if filters is None:
+        filters = ObjectFilter()
+    yield '--'
+    yield '-- FUNCTIONS'
+    yield '--'
+    diff = diff_objects(source_schema.functions, target_schema.functions)
+    if filters.reads('functions'):
+        for source_function in diff.removed:
+            yield Statement(source_function.dropstr(), source_function, 'drop')
+    for source_function, target_function in diff.changed:
+        if filters.reads('functions') and source_function.digest != target_function.digest:
+            yield Statement(source_function.dropstr(), source_function, 'drop')
+            yield Statement(str(target_function), target_function, 'create')
+        else:
+            if filters.reads('grants'):
+                yield from _statements(grants_migration_ddl(source_function, target_function), target_function, 'alter')
+            if filters.reads('functions') and source_function.owner != target_function.owner:
+                yield Statement(target_function.ownerstr(), target_function, 'alter')
+    if filters.reads('functions'):
+        for target_function in diff.added:
+            yield Statement(str(target_function), target_function, 'create')
+
+def schema_migration_ddl(source_schema, target_schema, filters=None, online=False):
+    """
+    Generates the migration DDL for two schemas.  The DDL will migrate
+    a database with the source schema to one with the target schema.
 
-        if not source_table:
-            print(f'{str(target_table)}')
-            target_table = next_target_table()
-            continue
+    :param source_schema: The source schema.
+    :param target_schema: The target schema.
+    :param filters: An ObjectFilter selecting the kinds of objects to diff, if not all of them.
+    :param online: Whether to build indexes concurrently and validate constraints separately.
+    :returns: A generator of DDL statements.
+    """
+    if filters is None:
+        filters = ObjectFilter()
+    yield from schema_banner(source_schema)
+    if filters.reads_tables():
+        yield from tables_migration_ddl(source_schema, target_schema, filters, online)
+        yield ''
+    if filters.reads_views():
+        yield from views_migration_ddl(source_schema, target_schema, filters)
+        yield ''
+    if filters.reads_functions():
+        yield from functions_migration_ddl(source_schema, target_schema, filters)
+
+def schemas_migration_ddl(source_schemas, target_schemas, filters=None, online=False):
+    """
+    Generates the migration DDL for two lists of schemas.  The DDL will
+    migrate a database with the source schemas to one with the target
+    schemas.
 
-        if source_table.name < target_table.name:
-            print(source_table.dropstr())
-            source_table = next_source_table()
-            continue
+    Online migrations keep changes to existing tables from blocking
+    writes for long: indexes are created and dropped concurrently, primary
+    and unique keys are added using an index created concurrently, and
+    check and foreign key constraints are added NOT VALID and validated by
+    a separate statement.  Each statement must then run on its own,
+    outside a transaction block.
 
-        if source_table.name > target_table.name:
-            print(f'{str(target_table)}')
-            target_table = next_target_table()
-            continue
+    :param source_schemas: The source schemas.
+    :param target_schemas: The target schemas.
+    :param filters: An ObjectFilter selecting the kinds of objects to diff, if not all of them.
+    :param online: Whether to generate an online migration.
+    :returns: A generator of DDL statements.
+    """
+    if online:
+        yield '-- Online migration: run each statement on its own, outside a transaction block,'
+        yield '-- as CREATE INDEX CONCURRENTLY and DROP INDEX CONCURRENTLY cannot run in one.'
+    diff = diff_objects(source_schemas, target_schemas)
+    for source_schema in diff.removed:
+        yield from schema_banner(source_schema)
+        yield Statement(source_schema.dropstr(), source_schema, 'drop')
+    for source_schema, target_schema in diff.changed:
+        yield from schema_migration_ddl(source_schema, target_schema, filters, online)
+    for target_schema in diff.added:
+        yield from schema_banner(target_schema)
+        yield Statement(target_schema.addstr(), target_schema, 'create')
+        yield from schema_ddl(target_schema, filters)
+
+def definitions_needed(source_schemas, target_schemas):
+    """
+    Gets the target functions and views whose definitions the migration
+    DDL for two lists of schemas will print, but which were read with only
+    their digests: those that are added, or whose digests differ.
 
-        print_table_migration_ddl(source_table, target_table)
-        source_table = next_source_table()
-        target_table = next_target_table()
+    :param source_schemas: The source schemas.
+    :param target_schemas: The target schemas.
+    :returns: A list of functions and views.
+    """
+    needed = []
+    diff = diff_objects(source_schemas, target_schemas)
+    for target_schema in diff.added:
+        needed.extend(target_schema.views)
+        needed.extend(target_schema.functions)
+    for source_schema, target_schema in diff.changed:
+        for source_objs, target_objs in ((source_schema.views, target_schema.views), (source_schema.functions, target_schema.functions)):
+            objs_diff = diff_objects(source_objs, target_objs)
+            needed.extend(objs_diff.added)
+            needed.extend(target_obj for source_obj, target_obj in objs_diff.changed if source_obj.digest != target_obj.digest)
+    return [obj for obj in needed if obj.definition is None and obj.digest is not None]
+
+def print_schemas_migration_ddl(source_schemas, target_schemas, out=None, filters=None):
+    """
+    Writes the migration DDL for two lists of schemas.  The DDL will
+    migrate a database with the source schemas to one with the target
+    schemas.
 
-def print_views_migration_ddl(source_schema, target_schema):
+    :param source_schemas: The source schemas.
+    :param target_schemas: The target schemas.
+    :param out: The DDLWriter to write to; defaults to standard output.
+    :param filters: An ObjectFilter selecting the kinds of objects to diff, if not all of them.
     """
-    Prints DDL to migrate the views in two schemas.
+    _write_ddl(schemas_migration_ddl(source_schemas, target_schemas, filters), out)
 
-    :param source_schema: The source schema.
-    :param target_schema: The target schema.
+############################################################################
+# FUNCTIONS FOR GENERATING SCHEMA DDL
+############################################################################
+
+def schema_ddl(schema, filters=None):
     """
-    print('--')
-    print('-- VIEWS')
-    print('--')
-    next_source_view = next_or_none(source_schema.views)
-    next_target_view = next_or_none(target_schema.views)
+    Generates the DDL to create all objects in a schema.
 
-    source_view = next_source_view()
-    target_view = next_target_view()
+    :param schema: The schema
+    :param filters: An ObjectFilter selecting the kinds of objects to create, if not all of them.
+    :returns: A generator of DDL statements.
+    """
+    if filters is None:
+        filters = ObjectFilter()
+    if filters.reads('tables'):
+        for table in schema.tables:
+            yield Statement(str(table), table, 'create')
+            yield ''
+
+    if filters.reads('constraints'):
+        for table in schema.tables:
+            for foreign_key in table.foreign_keys:
+                yield Statement(foreign_key.addstr(), foreign_key, 'create')
+        yield ''
+
+    if filters.reads('views'):
+        for view in schema.views:
+            yield Statement(str(view), view, 'create')
+            yield ''
+
+    if filters.reads('functions'):
+        for function in schema.functions:
+            yield Statement(str(function), function, 'create')
+            yield ''
+
+def schema_banner(schema):
+    """
+    Generates a banner to call out the schema name.
 
-    while source_view or target_view:
-        if not target_view:
-            print(source_view.dropstr())
-            source_view = next_source_view()
-            continue
+    :param schema: The schema
+    :returns: A generator of comment lines.
+    """
+    yield '-- *************************************'
+    yield '-- * SCHEMA: ' + schema.name
+    yield '-- *************************************'
 
-        if not source_view:
-            print(f'{str(target_view)}')
-            target_view = next_target_view()
-            continue
+def print_schema_ddl(schema, out=None, filters=None):
+    """
+    Writes the DDL to create all objects in a schema.
 
-        if source_view.name < target_view.name:
-            print(source_view.dropstr())
-            source_view = next_source_view()
-            continue
+    :param schema: The schema
+    :param out: The DDLWriter to write to; defaults to standard output.
+    :param filters: An ObjectFilter selecting the kinds of objects to create, if not all of them.
+    """
+    _write_ddl(schema_ddl(schema, filters), out)
 
-        if source_view.name > target_view.name:
-            print(f'{str(target_view)}')
-            target_view = next_target_view()
-            continue
+############################################################################
+# OUTPUT SINKS
+############################################################################
 
-        if source_view.definition != target_view.definition:
-            print(source_view.dropstr())
-            print(f'{str(target_view)}')
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+class DDLWriter:
+    """ Writes DDL statements, one per line, to a binary stream in large chunks """
+    def __init__(self, stream, buffer_size=DEFAULT_BUFFER_SIZE, close_stream=False):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.close_stream = close_stream
+        self._chunks = []
+        self._size = 0
+
+    def write(self, statement):
+        self._chunks.append(statement)
+        self._chunks.append('\n')
+        self._size += len(statement) + 1
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def writeall(self, statements):
+        for statement in statements:
+            self.write(statement)
+
+    def flush(self):
+        # Only hands the buffered text to the stream; flushing a compressing
+        # stream on every chunk would hurt the compression ratio.
+        if self._chunks:
+            self.stream.write(''.join(self._chunks).encode('utf-8'))
+            self._chunks = []
+            self._size = 0
+
+    def close(self):
+        self.flush()
+        if self.close_stream:
+            self.stream.close()
         else:
-            print_grants_migration_ddl(source_view, target_view)
-            if (source_view.owner != target_view.owner):
-                print(target_view.ownerstr())
+            self.stream.flush()
+
+    def __enter__(self):
+        return self
 
-        source_view = next_source_view()
-        target_view = next_target_view()
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-def print_functions_migration_ddl(source_schema, target_schema):
+_COMPRESSION_SUFFIXES = {
+    '.gz': 'gzip',
+    '.zst': 'zstd'
+}
+
+def open_ddl_writer(path=None, compression=None, buffer_size=DEFAULT_BUFFER_SIZE):
     """
-    Prints DDL to migrate the functions in two schemas.
+    Opens a DDLWriter on standard output or a file.  DDL written to a file
+    may be compressed on the fly.
 
-    :param source_schema: The source schema.
-    :param target_schema: The target schema.
+    :param path: The path of the file to write, or None or '-' for standard output.
+    :param compression: 'gzip', 'zstd' or 'none'; if None, it is chosen from the file suffix.
+    :param buffer_size: The number of characters to buffer between writes.
+    :returns: The DDLWriter.
     """
-    print('--')
-    print('-- FUNCTIONS')
-    print('--')
-    next_source_function = next_or_none(sorted(source_schema.functions, key=lambda f: f.fullname))
-    next_target_function = next_or_none(sorted(target_schema.functions, key=lambda f: f.fullname))
+    if path is None or path == '-':
+        return DDLWriter(sys.stdout.buffer, buffer_size)
+
+    if compression is None:
+        compression = _COMPRESSION_SUFFIXES.get(os.path.splitext(path)[1], 'none')
+    if compression == 'gzip':
+        stream = gzip.open(path, 'wb', compresslevel=6)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package')
+        stream = zstandard.open(path, 'wb')
+    elif compression == 'none':
+        stream = open(path, 'wb')
+    else:
+        raise ValueError(f'Unknown compression {compression}')
+    return DDLWriter(stream, buffer_size, close_stream=True)
 
-    source_function = next_source_function()
-    target_function = next_target_function()
+def _write_ddl(statements, out):
+    if out is None:
+        with open_ddl_writer() as writer:
+            writer.writeall(statements)
+    else:
+        out.writeall(statements)
 
-    while source_function or target_function:
-        if not target_function:
-            print(source_function.dropstr())
-            source_function = next_source_function()
-            continue
+############################################################################
+# FUNCTIONS FOR USE AS A LIBRARY
+############################################################################
 
-        if not source_function:
-            print(f'{str(target_function)}')
-            target_function = next_target_function()
-            continue
+class DiffResult:
+    """ The schemas of two databases and the migration DDL from the source to the target """
+    def __init__(self, source_schemas, target_schemas, statements):
+        self.source_schemas = source_schemas
+        self.target_schemas = target_schemas
+        self.statements = statements
 
-        if source_function.name < target_function.name:
-            print(source_function.dropstr())
-            source_function = next_source_function()
-            continue
+    def has_changes(self):
+        return has_changes(self.statements)
 
-        if source_function.name > target_function.name:
-            print(f'{str(target_function)}')
-            target_function = next_target_function()
-            continue
+    def ddl(self):
+        return ''.join(f'{statement}\n' for statement in self.statements)
 
-        if source_function.definition != target_function.definition:
-            print(source_function.dropstr())
-            print(f'{str(target_function)}')
-        else:
-            print_grants_migration_ddl(source_function, target_function)
-            if source_function.owner != target_function.owner:
-                print(target_function.ownerstr())
+    def write(self, out):
+        out.writeall(self.statements)
 
-        source_function = next_source_function()
-        target_function = next_target_function()
+def diff_schemas(source_schemas, target_schemas, filters=None, online=False):
+    """
+    Diffs two lists of schemas.
 
-def print_schema_migration_ddl(source_schema, target_schema):
+    :param source_schemas: The source schemas.
+    :param target_schemas: The target schemas.
+    :param filters: An ObjectFilter selecting the kinds of objects to diff, if not all of them.
+    :param online: Whether to generate an online migration; see schemas_migration_ddl.
+    :returns: A DiffResult.
     """
-    Prints the migration DDL for two schemas.  The DDL will migrate
-    a database with the source schema to one with the target schema.
+    return DiffResult(source_schemas, target_schemas, list(schemas_migration_ddl(source_schemas, target_schemas, filters, online)))
 
-    :param source_schema: The source schema.
-    :param target_schema: The target schema.
+def diff_databases(source, target, jobs=1, fetch_size=DEFAULT_FETCH_SIZE, filters=None, two_phase=False, stats=None, online=False, columnar=False):
+    """
+    Reads and diffs the schemas of two databases, without printing
+    anything.  Each database may be given as a libpq connection string or
+    as a connection, pool or cursor factory of the caller's, which saves
+    connecting on every call; see ConnectionSource.  The two databases
+    are read one after the other, so the caller controls concurrency.
+
+    :param source: The source database.
+    :param target: The target database.
+    :param jobs: The number of connections to read each database over, for connection strings and pools.
+    :param fetch_size: The number of catalog rows to fetch at a time, or 0 to buffer whole results.
+    :param filters: An ObjectFilter selecting the objects to compare, if not all of them.
+    :param two_phase: Whether to read in full only the objects whose
+                      fingerprints differ; the schemas in the result then
+                      hold only those objects.
+    :param stats: A QueryStats to record the queries run in, if any.
+    :param online: Whether to generate an online migration; see schemas_migration_ddl.
+    :param columnar: Whether to keep table columns in ColumnStores; see get_schema_objects.  Not with two_phase.
+    :returns: A DiffResult.
     """
-    print_schema_banner(source_schema)
-    print_tables_migration_ddl(source_schema, target_schema)
-    print()
-    print_views_migration_ddl(source_schema, target_schema)
-    print()
-    print_functions_migration_ddl(source_schema, target_schema)
+    if two_phase:
+        source_schemas, target_schemas = get_schema_objects_two_phase(source, target, fetch_size, filters, stats)
+    else:
+        source_schemas = get_schema_objects(source, jobs, None, fetch_size, False, filters, stats, columnar)
+        target_schemas = get_schema_objects(target, jobs, None, fetch_size, False, filters, stats, columnar)
+    return diff_schemas(source_schemas, target_schemas, filters, online)
+
+############################################################################
+# FUNCTIONS FOR ESTIMATING THE COST OF MIGRATION DDL
+############################################################################
+
+# Functions whose calls in a column default make ADD COLUMN rewrite the
+# table, since the default must be computed for every row.
+_VOLATILE_DEFAULT = re.compile(r'nextval\(|random\(|clock_timestamp\(|timeofday\(|gen_random_uuid\(|uuid_generate_v[14]')
+
+def _add_column_cost(match):
+    # From PostgreSQL 11, a column added with a non-volatile default is
+    # metadata only; serial columns get a nextval default.
+    definition = match.group(1)
+    if _VOLATILE_DEFAULT.search(definition) or re.match(r'\S+ (small|big)?serial ', definition):
+        return 'ACCESS EXCLUSIVE', 'rewrite'
+    return 'ACCESS EXCLUSIVE', 'metadata'
+
+# (pattern, lock, impact) in order of precedence, matched against the
+# first line of a statement.  The lock is the one taken on the table,
+# or None for none; a callable works both out from the match.  Anything
+# else takes no lock on a table.
+_STATEMENT_COSTS = [
+    (r'CREATE (UNIQUE )?INDEX CONCURRENTLY ', 'SHARE UPDATE EXCLUSIVE', 'scan'),
+    (r'CREATE (UNIQUE )?INDEX ', 'SHARE', 'scan'),
+    (r'DROP INDEX CONCURRENTLY ', 'SHARE UPDATE EXCLUSIVE', 'metadata'),
+    (r'DROP INDEX ', 'ACCESS EXCLUSIVE', 'metadata'),
+    (r'ALTER TABLE \S+ VALIDATE CONSTRAINT ', 'SHARE UPDATE EXCLUSIVE', 'scan'),
+    (r'ALTER TABLE \S+ ADD CONSTRAINT \S+ (PRIMARY KEY|UNIQUE) USING INDEX ', 'ACCESS EXCLUSIVE', 'metadata'),
+    (r'ALTER TABLE \S+ ADD CONSTRAINT \S+ FOREIGN KEY .* NOT VALID;', 'SHARE ROW EXCLUSIVE', 'metadata'),
+    (r'ALTER TABLE \S+ ADD CONSTRAINT \S+ FOREIGN KEY ', 'SHARE ROW EXCLUSIVE', 'scan'),
+    (r'ALTER TABLE \S+ ADD CONSTRAINT .* NOT VALID;', 'ACCESS EXCLUSIVE', 'metadata'),
+    (r'ALTER TABLE \S+ ADD CONSTRAINT ', 'ACCESS EXCLUSIVE', 'scan'),
+    (r'ALTER TABLE \S+ DROP CONSTRAINT ', 'ACCESS EXCLUSIVE', 'metadata'),
+    (r'CREATE (CONSTRAINT )?TRIGGER ', 'SHARE ROW EXCLUSIVE', 'metadata'),
+    (r'DROP TRIGGER \S+ ON ', 'ACCESS EXCLUSIVE', 'metadata'),
+    (r'ALTER TABLE \S+ ADD (.*)', _add_column_cost, None),
+    (r'ALTER TABLE \S+ DROP COLUMN ', 'ACCESS EXCLUSIVE', 'metadata'),
+    # The partition is scanned to check that its rows are within the bound.
+    (r'ALTER TABLE \S+ ATTACH PARTITION ', 'ACCESS EXCLUSIVE', 'scan'),
+    (r'ALTER TABLE \S+ DETACH PARTITION ', 'ACCESS EXCLUSIVE', 'metadata'),
+    (r'CREATE TABLE \S+ PARTITION OF ', 'ACCESS EXCLUSIVE', 'metadata'),
+    # Type changes that need no rewrite are metadata only; see statement_cost.
+    (r'ALTER TABLE \S+ ALTER COLUMN \S+ TYPE ', 'ACCESS EXCLUSIVE', 'rewrite'),
+    (r'ALTER TABLE \S+ ALTER COLUMN \S+ SET NOT NULL', 'ACCESS EXCLUSIVE', 'scan'),
+    (r'ALTER TABLE \S+ ALTER COLUMN \S+ (SET DEFAULT|DROP DEFAULT|DROP NOT NULL)', 'ACCESS EXCLUSIVE', 'metadata'),
+    (r'ALTER TABLE ', 'ACCESS EXCLUSIVE', 'metadata'),
+    (r'DROP TABLE ', 'ACCESS EXCLUSIVE', 'metadata'),
+    # Dropping a schema drops its tables.
+    (r'DROP SCHEMA ', 'ACCESS EXCLUSIVE', 'metadata'),
+    # Views and functions are not tables: dropping or replacing a view
+    # locks the view alone, and nothing done to a function locks a table.
+    (r'(CREATE OR REPLACE|CREATE|DROP|ALTER) (VIEW|FUNCTION|AGGREGATE) ', None, 'metadata'),
+    (r'(GRANT|REVOKE) ', None, 'metadata'),
+    (r'CREATE ', None, 'metadata'),
+]
+_STATEMENT_COSTS = [(re.compile(pattern), lock, impact) for pattern, lock, impact in _STATEMENT_COSTS]
+
+_ALTER_COLUMN_TYPE = re.compile(r'ALTER TABLE \S+ ALTER COLUMN (\S+) TYPE ')
+
+# An ALTER TABLE with a clause per line, as alter_table_str writes it.
+_ALTER_TABLE_CLAUSES = re.compile(r'ALTER TABLE \S+\n  (.*);$', re.DOTALL)
+
+# Table lock modes, weakest first.
+_LOCK_MODES = ['ACCESS SHARE', 'ROW SHARE', 'ROW EXCLUSIVE', 'SHARE UPDATE EXCLUSIVE', 'SHARE', 'SHARE ROW EXCLUSIVE', 'EXCLUSIVE', 'ACCESS EXCLUSIVE']
+
+# How many times a table's pages are read or written, by impact.
+_IMPACT_WEIGHTS = {'rewrite': 2, 'scan': 1, 'metadata': 0}
+
+BLOCK_SIZE = 8192
+
+class StatementCost:
+    """ The lock a migration statement takes and how much of its table it reads or writes """
+    def __init__(self, statement, lock, impact, table=None, reftable=None):
+        self.statement = statement
+        self.lock = lock
+        self.impact = impact
+        self.table = table
+        self.reftable = reftable
+
+    def pages(self):
+        # A foreign key is checked against the referenced table too.
+        return sum(table.pages for table in (self.table, self.reftable) if table is not None)
+
+    def cost(self):
+        """
+        Gets a rough cost of the statement: the number of table pages it
+        reads or writes, counting a rewrite twice.
+
+        :returns: The cost.
+        """
+        return _IMPACT_WEIGHTS[self.impact] * self.pages()
+
+    def summary(self):
+        return statement_summary(self.statement)
 
-def print_schemas_migration_ddl(source_schemas, target_schemas):
+    def __str__(self):
+        s = f'-- lock: {self.lock or "none on existing tables"}; {self.impact}'
+        if self.table is not None:
+            s += f': {self.table.fullname} ({table_size_str(self.table)})'
+        if self.reftable is not None:
+            s += f', checked against {self.reftable.fullname} ({table_size_str(self.reftable)})'
+        return s
+
+def statement_summary(statement):
     """
-    Prints the migration DDL for two lists of schemas.  The DDL will migrate
-    a database with the source schemas to one with the target schemas.
+    Gets enough of a statement to tell which it is: its first line, with
+    the number of clauses of an ALTER TABLE that has several.
 
-    :param source_schemas: The source schemas.
-    :param target_schemas: The target schemas.
+    :param statement: The statement.
+    :returns: The summary.
     """
-    next_source_schema = next_or_none(sorted(source_schemas, key=lambda f: f.name))
-    next_target_schema = next_or_none(sorted(target_schemas, key=lambda f: f.name))
+    lines = statement.split('\n')
+    if _ALTER_TABLE_CLAUSES.match(statement):
+        return f'{lines[0]} ({len(lines) - 1} changes)'
+    return lines[0]
 
-    source_schema = next_source_schema()
-    target_schema = next_target_schema()
+def table_size_str(table):
+    """
+    Describes the size of a table as of its last vacuum or analyze.
 
-    while source_schema or target_schema:
-        if not target_schema:
-            print_schema_banner(source_schema)
-            print(source_schema.dropstr())
-            source_schema = next_source_schema()
-            continue
+    :param table: The table.
+    :returns: The size and row estimate.
+    """
+    rows = 'rows unknown' if table.rows is None else f'~{table.rows} rows'
+    return f'{table.pages * BLOCK_SIZE / (1 << 20):.1f} MiB, {rows}'
 
-        if not source_schema:
-            print_schema_banner(target_schema)
-            print(target_schema.addstr())
-            print_schema_ddl(target_schema)
-            target_schema = next_target_schema()
-            continue
+def statement_cost(statement, tables):
+    """
+    Classifies a migration statement by the lock it takes and by whether
+    it rewrites its table, scans it or only changes the catalog, with the
+    table it applies to.
 
-        if source_schema.name < target_schema.name:
-            print_schema_banner(source_schema)
-            print(source_schema.dropstr())
-            source_schema = next_source_schema()
-            continue
+    :param statement: The statement, as schemas_migration_ddl generates it.
+    :param tables: The tables of the database to be migrated, keyed by identity key.
+    :returns: A StatementCost.
+    """
+    table = None
+    reftable = None
+    obj = getattr(statement, 'obj', None)
+    if isinstance(obj, ForeignKey):
+        table = tables.get(identity_key(obj.table))
+    elif isinstance(obj, Table) and statement.action != 'create':
+        table = tables.get(identity_key(obj))
+
+    # An ALTER TABLE with several clauses takes the strongest of their
+    # locks and reads or writes the table as the costliest of them does.
+    first_line = statement.split('\n', 1)[0]
+    match = _ALTER_TABLE_CLAUSES.match(statement)
+    if match:
+        lines = [f'{first_line} {clause}' for clause in match.group(1).split(',\n  ')]
+    else:
+        lines = [first_line]
+    lock, impact = None, 'metadata'
+    for line in lines:
+        line_lock, line_impact = _line_cost(line, table, obj)
+        if lock is None or (line_lock is not None and _LOCK_MODES.index(line_lock) > _LOCK_MODES.index(lock)):
+            lock = line_lock
+        if _IMPACT_WEIGHTS[line_impact] > _IMPACT_WEIGHTS[impact]:
+            impact = line_impact
+
+    if isinstance(obj, ForeignKey) and obj.reftable is not None and impact == 'scan':
+        reftable = tables.get(identity_key(obj.reftable))
+    return StatementCost(statement, lock, impact, table, reftable)
+
+def _line_cost(line, table, target_obj):
+    lock, impact = None, 'metadata'
+    for pattern, pattern_lock, pattern_impact in _STATEMENT_COSTS:
+        match = pattern.match(line)
+        if match:
+            if callable(pattern_lock):
+                lock, impact = pattern_lock(match)
+            else:
+                lock, impact = pattern_lock, pattern_impact
+            break
+    match = _ALTER_COLUMN_TYPE.match(line)
+    if match and table is not None and isinstance(target_obj, Table):
+        source_column = next((column for column in table.columns if column.name == match.group(1)), None)
+        target_column = next((column for column in target_obj.columns if column.name == match.group(1)), None)
+        if source_column is not None and target_column is not None and not type_change_rewrites(source_column, target_column):
+            impact = 'metadata'
+    return lock, impact
+
+def estimated_migration_ddl(statements, source_schemas, top=10):
+    """
+    Annotates migration DDL with a comment before each statement giving
+    the lock it takes, whether it rewrites or scans its table, and the
+    table's size in the database to be migrated, and adds a summary of
+    the most expensive statements at the end.
+
+    :param statements: The DDL statements, as schemas_migration_ddl generates them.
+    :param source_schemas: The schemas of the database to be migrated.
+    :param top: The number of statements to list in the summary.
+    :returns: A generator of DDL statements and comments.
+    """
+    tables = {identity_key(table): table for schema in source_schemas for table in schema.tables}
+    costs = []
+    for statement in statements:
+        if statement and not statement.startswith('--'):
+            cost = statement_cost(statement, tables)
+            costs.append(cost)
+            yield str(cost)
+        yield statement
+    yield ''
+    yield '-- *************************************'
+    yield '-- * MOST EXPENSIVE STATEMENTS'
+    yield '-- *************************************'
+    # Tables without pages, such as those never vacuumed or analyzed, are
+    # ranked by impact alone, after those of known size.
+    ranked = sorted((cost for cost in costs if cost.impact != 'metadata'), key=lambda cost: (-cost.cost(), -_IMPACT_WEIGHTS[cost.impact]))[:top]
+    if not ranked:
+        yield '-- No statement rewrites or scans an existing table.'
+    for number, cost in enumerate(ranked, 1):
+        size = f'{cost.pages() * BLOCK_SIZE / (1 << 20):.1f} MiB' if cost.pages() else 'size unknown'
+        yield f'-- {number}. {cost.impact}, {size}, lock {cost.lock}: {cost.summary()}'
+    counts = {}
+    for cost in costs:
+        counts[cost.impact] = counts.get(cost.impact, 0) + 1
+    yield f'-- {", ".join(f"{count} {impact}" for impact, count in sorted(counts.items()))}'
 
-        if source_schema.name > target_schema.name:
-            print_schema_banner(target_schema)
-            print(target_schema.addstr())
-            print_schema_ddl(target_schema)
-            target_schema = next_target_schema()
+############################################################################
+# FUNCTIONS FOR APPLYING MIGRATION DDL
+############################################################################
+
+class MigrationStep:
+    """ A statement of a migration, with the steps it must wait for and how running it went """
+    def __init__(self, number, statement):
+        self.number = number
+        self.statement = statement
+        self.depends = []
+        self.dependents = []
+        self.status = 'pending'
+        self.seconds = None
+        self.error = None
+
+    def summary(self):
+        return statement_summary(self.statement)
+
+def _root_table(table):
+    while table.parent is not None:
+        table = table.parent
+    return table
+
+def _statement_keys(statement, dependencies):
+    # Gets the identity keys of the object a statement writes and of the
+    # objects it reads: its schema, an FK's referenced table and the
+    # pg_depend dependencies of a table, view or function.  A partition's
+    # statements belong to its partitioned table.  Reads of None stand for
+    # dependencies that are not known.
+    obj = statement.obj
+    if isinstance(obj, Schema):
+        return identity_key(obj), ()
+    if isinstance(obj, ForeignKey):
+        reads = [obj.table.schema.name]
+        if obj.reftable is not None:
+            reads.extend((obj.reftable.schema.name, identity_key(_root_table(obj.reftable))))
+        return identity_key(_root_table(obj.table)), reads
+    key = identity_key(obj)
+    reads = [obj.schema.name]
+    if dependencies is None or key not in dependencies:
+        reads.append(None)
+    else:
+        reads.extend(dependencies[key])
+    return key, reads
+
+def migration_graph(statements, dependencies=None):
+    """
+    Turns migration DDL into a graph of steps.  A statement depends on
+    the statements before it that touch the same object, and on those
+    before it that create, drop or alter an object it reads: the schema
+    it is in, the table an FK references, or what a table, view or
+    function depends on.  A
+    statement that writes an object waits for the statements before it
+    that read it.  Indexes, constraints, triggers and grants belong to
+    their table, view or function.  Edges only ever point forward in the
+    printed order, so the graph has no cycles and any order it allows
+    has the same effect as the script.
+
+    :param statements: The DDL statements, as schemas_migration_ddl generates them; comments and blank lines are left out.
+    :param dependencies: A dict of sets of the identity keys of the
+                         objects tables, views and functions depend on,
+                         keyed by their identity key, as
+                         object_dependencies gets; an object missing from
+                         it, or whose set holds None, waits for every
+                         statement before it.
+    :returns: A list of MigrationSteps in printed order.
+    """
+    steps = []
+    last_writer = {}
+    readers = {}
+    # The steps no other step depends on yet; depending on all of them
+    # is depending on every step so far.
+    sinks = set()
+    for statement in statements:
+        if not statement or statement.startswith('--'):
             continue
+        step = MigrationStep(len(steps) + 1, statement)
+        if not isinstance(statement, Statement):
+            # Nothing is known of it, so it keeps its place in the script.
+            depends = set(sinks)
+            key, reads = None, ()
+        else:
+            key, reads = _statement_keys(statement, dependencies)
+            depends = set()
+            if None in reads:
+                depends.update(sinks)
+            for read_key in reads:
+                if read_key in last_writer:
+                    depends.add(last_writer[read_key])
+            if key in last_writer:
+                depends.add(last_writer[key])
+            depends.update(readers.get(key, ()))
+        for dependency in sorted(depends, key=lambda step: step.number):
+            step.depends.append(dependency)
+            dependency.dependents.append(step)
+        sinks.difference_update(depends)
+        sinks.add(step)
+        if key is not None:
+            last_writer[key] = step
+            readers[key] = []
+            for read_key in reads:
+                if read_key is not None:
+                    readers.setdefault(read_key, []).append(step)
+        steps.append(step)
+    return steps
+
+def object_dependencies(database, schemas):
+    """
+    Gets what the tables, views and functions of a list of schemas depend
+    on, from pg_depend.  What a partition depends on counts for its
+    partitioned table, whose statements create and alter it.
+
+    :param database: A libpq connection string to the database the schemas were read from, or a connection, pool or cursor factory; see ConnectionSource.
+    :param schemas: The schemas.
+    :returns: A dict of sets of identity keys, keyed by the identity key of the object; see get_object_dependencies.
+    """
+    tables = {}
+    for schema in schemas:
+        for table in schema.tables:
+            tables[table.oid] = table
+            for partition in table.all_partitions():
+                tables[partition.oid] = partition
+    views = {view.oid: view for schema in schemas for view in schema.views}
+    functions = {function.oid: function for schema in schemas for function in schema.functions}
+    source = ConnectionSource(database)
+    try:
+        dependencies = get_object_dependencies(source.cursor(0), tables, views, functions)
+    finally:
+        source.close()
+    roots = {identity_key(table): identity_key(_root_table(table)) for table in tables.values() if table.parent is not None}
+    objects = dict(tables)
+    objects.update(views)
+    objects.update(functions)
+    keyed = {}
+    for oid, keys in dependencies.items():
+        obj = objects[oid]
+        if isinstance(obj, Table):
+            obj = _root_table(obj)
+        key = identity_key(obj)
+        keys = {roots.get(read_key, read_key) for read_key in keys}
+        keys.discard(key)
+        keyed.setdefault(key, set()).update(keys)
+    return keyed
+
+def apply_migration(libpq_connstr, steps, jobs=4):
+    """
+    Runs the steps of a migration on a database, each as soon as the
+    steps it depends on have succeeded, on up to jobs connections at a
+    time.  Each step runs in a transaction of its own.  When a step fails
+    the steps that depend on it, directly or not, are skipped; the others
+    still run.
+
+    :param libpq_connstr: A libpq connection string to the database to migrate.
+    :param steps: The MigrationSteps, as migration_graph returns them.
+    :param jobs: The number of connections to run steps on.
+    :returns: True if every step succeeded.
+    """
+    if not steps:
+        return True
+    conns = queue.Queue()
+    opened = []
+    try:
+        for _ in range(min(jobs, len(steps))):
+            conn = psycopg2.connect(libpq_connstr)
+            conn.autocommit = True
+            opened.append(conn)
+            conns.put(conn)
+
+        def run(step):
+            conn = conns.get()
+            start = time.perf_counter()
+            try:
+                cur = conn.cursor()
+                try:
+                    # psycopg2 sends a string of several statements as one
+                    # implicit transaction.
+                    cur.execute(step.statement)
+                finally:
+                    cur.close()
+            finally:
+                step.seconds = time.perf_counter() - start
+                conns.put(conn)
+
+        def skip(step):
+            dependents = list(step.dependents)
+            while dependents:
+                dependent = dependents.pop()
+                if dependent.status == 'pending':
+                    dependent.status = 'skipped'
+                    dependents.extend(dependent.dependents)
+
+        waiting = {step: len(step.depends) for step in steps}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(opened)) as executor:
+            running = {executor.submit(run, step): step for step in steps if not step.depends}
+            while running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    try:
+                        future.result()
+                    except psycopg2.Error as e:
+                        step.status = 'failed'
+                        step.error = str(e).strip()
+                        skip(step)
+                        continue
+                    step.status = 'ok'
+                    for dependent in step.dependents:
+                        waiting[dependent] -= 1
+                        if waiting[dependent] == 0 and dependent.status == 'pending':
+                            running[executor.submit(run, dependent)] = dependent
+    finally:
+        for conn in opened:
+            conn.close()
+    return all(step.status == 'ok' for step in steps)
 
-        print_schema_migration_ddl(source_schema, target_schema)
+def write_apply_report(steps, out=None):
+    """
+    Writes how each step of a migration went, with its time, and a count
+    of the steps by outcome.
 
-        source_schema = next_source_schema()
-        target_schema = next_target_schema()
+    :param steps: The MigrationSteps.
+    :param out: A text stream to write to; defaults to standard output.
+    """
+    if out is None:
+        out = sys.stdout
+    counts = {}
+    for step in steps:
+        counts[step.status] = counts.get(step.status, 0) + 1
+        seconds = '' if step.seconds is None else f'{step.seconds:.3f}s'
+        after = f' (after {", ".join(str(dependency.number) for dependency in step.depends)})' if step.depends else ''
+        print(f'{step.number:>5} {step.status:<8} {seconds:>9} {step.summary()}{after}', file=out)
+        if step.error is not None:
+            print(f'      {step.error}', file=out)
+    print(', '.join(f'{count} {status}' for status, count in sorted(counts.items())) or 'nothing to apply', file=out)
 
 ############################################################################
-# FUNCTIONS FOR PRINTING SCHEMA DDL
+# FUNCTIONS FOR RUNNING AS A SERVICE
 ############################################################################
 
-def print_schema_ddl(schema):
+class ServedDatabase:
+    """ A database that a DiffService keeps a connection to and a model of """
+    def __init__(self, libpq_connstr):
+        self.libpq_connstr = libpq_connstr
+        self.conn = None
+        self.cache = CatalogCache()
+        self.lock = threading.Lock()
+
+    def refresh(self, jobs=1, fetch_size=DEFAULT_FETCH_SIZE, stats=None):
+        """
+        Brings the model up to date.  The first time, the whole catalog is
+        read over jobs connections; after that, only the catalog version
+        markers are read on the kept connection, along with any objects
+        that have changed since.  The caller must hold the lock.
+
+        :param jobs: The number of connections to read the whole catalog over.
+        :param fetch_size: The number of catalog rows to fetch at a time, or 0 to buffer whole results.
+        :param stats: A QueryStats to record the queries run in, if any.
+        :returns: The schemas.
+        """
+        try:
+            loaded = self.cache.identity is None
+            if loaded:
+                get_schema_objects(self.libpq_connstr, jobs, self.cache, fetch_size, stats=stats)
+            if self.conn is None or self.conn.closed:
+                self.conn = connect(self.libpq_connstr)
+            # Only a model just read in full is known to be up to date; one
+            # kept over a lost connection is refreshed on the new one.
+            if not loaded:
+                get_schema_objects(self.conn, cache=self.cache, fetch_size=fetch_size, stats=stats)
+        except psycopg2.Error:
+            # The connection may be broken and the model half refreshed, so
+            # start over on the next request.
+            self.close()
+            self.cache = CatalogCache()
+            raise
+        return self.cache.schemas
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+# The number of databases a DiffService keeps models of besides those it
+# was started with.
+DEFAULT_SERVED_DATABASES = 16
+
+class DiffService:
+    """ Diffs databases on request, keeping a connection to and a model of each database it has read lately """
+    def __init__(self, jobs=1, fetch_size=DEFAULT_FETCH_SIZE, stats=None, max_databases=DEFAULT_SERVED_DATABASES):
+        self.jobs = jobs
+        self.fetch_size = fetch_size
+        self.stats = stats
+        self.max_databases = max_databases
+        # Databases read on request, least recently used first; those the
+        # service was started with are kept apart and never evicted.
+        self.databases = collections.OrderedDict()
+        self.warmed = {}
+        self._lock = threading.Lock()
+
+    def database(self, libpq_connstr):
+        """
+        Gets the served database for a connection string, evicting the
+        least recently used database read on request if there are more
+        than max_databases of them.  An evicted database's connection is
+        closed once no diff is using it.
+
+        :param libpq_connstr: A libpq connection string to the database.
+        :returns: The ServedDatabase.
+        """
+        evicted = []
+        with self._lock:
+            database = self.warmed.get(libpq_connstr)
+            if database is None:
+                database = self.databases.get(libpq_connstr)
+                if database is None:
+                    database = self.databases[libpq_connstr] = ServedDatabase(libpq_connstr)
+                self.databases.move_to_end(libpq_connstr)
+                while len(self.databases) > self.max_databases:
+                    evicted.append(self.databases.popitem(last=False)[1])
+        for evicted_database in evicted:
+            with evicted_database.lock:
+                evicted_database.close()
+        return database
+
+    def warm(self, libpq_connstr):
+        """
+        Reads the model of a database ahead of the first request for it.
+        The database is kept for as long as the service runs.
+
+        :param libpq_connstr: A libpq connection string to the database.
+        """
+        with self._lock:
+            database = self.databases.pop(libpq_connstr, None) or self.warmed.get(libpq_connstr) or ServedDatabase(libpq_connstr)
+            self.warmed[libpq_connstr] = database
+        with database.lock:
+            database.refresh(self.jobs, self.fetch_size, self.stats)
+
+    def diff(self, source, target, filters=None, online=False):
+        """
+        Diffs two databases, refreshing their models first.  Both models
+        are locked until the diff is done, since a refresh reuses the
+        objects of the model.
+
+        :param source: A libpq connection string to the source database.
+        :param target: A libpq connection string to the target database.
+        :param filters: An ObjectFilter selecting the objects to compare, if not all of them.
+        :param online: Whether to generate an online migration; see schemas_migration_ddl.
+        :returns: A DiffResult.
+        """
+        if filters is None:
+            filters = ObjectFilter()
+        databases = {libpq_connstr: self.database(libpq_connstr) for libpq_connstr in (source, target)}
+        with contextlib.ExitStack() as stack:
+            # Locks are always taken in the same order to avoid deadlock.
+            for libpq_connstr in sorted(databases):
+                stack.enter_context(databases[libpq_connstr].lock)
+            try:
+                schemas = {libpq_connstr: database.refresh(self.jobs, self.fetch_size, self.stats) for libpq_connstr, database in databases.items()}
+                return diff_schemas(filters.filter_schemas(schemas[source]), filters.filter_schemas(schemas[target]), filters, online)
+            finally:
+                # A database evicted by another request while this one
+                # was using it is closed here instead.
+                with self._lock:
+                    for libpq_connstr, database in databases.items():
+                        if self.warmed.get(libpq_connstr) is not database and self.databases.get(libpq_connstr) is not database:
+                            database.close()
+
+    def close(self):
+        for database in list(self.warmed.values()) + list(self.databases.values()):
+            database.close()
+
+def _request_kinds(value):
+    return _object_kinds(value if isinstance(value, str) else ','.join(value))
+
+def _request_filters(request):
+    # Builds the ObjectFilter of a diff request, whose keys mirror the
+    # command line options.
+    for key in ('include_schema', 'exclude_schema', 'include_table', 'exclude_table'):
+        if not isinstance(request.get(key, []), list):
+            raise ValueError(f'{key} must be a list of patterns')
+    if request.get('only') and request.get('skip'):
+        raise ValueError('only and skip cannot both be given')
+    if request.get('only'):
+        kinds = _request_kinds(request['only'])
+    elif request.get('skip'):
+        kinds = OBJECT_KINDS - _request_kinds(request['skip'])
+    else:
+        kinds = OBJECT_KINDS
+    return ObjectFilter(request.get('include_schema', []), request.get('exclude_schema', []), request.get('include_table', []), request.get('exclude_table', []), kinds)
+
+class _DiffRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves POST /diff with a JSON object holding source and target
+    connection strings and, optionally, include_schema, exclude_schema,
+    include_table, exclude_table, only, skip and online.  The reply is the
+    migration DDL as text.  GET /health replies ok.
     """
-    Prints the DDL to create all objects in a schema.
+    def do_GET(self):
+        if self.path != '/health':
+            self._reply(404, 'not found\n')
+            return
+        self._reply(200, 'ok\n')
+
+    def do_POST(self):
+        if self.path != '/diff':
+            self._reply(404, 'not found\n')
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            source = request['source']
+            target = request['target']
+            filters = _request_filters(request)
+            online = request.get('online', False)
+            if not isinstance(online, bool):
+                raise ValueError('online must be true or false')
+        except (ValueError, KeyError, TypeError, AttributeError, argparse.ArgumentTypeError) as e:
+            self._reply(400, f'bad request: {e}\n')
+            return
+        start = time.perf_counter()
+        try:
+            result = self.server.service.diff(source, target, filters, online)
+        except psycopg2.Error as e:
+            self._reply(502, f'{str(e).strip()}\n')
+            return
+        self._reply(200, result.ddl(), {
+            'X-Xpgdiff-Changes': 'yes' if result.has_changes() else 'no',
+            'X-Xpgdiff-Seconds': f'{time.perf_counter() - start:.3f}'
+        })
+
+    def _reply(self, status, text, headers=None):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Clients of a Unix socket have no address.
+        return self.client_address[0] if self.client_address else 'local'
+
+class _UnixHTTPServer(http.server.ThreadingHTTPServer):
+    """ An HTTP server on a Unix socket """
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a host and port.
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = self.server_address
+        self.server_port = 0
+
+def make_diff_server(address, service):
+    """
+    Creates an HTTP server for a DiffService, handling each request in a
+    thread of its own.
 
-    :param schema: The schema
+    :param address: HOST:PORT, or the path of a Unix socket, which must contain a /; a stale socket at the path is removed.
+    :param service: The DiffService.
+    :returns: The server.
     """
-    for table in schema.tables:
-        print(str(table))
-        print()
+    if '/' in address:
+        if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            os.unlink(address)
+        server = _UnixHTTPServer(address, _DiffRequestHandler)
+    else:
+        host, _, port = address.rpartition(':')
+        server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), _DiffRequestHandler)
+    server.service = service
+    return server
 
-    for table in schema.tables:
-        for foreign_key in table.foreign_keys:
-            print(foreign_key.addstr())
-    print()
+def serve(address, service):
+    """
+    Serves diff requests until interrupted.
+
+    :param address: HOST:PORT, or the path of a Unix socket; see make_diff_server.
+    :param service: The DiffService.
+    """
+    server = make_diff_server(address, service)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if server.address_family == socket.AF_UNIX:
+            os.unlink(address)
+
+############################################################################
+# FUNCTIONS FOR DIFFING A FLEET OF DATABASES
+############################################################################
+
+class FleetGroup:
+    """ The databases of a fleet that share one schema fingerprint """
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.databases = []
+        self.statements = None
+        self.error = None
 
-    for view in schema.views:
-        print(str(view))
-        print()
+    def add_database(self, name, libpq_connstr):
+        self.databases.append((name, libpq_connstr))
 
-    for function in schema.functions:
-        print(str(function))
-        print()
+    def has_drift(self):
+        return has_changes(self.statements)
 
-def print_schema_banner(schema):
+def has_changes(statements):
     """
-    Prints a banner to call out the schema name.
+    Tells whether generated DDL holds any statement other than comments
+    and blank lines.
 
-    :param schema: The schema
+    :param statements: The DDL statements.
+    :returns: True if there is at least one real statement.
+    """
+    return any(statement and not statement.startswith('--') for statement in statements)
+
+def read_fleet_file(path):
+    """
+    Reads the list of databases in a fleet.  Each line is a libpq
+    connection string, optionally preceded by a name and a tab; blank
+    lines and lines starting with # are skipped.  Databases without a
+    name are named by host and database name.
+
+    :param path: The path of the file.
+    :returns: A list of (name, libpq connection string) tuples.
+    :raises ValueError: If a connection string cannot be parsed, giving the file and line number.
+    """
+    databases = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.rstrip('\n')
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            if '\t' in line:
+                name, libpq_connstr = line.split('\t', 1)
+            else:
+                name, libpq_connstr = None, line
+            libpq_connstr = libpq_connstr.strip()
+            try:
+                params = psycopg2.extensions.parse_dsn(libpq_connstr)
+            except psycopg2.ProgrammingError:
+                raise ValueError(f'{path}:{line_number}: invalid connection string') from None
+            if name is None:
+                name = '/'.join(params[key] for key in ('host', 'dbname') if params.get(key)) or libpq_connstr
+            databases.append((name.strip(), libpq_connstr))
+    return databases
+
+def get_schema_fingerprint(database, filters=None):
+    """
+    Gets a fingerprint of all schemas in a database, combining the
+    server-side fingerprints of its tables, views and functions.  Two
+    databases with the same fingerprint have the same schemas.
+
+    :param database: A libpq connection string to a database, or a connection, pool or cursor factory; see ConnectionSource.
+    :param filters: An ObjectFilter selecting the schemas, tables and views to fingerprint, if not all of them.
+    :returns: The fingerprint as a hex string.
+    """
+    source = ConnectionSource(database)
+    try:
+        cur = source.cursor(0)
+        schemas = []
+        get_schemas(cur, schemas, filters)
+        fingerprints = get_fingerprints(cur, schemas, filters)
+    finally:
+        source.close()
+    schema_names = {schema.oid: schema.name for schema in schemas}
+    digest = hashlib.md5()
+    for schema_name in sorted(schema_names.values()):
+        digest.update(f'{schema_name}\n'.encode('utf-8'))
+    for row in sorted((schema_names[schema_oid], kind, name, tuple(argtypes or ()), fingerprint) for oid, schema_oid, kind, name, argtypes, fingerprint in fingerprints):
+        digest.update(f'{row!r}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+def diff_fleet(baseline_schemas, databases, concurrency=8, filters=None):
+    """
+    Diffs many databases against one baseline.  Every database is
+    fingerprinted, with at most concurrency databases read at a time;
+    databases with the same fingerprint are grouped, and each group is
+    read in full and diffed against the baseline only once.  The DDL of
+    a group migrates its databases to the baseline.
+
+    :param baseline_schemas: The schemas of the baseline database.
+    :param databases: A list of (name, libpq connection string) tuples.
+    :param concurrency: The most databases to read at the same time.
+    :param filters: An ObjectFilter selecting the schemas, tables and views to compare, if not all of them.
+    :returns: A tuple of the list of FleetGroups, in order of first database, and a list of (name, error message) tuples for databases that could not be fingerprinted.
+    """
+    groups = {}
+    failures = []
+
+    def diff_group(group):
+        try:
+            schemas = get_schema_objects(group.databases[0][1], filters=filters)
+            group.statements = list(schemas_migration_ddl(schemas, baseline_schemas, filters))
+        except psycopg2.Error as e:
+            group.error = str(e).strip()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(get_schema_fingerprint, libpq_connstr, filters) for name, libpq_connstr in databases]
+        for (name, libpq_connstr), future in zip(databases, futures):
+            try:
+                fingerprint = future.result()
+            except psycopg2.Error as e:
+                failures.append((name, str(e).strip()))
+                continue
+            if fingerprint not in groups:
+                groups[fingerprint] = FleetGroup(fingerprint)
+            groups[fingerprint].add_database(name, libpq_connstr)
+        list(executor.map(diff_group, groups.values()))
+    return list(groups.values()), failures
+
+def write_fleet_report(groups, failures, output_dir):
     """
-    print('-- *************************************')
-    print('-- * SCHEMA: ' + schema.name)
-    print('-- *************************************')
+    Writes one migration file per distinct drift found by diff_fleet to a
+    directory, and a summary of which databases share each drift to the
+    directory and to standard output.
+
+    :param groups: The FleetGroups.
+    :param failures: The (name, error message) tuples for databases that could not be read.
+    :param output_dir: The directory to write to; it is created if need be.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    summary = []
+    drift_count = 0
+    for group in groups:
+        names = ', '.join(name for name, libpq_connstr in group.databases)
+        if group.error is not None:
+            summary.append(f'error reading {group.databases[0][0]} ({len(group.databases)} databases: {names}): {group.error}')
+        elif group.has_drift():
+            drift_count += 1
+            filename = f'drift-{drift_count:03d}.sql'
+            with open_ddl_writer(os.path.join(output_dir, filename)) as out:
+                out.writeall(group.statements)
+            summary.append(f'{filename}: {len(group.databases)} databases: {names}')
+        else:
+            summary.append(f'no drift: {len(group.databases)} databases: {names}')
+    for name, error in failures:
+        summary.append(f'error reading {name}: {error}')
+
+    with open(os.path.join(output_dir, 'summary.txt'), 'w') as f:
+        f.write('\n'.join(summary) + '\n')
+    print('\n'.join(summary))
 
 ############################################################################
 # FUNCTIONS FOR COMMAND LINE UTILITY
 ############################################################################
 
-def _main(source_libpq_connstr='', target_libpq_connstr=None):
-    source_schemas = get_schema_objects(source_libpq_connstr)
-    if target_libpq_connstr:
-        target_schemas = get_schema_objects(target_libpq_connstr)
-        print_schemas_migration_ddl(source_schemas, target_schemas)
+class _DatabaseAction(argparse.Action):
+    """
+    Collects database arguments, whether connection strings or snapshot
+    files, in command line order, so that a snapshot can stand in for
+    either the source or the target.
+    """
+    def __call__(self, parser, namespace, values, option_string=None):
+        if values is None:
+            return
+        databases = list(getattr(namespace, 'databases', None) or [])
+        databases.append(('snapshot' if option_string else 'connstr', values))
+        namespace.databases = databases
+
+class _StatsAction(argparse.Action):
+    """
+    Handles --stats with an optional format.  As the format is optional,
+    a connection string right after --stats would be taken for it, so
+    anything but a format is passed on as a database argument.
+    """
+    def __call__(self, parser, namespace, values, option_string=None):
+        if values is None or values in _STATS_FORMATS:
+            namespace.stats = values or 'text'
+        else:
+            namespace.stats = 'text'
+            _DatabaseAction(self.option_strings, 'databases')(parser, namespace, values)
+
+_STATS_FORMATS = ('text', 'json')
+
+def _object_kinds(value):
+    kinds = frozenset(kind.strip() for kind in value.split(',') if kind.strip())
+    unknown = kinds - OBJECT_KINDS
+    if unknown:
+        raise argparse.ArgumentTypeError(f'unknown object kinds: {", ".join(sorted(unknown))}')
+    return kinds
+
+def _load_catalog(database, jobs, fetch_size, filters, cache=None, lazy=False, stats=None, columnar=False):
+    kind, value = database
+    if kind == 'snapshot':
+        cache = load_snapshot(value)
+        cache.schemas = filters.filter_schemas(cache.schemas)
+        return cache
+    if lazy:
+        return CatalogCache(schemas=get_schema_objects(value, jobs, None, fetch_size, lazy, filters, stats, columnar))
+    if cache is None:
+        cache = CatalogCache()
+    get_schema_objects(value, jobs, cache, fetch_size, False, filters, stats, columnar)
+    return cache
+
+def _load_snapshot_cache(path):
+    # An existing snapshot lets the source be refreshed incrementally; one
+    # that cannot be read is simply replaced.
+    if not os.path.exists(path):
+        return None
+    try:
+        return load_snapshot(path)
+    except (ValueError, pickle.UnpicklingError, zlib.error) as e:
+        print(f'Ignoring existing snapshot: {e}', file=sys.stderr)
+        return None
+
+def _main(argv):
+    parser = argparse.ArgumentParser(description='Prints DDL to migrate the schemas of one PostgreSQL database to those of another.')
+    parser.add_argument('source', nargs='?', action=_DatabaseAction, help='libpq connection string of the source database')
+    parser.add_argument('target', nargs='?', action=_DatabaseAction, help='libpq connection string of the target database; if omitted, DDL for the source is printed')
+    parser.add_argument('--from-snapshot', action=_DatabaseAction, metavar='FILE', help='snapshot file to read in place of the source or target connection string, in command line order')
+    parser.add_argument('--save-snapshot', metavar='FILE', help='save the source schemas to a snapshot file, reading only changed objects if it already holds the same database; nothing is printed unless a target is given')
+    parser.add_argument('--include-schema', action='append', default=[], metavar='PATTERN', help='read only schemas matching PATTERN, a glob or a regular expression prefixed with ~; may be repeated')
+    parser.add_argument('--exclude-schema', action='append', default=[], metavar='PATTERN', help='do not read schemas matching PATTERN; may be repeated')
+    parser.add_argument('--include-table', action='append', default=[], metavar='PATTERN', help='read only tables and views matching PATTERN; may be repeated')
+    parser.add_argument('--exclude-table', action='append', default=[], metavar='PATTERN', help='do not read tables and views matching PATTERN; may be repeated')
+    kinds = parser.add_mutually_exclusive_group()
+    kinds.add_argument('--only', type=_object_kinds, metavar='KINDS', help=f'read and diff only these kinds of objects, comma separated: {", ".join(sorted(OBJECT_KINDS))}')
+    kinds.add_argument('--skip', type=_object_kinds, metavar='KINDS', help='read and diff all but these kinds of objects, comma separated')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N', help='number of connections per database used to load schemas in parallel')
+    parser.add_argument('--fetch-size', type=int, default=DEFAULT_FETCH_SIZE, metavar='N', help=f'catalog rows fetched at a time through server-side cursors, or 0 to buffer whole results on the client (default: {DEFAULT_FETCH_SIZE})')
+    parser.add_argument('--lazy-definitions', action='store_true', help='read only digests of function and view definitions, then read in one query the target definitions the migration prints; needs a target connection string')
+    parser.add_argument('--columnar', action='store_true', help='keep the columns of each schema\'s tables in parallel arrays rather than as an object each, and compare whole tables\' columns at once, for catalogs with millions of columns')
+    parser.add_argument('--two-phase', action='store_true', help='compare server-side fingerprints first and read in full only the objects that differ; needs two connection strings')
+    parser.add_argument('--fleet', metavar='FILE', help='diff every database listed in FILE against the source as baseline, one libpq connection string per line, optionally preceded by a name and a tab')
+    parser.add_argument('--fleet-output', metavar='DIR', default='fleet', help='directory for the per-drift migrations and summary of --fleet (default: fleet)')
+    parser.add_argument('--concurrency', type=int, default=8, metavar='N', help='most fleet databases read at the same time (default: 8)')
+    parser.add_argument('--online', action='store_true', help='generate a migration that does not block writes for long: indexes built and dropped concurrently, keys added using such indexes, and check and foreign key constraints validated separately')
+    parser.add_argument('--estimate', action='store_true', help='annotate each statement with the lock it takes, whether it rewrites or scans its table and the size of the table, and rank the most expensive statements at the end')
+    parser.add_argument('--top', type=int, default=10, metavar='N', help='number of statements ranked by --estimate (default: 10)')
+    parser.add_argument('--apply', action='store_true', help='run the migration on the source database instead of printing it, running statements that do not depend on each other at the same time, and print how each went')
+    parser.add_argument('--apply-jobs', type=int, default=4, metavar='N', help='connections to run migration statements on with --apply (default: 4)')
+    parser.add_argument('--serve', metavar='ADDRESS', help='serve diff requests over HTTP on HOST:PORT or a Unix socket path, keeping a connection to and a model of each database; any databases given are read at startup')
+    parser.add_argument('--max-databases', type=int, default=DEFAULT_SERVED_DATABASES, metavar='N', help=f'databases besides those given that --serve keeps connections to and models of, dropping the least recently used (default: {DEFAULT_SERVED_DATABASES})')
+    parser.add_argument('-o', '--output', metavar='FILE', help='write DDL to a file instead of standard output, compressed if FILE ends in .gz or .zst')
+    parser.add_argument('--stats', nargs='?', action=_StatsAction, metavar='FORMAT', help='print the time, rows and bytes of the catalog queries by loader and the time of each phase to standard error, as text (the default) or json')
+    parser.add_argument('--profile', metavar='FILE', help='save a cProfile dump of the run to FILE')
+    parser.set_defaults(databases=[])
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.fetch_size < 0:
+        parser.error('--fetch-size must not be negative')
+    if args.estimate and (len(args.databases) != 2 or args.apply or args.fleet or args.serve):
+        parser.error('--estimate needs a source and a target and cannot be used with --apply, --fleet or --serve')
+    if args.apply_jobs < 1:
+        parser.error('--apply-jobs must be at least 1')
+    if args.apply and (len(args.databases) != 2 or args.databases[0][0] != 'connstr' or args.fleet or args.serve or args.two_phase):
+        parser.error('--apply needs a source connection string to migrate and a target, and cannot be used with --fleet, --serve or --two-phase')
+    if args.serve:
+        if any(kind != 'connstr' for kind, value in args.databases) or args.save_snapshot or args.fleet or args.two_phase or args.lazy_definitions or args.output:
+            parser.error('--serve takes only connection strings, and cannot be used with snapshots, --fleet, --two-phase, --lazy-definitions or -o')
+        if args.include_schema or args.exclude_schema or args.include_table or args.exclude_table or args.only or args.skip or args.online:
+            parser.error('--serve takes filters and online with each request rather than on the command line')
+    databases = args.databases or [('connstr', '')]
+    if len(databases) > 2 and not args.serve:
+        parser.error('at most a source and a target database may be given')
+    if args.fleet and (len(databases) != 1 or args.two_phase):
+        parser.error('--fleet needs exactly one baseline database, as a connection string or snapshot')
+    if args.max_databases < 2:
+        parser.error('--max-databases must be at least 2, for the source and target of a diff')
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if args.two_phase and (len(databases) != 2 or args.save_snapshot or any(kind != 'connstr' for kind, value in databases)):
+        parser.error('--two-phase needs a source and a target connection string and cannot be used with snapshots')
+    if args.columnar and (args.two_phase or args.serve):
+        parser.error('--columnar cannot be used with --two-phase or --serve')
+
+    if args.lazy_definitions and (len(databases) != 2 or databases[1][0] != 'connstr' or args.two_phase or args.save_snapshot or args.fleet):
+        parser.error('--lazy-definitions needs a target connection string and cannot be used with --two-phase, --save-snapshot or --fleet')
+
+    if (args.only or args.skip) and args.save_snapshot:
+        parser.error('--only and --skip cannot be used with --save-snapshot, as snapshots hold all kinds of objects')
+    if args.only:
+        kinds = args.only
+    elif args.skip:
+        kinds = OBJECT_KINDS - args.skip
     else:
-        for source_schema in source_schemas:
-            print_schema_banner(source_schema)
-            print_schema_ddl(source_schema)
+        kinds = OBJECT_KINDS
+    filters = ObjectFilter(args.include_schema, args.exclude_schema, args.include_table, args.exclude_table, kinds)
+    stats = QueryStats() if args.stats else None
+
+    # The fleet file is checked before any database is read.
+    fleet = None
+    if args.fleet:
+        try:
+            fleet = read_fleet_file(args.fleet)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return _run(args, databases, filters, stats, fleet)
+    finally:
+        if args.profile:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if stats is not None:
+            print(stats.to_json() if args.stats == 'json' else stats.report(), file=sys.stderr)
+
+def _run(args, databases, filters, stats, fleet=None):
+    if args.serve:
+        service = DiffService(args.jobs, args.fetch_size, stats, args.max_databases)
+        for kind, value in args.databases:
+            service.warm(value)
+        serve(args.serve, service)
+        return
+
+    source_cache = None
+    if args.save_snapshot and databases[0][0] == 'connstr':
+        source_cache = _load_snapshot_cache(args.save_snapshot)
+
+    with stats.timed('introspect') if stats else contextlib.nullcontext():
+        if args.two_phase:
+            source_catalog = CatalogCache()
+            source_catalog.schemas, target_schemas = get_schema_objects_two_phase(databases[0][1], databases[1][1], args.fetch_size, filters, stats)
+        elif len(databases) == 2:
+            # Both catalog scans are network-bound, so load them side by side.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                source_future = executor.submit(_load_catalog, databases[0], args.jobs, args.fetch_size, filters, source_cache, args.lazy_definitions, stats, args.columnar)
+                target_future = executor.submit(_load_catalog, databases[1], args.jobs, args.fetch_size, filters, None, args.lazy_definitions, stats, args.columnar)
+                source_catalog = source_future.result()
+                target_schemas = target_future.result().schemas
+        else:
+            source_catalog = _load_catalog(databases[0], args.jobs, args.fetch_size, filters, source_cache, False, stats, args.columnar)
+            target_schemas = None
+        source_schemas = source_catalog.schemas
+        if args.lazy_definitions:
+            load_definitions(databases[1][1], definitions_needed(source_schemas, target_schemas), args.fetch_size, stats)
+
+    if args.save_snapshot:
+        with stats.timed('save snapshot') if stats else contextlib.nullcontext():
+            save_snapshot(args.save_snapshot, source_catalog)
+
+    if args.fleet:
+        groups, failures = diff_fleet(source_schemas, fleet, args.concurrency, filters)
+        write_fleet_report(groups, failures, args.fleet_output)
+        return
+
+    if target_schemas is None and args.save_snapshot:
+        return
+
+    if args.apply:
+        # The objects to be dropped depend on what the source says and
+        # those to be created on what the target says.
+        dependencies = None
+        if databases[1][0] == 'connstr':
+            dependencies = object_dependencies(databases[0][1], source_schemas)
+            for key, keys in object_dependencies(databases[1][1], target_schemas).items():
+                dependencies.setdefault(key, set()).update(keys)
+        statements = schemas_migration_ddl(source_schemas, target_schemas, filters, args.online)
+        if args.output:
+            statements = list(statements)
+            with open_ddl_writer(args.output) as out:
+                out.writeall(statements)
+        steps = migration_graph(statements, dependencies)
+        with stats.timed('apply') if stats else contextlib.nullcontext():
+            succeeded = apply_migration(databases[0][1], steps, args.apply_jobs)
+        write_apply_report(steps)
+        return 0 if succeeded else 1
+    # Statements are generated as they are written, so the diff is timed
+    # inside the generator and the rest of the time goes to rendering.
+    start = time.perf_counter()
+    with open_ddl_writer(args.output) as out:
+        if target_schemas is not None:
+            statements = schemas_migration_ddl(source_schemas, target_schemas, filters, args.online)
+            if stats:
+                statements = stats.timed_iter('diff', statements)
+            if args.estimate:
+                statements = estimated_migration_ddl(statements, source_schemas, args.top)
+            out.writeall(statements)
+        else:
+            for source_schema in source_schemas:
+                out.writeall(schema_banner(source_schema))
+                out.writeall(schema_ddl(source_schema, filters))
+    if stats is not None:
+        stats.add_phase('render', time.perf_counter() - start - stats.phases.get('diff', 0.0))
 
 if __name__ == '__main__':
-    _main(*sys.argv[1:])
+    sys.exit(_main(sys.argv[1:]))